@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+#
+# Benchmark of the mesh decimation backends on a reconstructed mesh
+# Run with python benchmarks/bench_decimation.py --input scan_unaligned.ply --instant_meshes "/path/to/Instant Meshes"
+
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+from timeit import default_timer as timer
+
+import numpy as np
+import open3d as o3d
+
+from multiscan.meshproc import TriMesh
+
+
+def surface_distance(source, target, samples):
+    """mean and maximum distance of points sampled on source to points sampled on target"""
+    source_points = source.sample_points_uniformly(number_of_points=samples)
+    target_points = target.sample_points_uniformly(number_of_points=samples)
+    distances = np.asarray(source_points.compute_point_cloud_distance(target_points))
+    return distances.mean(), distances.max()
+
+
+def instant_meshes(mesh_file, output_file, target_vertices, args):
+    cmd = [args.instant_meshes, mesh_file, '-c', str(args.crease),
+           '-r', str(args.rosy), '-p', str(args.posy), '-v', str(target_vertices), '-o', output_file]
+    if args.dominant:
+        cmd.insert(2, '--dominant')
+    subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return o3d.io.read_triangle_mesh(output_file)
+
+
+def report(name, seconds, mesh, reference, samples):
+    # distances in both directions, decimated to reference and reference to decimated
+    to_reference = surface_distance(mesh, reference, samples)
+    from_reference = surface_distance(reference, mesh, samples)
+    chamfer = (to_reference[0] + from_reference[0]) / 2
+    hausdorff = max(to_reference[1], from_reference[1])
+    print(f'{name:<16} {seconds:8.2f} s  {len(mesh.vertices):9d} vertices  {len(mesh.triangles):9d} triangles  '
+          f'chamfer {chamfer * 1000:7.3f} mm  hausdorff {hausdorff * 1000:8.3f} mm')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark mesh decimation backends')
+    parser.add_argument('--input', dest='input', type=str, required=True, help='Cleaned full resolution mesh')
+    parser.add_argument('--degree', dest='degree', type=int, default=4, help='Decimate to 1/degree number of vertices')
+    parser.add_argument('--instant_meshes', dest='instant_meshes', type=str, default=None,
+                        help='Instant Meshes binary, skipped if not given')
+    parser.add_argument('--crease', dest='crease', type=float, default=20)
+    parser.add_argument('--rosy', dest='rosy', type=int, default=4)
+    parser.add_argument('--posy', dest='posy', type=int, default=4)
+    parser.add_argument('--dominant', dest='dominant', action='store_true')
+    parser.add_argument('--samples', dest='samples', type=int, default=200000,
+                        help='Number of surface samples for the distance metrics')
+    args = parser.parse_args()
+
+    reference = o3d.io.read_triangle_mesh(args.input)
+    target_vertices = int(len(reference.vertices) / args.degree)
+    print(f'{args.input}: {len(reference.vertices)} vertices, {len(reference.triangles)} triangles, '
+          f'target {target_vertices} vertices')
+
+    start = timer()
+    decimated = TriMesh.decimate_o3d_mesh(reference, target_vertices)
+    report('quadric', timer() - start, decimated, reference, args.samples)
+
+    if args.instant_meshes:
+        tmp_dir = tempfile.mkdtemp(prefix='bench_decimation')
+        try:
+            # instant meshes reads a file, include the write of the input in its time
+            start = timer()
+            mesh_file = os.path.join(tmp_dir, 'input.ply')
+            o3d.io.write_triangle_mesh(mesh_file, reference, write_vertex_normals=True)
+            decimated = instant_meshes(mesh_file, os.path.join(tmp_dir, 'decimated.ply'), target_vertices, args)
+            report('instant meshes', timer() - start, decimated, reference, args.samples)
+        finally:
+            shutil.rmtree(tmp_dir)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+#
+# Micro-benchmark of directory listing on a synthetic frame folder
+# Run with python benchmarks/bench_file_list.py --num 100000
+
+import argparse
+import os
+import re
+import shutil
+import tempfile
+from timeit import default_timer as timer
+
+from multiscan.utils import io
+
+
+# listing as implemented before the scandir based lister
+def legacy_get_file_list(path, ext='', join_path=True):
+    def convert(text): return int(text) if text.isdigit() else text
+
+    def alphanum_key(key): return [convert(c) for c in re.split('([0-9]+)', key)]
+
+    file_list = []
+    for filename in os.listdir(path):
+        file_ext = os.path.splitext(filename)[1]
+        if (ext in file_ext or not ext) and os.path.isfile(os.path.join(path, filename)):
+            file_list.append(os.path.join(path, filename) if join_path else filename)
+    indices = [i[0] for i in sorted(enumerate(file_list), key=lambda x: alphanum_key(x[1]))]
+    return sorted(file_list, key=alphanum_key), indices
+
+
+def make_frames(path, num, ext):
+    for i in range(num):
+        open(os.path.join(path, f'{i}{ext}'), 'w').close()
+    # settle the directory mtime so the listing is cacheable
+    past = os.stat(path).st_mtime - 10
+    os.utime(path, (past, past))
+
+
+def bench(name, fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        result = fn()
+        times.append(timer() - start)
+    print(f'{name:<32} best {min(times) * 1000:9.2f} ms  mean {sum(times) / len(times) * 1000:9.2f} ms')
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark frame directory listing')
+    parser.add_argument('--num', dest='num', type=int, default=100000, help='Number of files')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=5, help='Number of repetitions')
+    parser.add_argument('--dir', dest='dir', type=str, default=None, help='Parent of the temporary folder')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix='bench_file_list', dir=args.dir)
+    try:
+        make_frames(tmp_dir, args.num, '.png')
+        print(f'{args.num} files in {tmp_dir}')
+
+        expected, _ = bench('legacy listdir+isfile+sort', lambda: legacy_get_file_list(tmp_dir, '.png'), args.repeat)
+        result = bench('scandir, no cache', lambda: io.get_file_list(tmp_dir, '.png', cache=False), args.repeat)
+        assert result == expected, 'scandir listing differs from legacy listing'
+        io.clear_listing_cache()
+        bench('scandir, cold cache', lambda: io.get_file_list(tmp_dir, '.png'), 1)
+        result = bench('scandir, warm cache', lambda: io.get_file_list(tmp_dir, '.png'), args.repeat)
+        assert result == expected, 'cached listing differs from legacy listing'
+        bench('streaming count', lambda: sum(1 for _ in io.iter_dir(tmp_dir, '.png')), args.repeat)
+    finally:
+        shutil.rmtree(tmp_dir)
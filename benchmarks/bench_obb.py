@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+#
+# Benchmark of the gravity aligned oriented bounding box on scan meshes
+# Run with python benchmarks/bench_obb.py --input scan1.ply scan2.ply
+
+import argparse
+from timeit import default_timer as timer
+
+import numpy as np
+import open3d as o3d
+from scipy.spatial import ConvexHull
+
+from multiscan.meshproc import gravity_aligned_obbs, intersect_lines, rotation_from2vectors
+
+
+# rotating calipers loop as implemented before the vectorized minimum area rectangles
+def legacy_min_area_direction(hull_points):
+    num = len(hull_points)
+    edge_dirs = np.roll(hull_points, -1, axis=0) - hull_points
+    edge_dirs /= np.linalg.norm(edge_dirs, axis=1)[:, None]
+    min_idx = np.argmin(hull_points, axis=0)
+    max_idx = np.argmax(hull_points, axis=0)
+    left_idx, right_idx, top_idx, bottom_idx = min_idx[0], max_idx[0], max_idx[1], min_idx[1]
+    left_dir, right_dir = np.array((0, -1)), np.array((0, 1))
+    top_dir, bottom_dir = np.array((-1, 0)), np.array((1, 0))
+
+    def ortho(v):
+        return np.array([v[1], -v[0]])
+
+    def angle(a, b):
+        return np.arccos(np.clip(np.dot(a, b), -1.0, 1.0))
+
+    min_area = np.inf
+    best = None
+    for _ in range(num):
+        best_line = np.argmin([angle(left_dir, edge_dirs[left_idx]), angle(right_dir, edge_dirs[right_idx]),
+                               angle(top_dir, edge_dirs[top_idx]), angle(bottom_dir, edge_dirs[bottom_idx])])
+        if best_line == 0:
+            left_dir = edge_dirs[left_idx]
+            right_dir, top_dir = -left_dir, ortho(left_dir)
+            bottom_dir = -top_dir
+            left_idx = (left_idx + 1) % num
+        elif best_line == 1:
+            right_dir = edge_dirs[right_idx]
+            left_dir = -right_dir
+            top_dir = ortho(left_dir)
+            bottom_dir = -top_dir
+            right_idx = (right_idx + 1) % num
+        elif best_line == 2:
+            top_dir = edge_dirs[top_idx]
+            bottom_dir = -top_dir
+            left_dir = ortho(bottom_dir)
+            right_dir = -left_dir
+            top_idx = (top_idx + 1) % num
+        else:
+            bottom_dir = edge_dirs[bottom_idx]
+            top_dir = -bottom_dir
+            left_dir = ortho(bottom_dir)
+            right_dir = -left_dir
+            bottom_idx = (bottom_idx + 1) % num
+        upper_left = intersect_lines(hull_points[left_idx], left_dir, hull_points[top_idx], top_dir)
+        upper_right = intersect_lines(hull_points[right_idx], right_dir, hull_points[top_idx], top_dir)
+        bottom_left = intersect_lines(hull_points[bottom_idx], bottom_dir, hull_points[left_idx], left_dir)
+        area = np.linalg.norm(upper_left - upper_right) * np.linalg.norm(upper_left - bottom_left)
+        if area < min_area:
+            min_area = area
+            best = (bottom_dir, bottom_idx, left_dir, left_idx, right_dir, right_idx, top_dir, top_idx)
+    bottom_dir, bottom_idx, left_dir, left_idx, right_dir, right_idx, top_dir, top_idx = best
+    p_bl = intersect_lines(hull_points[bottom_idx], bottom_dir, hull_points[left_idx], left_dir)
+    p_br = intersect_lines(hull_points[bottom_idx], bottom_dir, hull_points[right_idx], right_dir)
+    p_tl = intersect_lines(hull_points[left_idx], left_dir, hull_points[top_idx], top_dir)
+    return bottom_dir if np.linalg.norm(p_bl - p_br) < np.linalg.norm(p_bl - p_tl) else left_dir
+
+
+def legacy_obb(points, gravity, align_axis):
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+    pcd, _ = pcd.remove_statistical_outlier(20, 3.0)
+    points = np.asarray(pcd.points)
+    align_gravity = rotation_from2vectors(gravity, align_axis)
+    points_2d = np.matmul(align_gravity, points.transpose()).transpose()[:, 0:2]
+    hull = ConvexHull(points_2d)
+    legacy_min_area_direction(points_2d[hull.vertices])
+
+
+def bench(name, fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = timer()
+        result = fn()
+        times.append(timer() - start)
+    print(f'{name:<40} best {min(times) * 1000:9.2f} ms  mean {sum(times) / len(times) * 1000:9.2f} ms')
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark gravity aligned oriented bounding boxes')
+    parser.add_argument('--input', dest='input', type=str, nargs='+', required=True, help='Scan meshes')
+    parser.add_argument('--max_points', dest='max_points', type=int, default=100000,
+                        help='Point budget of the outlier filter')
+    parser.add_argument('--repeat', dest='repeat', type=int, default=3, help='Number of repetitions')
+    args = parser.parse_args()
+
+    gravity = np.array((0.0, 1.0, 0.0))
+    align_axis = np.array((0.0, 0.0, -1.0))
+    point_sets = [np.asarray(o3d.io.read_triangle_mesh(filename).vertices) for filename in args.input]
+    print(f'{len(point_sets)} meshes, {sum(len(points) for points in point_sets)} vertices')
+
+    bench('legacy, all vertices, calipers loop',
+          lambda: [legacy_obb(points, gravity, align_axis) for points in point_sets], args.repeat)
+    full = bench('vectorized, all vertices',
+                 lambda: gravity_aligned_obbs(point_sets, gravity, align_axis, max_points=0), args.repeat)
+    budget = bench(f'vectorized, {args.max_points} point budget',
+                   lambda: gravity_aligned_obbs(point_sets, gravity, align_axis, max_points=args.max_points),
+                   args.repeat)
+    for filename, (_, full_size, _), (_, size, _) in zip(args.input, full, budget):
+        print(f'{filename}: size {np.round(full_size, 3)} all vertices, {np.round(size, 3)} with point budget')
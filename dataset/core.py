@@ -6,7 +6,7 @@ import numpy as np
 import pandas as pd
 import trimesh
 from multiscan.utils import io
-from plyfile import PlyData
+from multiscan.utils import ply
 
 class Preprocess:
     def __init__(self, cfg, scan_dir):
@@ -36,23 +36,14 @@ class Preprocess:
         return io.read_json(os.path.join(self.input_path, f'{self.scan_id}.annotations.json'))
 
     def _get_plydata(self):
-        return PlyData.read(os.path.join(self.input_path, f'{self.scan_id}.ply'))
+        return ply.read_ply(os.path.join(self.input_path, f'{self.scan_id}.ply'))
 
     def _construct_mesh(self):
-        x = np.asarray(self.plydata['vertex']['x'])
-        y = np.asarray(self.plydata['vertex']['y'])
-        z = np.asarray(self.plydata['vertex']['z'])
-        nx = np.asarray(self.plydata['vertex']['nx'])
-        ny = np.asarray(self.plydata['vertex']['ny'])
-        nz = np.asarray(self.plydata['vertex']['nz'])
-        red = self.plydata['vertex']['red'].astype('float64') / 255.
-        green = self.plydata['vertex']['green'].astype('float64') / 255.
-        blue = self.plydata['vertex']['blue'].astype('float64') / 255.
-        
-        vertices = np.column_stack((x, y, z))
-        vertex_normals = np.column_stack((nx, ny, nz))
-        vertex_colors = np.column_stack((red, green, blue))
-        triangles = np.vstack(self.plydata['face'].data['vertex_indices'])
+        vertex = self.plydata['vertex']
+        vertices = ply.columns(vertex, ('x', 'y', 'z'))
+        vertex_normals = ply.columns(vertex, ('nx', 'ny', 'nz'))
+        vertex_colors = ply.columns(vertex, ('red', 'green', 'blue')) / 255.
+        triangles = ply.faces(self.plydata['face'])
         return vertices, vertex_colors, vertex_normals, triangles
 
     def construct_o3d_mesh(self):
@@ -71,8 +62,8 @@ class Preprocess:
         return trimesh.Trimesh(vertices=vertices, faces=triangles, vertex_normals=vertex_normals, vertex_colors=vertex_colors, process=False)
 
     def semseg_triangles(self):
-        object_ids = self.plydata['face'].data['objectId']
-        part_ids = self.plydata['face'].data['partId']
+        object_ids = self.plydata['face']['objectId']
+        part_ids = self.plydata['face']['partId']
         return pd.DataFrame({'objectId': object_ids, 'partId': part_ids})
 
     def object_triangles(self, object_id):
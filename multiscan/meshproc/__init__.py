@@ -1,2 +1,3 @@
-from .common import rotation_from2vectors, intersect_lines
-from .plymesh import TriMesh
\ No newline at end of file
+from .common import rotation_from2vectors, intersect_lines, min_area_rectangles
+from .plymesh import TriMesh, gravity_aligned_obbs
+from .session import MeshSession, mesh_session
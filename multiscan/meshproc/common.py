@@ -28,3 +28,42 @@ def intersect_lines(s0, d0, s1, d1):
     t = np.cross(vec_s, d1) / sin_a
 
     return s0 + t * d0
+
+
+# minimum area enclosing rectangles of many convex hulls at once, rotating calipers over all hull edges
+def min_area_rectangles(hulls):
+    """
+    hulls: (G, K, 2) convex hull vertices in counterclockwise order, shorter hulls padded by repeating a vertex
+    return: bottom edge directions (G, 2) in the first quadrant, left edge directions (G, 2) and
+            rectangle extents (G, 2) along the bottom and left directions
+    """
+    hulls = np.asarray(hulls, dtype=np.float64)
+    edges = np.roll(hulls, -1, axis=1) - hulls
+    norms = np.linalg.norm(edges, axis=2)
+    # padded hull vertices give zero length edges, they take the direction of the first edge
+    valid = norms > 0
+    first = np.argmax(valid, axis=1)
+    edges = np.where(valid[..., None], edges, edges[np.arange(len(hulls)), first][:, None, :])
+    edges /= np.linalg.norm(edges, axis=2, keepdims=True)
+
+    # rotate the edge directions into the first quadrant [0, 90) degrees, the bottom caliper
+    # starts along +x and the calipers rotate counterclockwise by 90 degrees in total
+    bottom = edges.copy()
+    for _ in range(3):
+        outside = ~((bottom[..., 0] > 0) & (bottom[..., 1] >= 0))
+        bottom[outside] = np.stack([-bottom[outside][:, 1], bottom[outside][:, 0]], axis=1)
+    left = np.stack([bottom[..., 1], -bottom[..., 0]], axis=2)
+
+    # extents of the hulls along every edge orientation, (G, K edges, K points)
+    along_bottom = np.einsum('gkd,gmd->gkm', bottom, hulls)
+    along_left = np.einsum('gkd,gmd->gkm', left, hulls)
+    extent_bottom = along_bottom.max(axis=2) - along_bottom.min(axis=2)
+    extent_left = along_left.max(axis=2) - along_left.min(axis=2)
+    area = extent_bottom * extent_left
+    # ties go to the smallest caliper rotation
+    angle = np.arctan2(bottom[..., 1], bottom[..., 0])
+    best = np.argmin(np.where(np.isclose(area, area.min(axis=1, keepdims=True), rtol=1e-12, atol=0.0),
+                              angle, np.inf), axis=1)
+    index = np.arange(len(hulls))
+    return (bottom[index, best], left[index, best],
+            np.stack([extent_bottom[index, best], extent_left[index, best]], axis=1))
@@ -7,13 +7,98 @@ import pymeshlab
 from scipy.spatial import ConvexHull
 
 from multiscan.utils import io
-from multiscan.meshproc import rotation_from2vectors, intersect_lines
+from multiscan.meshproc import rotation_from2vectors, min_area_rectangles
+from multiscan.meshproc.session import mesh_session
+
+# number of points the statistical outlier filter of the obb runs on
+OUTLIER_MAX_POINTS = 100000
+
+
+def inlier_points(points, nb_neighbors=20, std_ratio=3.0, max_points=OUTLIER_MAX_POINTS):
+    """points without statistical outliers
+
+    Above max_points points the filter runs on the centroids of a voxel grid sized for about
+    max_points occupied voxels, and the points of the outlier voxels are removed.
+
+    :param points: (N, 3) points
+    :param max_points: point budget of the outlier filter, 0 filters all points
+    :return: (M, 3) inlier points
+    """
+    points = np.asarray(points, dtype=np.float64)
+    if max_points <= 0 or len(points) <= max_points:
+        pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points))
+        _, indices = pcd.remove_statistical_outlier(nb_neighbors, std_ratio)
+        return points[indices]
+
+    min_pt = points.min(axis=0)
+    extent = points.max(axis=0) - min_pt
+    # scans are surfaces, estimate their area by the surface of the bounding box
+    area = 2.0 * (extent[0] * extent[1] + extent[1] * extent[2] + extent[0] * extent[2])
+    voxel_size = max(np.sqrt(area / max_points), np.finfo(float).eps)
+    coords = np.floor((points - min_pt) / voxel_size).astype(np.int64)
+    keys = (coords[:, 0] << 42) | (coords[:, 1] << 21) | coords[:, 2]
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    centroids = np.stack([np.bincount(inverse, weights=points[:, i]) for i in range(3)], axis=1) / counts[:, None]
+    pcd = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(centroids))
+    _, indices = pcd.remove_statistical_outlier(nb_neighbors, std_ratio)
+    inlier_voxels = np.zeros(len(counts), dtype=bool)
+    inlier_voxels[indices] = True
+    return points[inlier_voxels[inverse]]
+
+
+def gravity_aligned_obbs(point_sets, gravity=np.array((0.0, 1.0, 0.0)), align_axis=np.array((0.0, 0.0, -1.0)),
+                         nb_neighbors=20, std_ratio=3.0, max_points=OUTLIER_MAX_POINTS):
+    """gravity aligned minimum area oriented bounding boxes of many point sets
+
+    The boxes share the up axis gravity, their orientation around it is the minimum area
+    rectangle of the convex hull of the inlier points projected along gravity. The rectangles
+    of all point sets are evaluated at once.
+
+    :param point_sets: list of (N, 3) points, e.g. mesh vertices of scans or objects
+    :return: list of (center, size, rotation) of the boxes
+    """
+    align_gravity = rotation_from2vectors(gravity, align_axis)
+    inliers = []
+    hulls = []
+    for points in point_sets:
+        points = inlier_points(points, nb_neighbors, std_ratio, max_points)
+        points_2d = np.matmul(align_gravity, points.transpose()).transpose()[:, 0:2]
+        hull = ConvexHull(points_2d)
+        assert len(hull.vertices) > 0, 'convex hull vertices number must be positive'
+        inliers.append(points)
+        # the vertices are in counterclockwise order
+        hulls.append(points_2d[hull.vertices])
+    if not hulls:
+        return []
+
+    num_hull_points = max(len(hull) for hull in hulls)
+    padded = np.stack([np.concatenate([hull, np.repeat(hull[-1:], num_hull_points - len(hull), axis=0)])
+                       for hull in hulls])
+    bottom_dirs, left_dirs, extents = min_area_rectangles(padded)
+
+    obbs = []
+    for points, bottom_dir, left_dir, extent in zip(inliers, bottom_dirs, left_dirs, extents):
+        # the shorter rectangle side becomes the -y axis
+        vec = bottom_dir if extent[0] < extent[1] else left_dir
+        vec = np.concatenate([vec, [0]])
+        third_t = np.array([np.cross(-vec, align_axis), -vec, align_axis])
+        trans_w2b = np.matmul(third_t, align_gravity)
+        aligned_points = np.matmul(trans_w2b, points.transpose()).transpose()
+
+        min_pt = np.amin(aligned_points, axis=0)
+        max_pt = np.amax(aligned_points, axis=0)
+        center = (min_pt + max_pt) / 2.0
+
+        trans_inv = np.linalg.inv(trans_w2b)
+        obbs.append((np.matmul(trans_inv, center), max_pt - min_pt, trans_inv))
+    return obbs
 
 
 class TriMesh:
     def __init__(self, mesh):
         if mesh and isinstance(mesh, str) and io.file_exist(mesh):
-            self.o3d_mesh = o3d.io.read_triangle_mesh(mesh)
+            self.o3d_mesh = mesh_session().o3d_mesh(mesh)
         elif isinstance(mesh, o3d.geometry.TriangleMesh):
             self.o3d_mesh = mesh
         else:
@@ -31,17 +116,18 @@ class TriMesh:
         self.ch.setFormatter(self.formatter)
         self.logger.addHandler(self.ch)
 
-    def obb_calc(self, aligned=True, gravity=np.array((0.0, 1.0, 0.0)), align_axis=np.array((0.0, 0.0, -1.0))):
+    def obb_calc(self, aligned=True, gravity=np.array((0.0, 1.0, 0.0)), align_axis=np.array((0.0, 0.0, -1.0)),
+                 max_points=OUTLIER_MAX_POINTS):
         if aligned:
-            obb_center, obb_size, trans_inv = self.__gravity_aligned_mobb(gravity, align_axis)
+            obb_center, obb_size, trans_inv = self.__gravity_aligned_mobb(gravity, align_axis, max_points=max_points)
             self.obb = o3d.geometry.OrientedBoundingBox(obb_center, trans_inv, obb_size)
         else:
             self.obb = self.o3d_mesh.get_oriented_bounding_box()
         return self.obb
 
-    def align_mesh(self, transform_output=None):
+    def align_mesh(self, transform_output=None, max_points=OUTLIER_MAX_POINTS):
         if not self.obb:
-            self.obb_calc()
+            self.obb_calc(max_points=max_points)
         rotation = self.obb.R.copy()
         center = self.obb.center.copy()
         transform_mat = np.diag([1.0, 1.0, 1.0, 1.0])
@@ -71,197 +157,27 @@ class TriMesh:
         if self.o3d_mesh:
             self.o3d_mesh.transform(transform_mat)
 
-    def __gravity_aligned_mobb(self, gravity, align_axis, nb_neighbors=20, std_ratio=3.0, debug=False):
-        pcd = o3d.geometry.PointCloud(self.o3d_mesh.vertices)
-        pcd, _ = pcd.remove_statistical_outlier(nb_neighbors, std_ratio)
-        points = np.asarray(pcd.points)
-
-        def mobb_area(left_start, left_dir, right_start, right_dir,
-                      top_start, top_dir, bottom_start, bottom_dir):
-            upper_left = intersect_lines(left_start, left_dir, top_start, top_dir)
-            upper_right = intersect_lines(right_start, right_dir, top_start, top_dir)
-            bottom_left = intersect_lines(bottom_start, bottom_dir, left_start, left_dir)
-
-            return np.linalg.norm(upper_left - upper_right) * np.linalg.norm(upper_left - bottom_left)
-
-        align_gravity = rotation_from2vectors(gravity, align_axis)
-
-        tmp_points = np.matmul(align_gravity, points.transpose()).transpose()
-        points_2d = tmp_points[:, 0:2]
-        hull = ConvexHull(points_2d)
-
-        # plot conver hull
+    def __gravity_aligned_mobb(self, gravity, align_axis, nb_neighbors=20, std_ratio=3.0, debug=False,
+                               max_points=OUTLIER_MAX_POINTS):
+        points = np.asarray(self.o3d_mesh.vertices)
+        (obb_center, obb_size, trans_inv), = gravity_aligned_obbs([points], gravity, align_axis, nb_neighbors,
+                                                                  std_ratio, max_points)
         if debug:
+            align_gravity = rotation_from2vectors(gravity, align_axis)
+            points_2d = np.matmul(align_gravity, points.transpose()).transpose()[:, 0:2]
+            hull = ConvexHull(points_2d)
             self.logger.debug(len(hull.vertices))
             fig = plt.figure(figsize=(5, 5))
             ax = fig.add_subplot(111)
             plt.plot(points_2d[:, 0], points_2d[:, 1], '.')
-            plt.plot(points_2d[hull.vertices, 0],
-                     points_2d[hull.vertices, 1], 'r--', lw=4)
-            plt.plot(points_2d[(hull.vertices[-1], hull.vertices[0]), 0],
-                     points_2d[(hull.vertices[-1], hull.vertices[0]), 1], 'r--', lw=4)
-            plt.plot(points_2d[hull.vertices[:], 0], points_2d[hull.vertices[:], 1],
-                     marker='o', markersize=7, color="red")
+            hull_loop = np.append(hull.vertices, hull.vertices[0])
+            plt.plot(points_2d[hull_loop, 0], points_2d[hull_loop, 1], 'r--', lw=4)
+            # obb axes in the gravity aligned plane
+            center_2d = np.matmul(align_gravity, obb_center)[0:2]
+            for axis in np.matmul(align_gravity, trans_inv).transpose()[0:2]:
+                plt.axline(center_2d, center_2d + axis[0:2], color="m", lw=6)
             ax.set_aspect('equal', adjustable='box')
-        assert len(hull.vertices) > 0, 'convex hull vertices number must be positive'
-
-        # the vertices are in counterclockwise order
-        hull_points = points_2d[hull.vertices]
-
-        edge_dirs = np.roll(hull_points, -1, axis=0) - hull_points
-        edge_norm = np.linalg.norm(edge_dirs, axis=1)
-        edge_dirs /= edge_norm[:, None]
-
-        min_idx = np.argmin(hull_points, axis=0)
-        max_idx = np.argmax(hull_points, axis=0)
-        min_pt = np.array((hull_points[min_idx[0]][0], hull_points[min_idx[1]][1]))
-        max_pt = np.array((hull_points[max_idx[0]][0], hull_points[max_idx[1]][1]))
-
-        left_idx = min_idx[0]
-        right_idx = max_idx[0]
-        top_idx = max_idx[1]
-        bottom_idx = min_idx[1]
-
-        left_dir = np.array((0, -1))
-        right_dir = np.array((0, 1))
-        top_dir = np.array((-1, 0))
-        bottom_dir = np.array((1, 0))
-
-        if debug:
-            plt.plot(hull_points[bottom_idx][0], hull_points[bottom_idx][1],
-                     marker='o', markersize=14, color="r")
-            plt.axline((hull_points[bottom_idx][0], hull_points[bottom_idx][1]), (
-                hull_points[bottom_idx][0] + bottom_dir[0], hull_points[bottom_idx][1] + bottom_dir[1]))
-            plt.plot(hull_points[left_idx][0], hull_points[left_idx][1],
-                     marker='o', markersize=14, color="r")
-            plt.axline((hull_points[left_idx][0], hull_points[left_idx][1]), (
-                hull_points[left_idx][0] + left_dir[0], hull_points[left_idx][1] + left_dir[1]))
-            plt.plot(hull_points[right_idx][0], hull_points[right_idx][1],
-                     marker='o', markersize=14, color="r")
-            plt.axline((hull_points[right_idx][0], hull_points[right_idx][1]), (
-                hull_points[right_idx][0] + right_dir[0], hull_points[right_idx][1] + right_dir[1]))
-            plt.plot(hull_points[top_idx][0], hull_points[top_idx][1],
-                     marker='o', markersize=14, color="r")
-            plt.axline((hull_points[top_idx][0], hull_points[top_idx][1]), (
-                hull_points[top_idx][0] + top_dir[0], hull_points[top_idx][1] + top_dir[1]))
-
-        min_area = np.finfo(np.float).max
-        best_bottom_dir = np.array((np.nan, np.nan))
-        best_bottom_idx = -1
-        best_left_dir = np.array((np.nan, np.nan))
-        best_left_idx = -1
-        best_top_dir = np.array((np.nan, np.nan))
-        best_top_idx = -1
-        best_right_dir = np.array((np.nan, np.nan))
-        best_right_idx = -1
-
-        def ortho(v):
-            return np.array([v[1], -v[0]])
-
-        for i in range((len(hull.vertices))):
-            angles = [np.arccos(np.clip(np.dot(left_dir, edge_dirs[left_idx]), -1.0, 1.0)),
-                      np.arccos(np.clip(np.dot(right_dir, edge_dirs[right_idx]), -1.0, 1.0)),
-                      np.arccos(np.clip(np.dot(top_dir, edge_dirs[top_idx]), -1.0, 1.0)),
-                      np.arccos(np.clip(np.dot(bottom_dir, edge_dirs[bottom_idx]), -1.0, 1.0))]
-            angles = np.asarray(angles)
-
-            best_line = np.argmin(angles)
-            min_angle = angles[best_line]
-
-            if best_line == 0:
-                left_dir = edge_dirs[left_idx]
-                right_dir = -left_dir
-                top_dir = ortho(left_dir)
-                bottom_dir = -top_dir
-                left_idx = (left_idx + 1) % len(hull.vertices)
-            elif best_line == 1:
-                right_dir = edge_dirs[right_idx]
-                left_dir = -right_dir
-                top_dir = ortho(left_dir)
-                bottom_dir = -top_dir
-                right_idx = (right_idx + 1) % len(hull.vertices)
-            elif best_line == 2:
-                top_dir = edge_dirs[top_idx]
-                bottom_dir = -top_dir
-                left_dir = ortho(bottom_dir)
-                right_dir = -left_dir
-                top_idx = (top_idx + 1) % len(hull.vertices)
-            elif best_line == 3:
-                bottom_dir = edge_dirs[bottom_idx]
-                top_dir = -bottom_dir
-                left_dir = ortho(bottom_dir)
-                right_dir = -left_dir
-                bottom_idx = (bottom_idx + 1) % len(hull.vertices)
-            else:
-                assert False
-
-            area = mobb_area(hull_points[left_idx], left_dir, hull_points[right_idx], right_dir,
-                             hull_points[top_idx], top_dir, hull_points[bottom_idx], bottom_dir)
-
-            if area < min_area:
-                min_area = area
-                best_bottom_dir = bottom_dir
-                best_bottom_idx = bottom_idx
-                best_left_dir = left_dir
-                best_left_idx = left_idx
-                best_right_dir = right_dir
-                best_right_idx = right_idx
-                best_top_dir = top_dir
-                best_top_idx = top_idx
-
-        p_bl = intersect_lines(
-            hull_points[best_bottom_idx], best_bottom_dir, hull_points[best_left_idx], best_left_dir)
-        p_br = intersect_lines(
-            hull_points[best_bottom_idx], best_bottom_dir, hull_points[best_right_idx], best_right_dir)
-        p_tl = intersect_lines(
-            hull_points[best_left_idx], best_left_dir, hull_points[best_top_idx], best_top_dir)
-
-        len_b = np.linalg.norm(p_bl - p_br)
-        len_l = np.linalg.norm(p_bl - p_tl)
-
-        if len_b < len_l:
-            vec = best_bottom_dir / np.linalg.norm(best_bottom_dir)
-        else:
-            vec = best_left_dir / np.linalg.norm(best_left_dir)
-            self.logger.debug(vec)
-        vec = np.concatenate([vec, [0]])
-        if debug:
-            plt.axline((hull_points[best_bottom_idx][0], hull_points[best_bottom_idx][1]), (
-                hull_points[best_bottom_idx][0] + best_bottom_dir[0],
-                hull_points[best_bottom_idx][1] + best_bottom_dir[1]), color="m", lw=6)
-            plt.axline((hull_points[best_left_idx][0], hull_points[best_left_idx][1]), (
-                hull_points[best_left_idx][0] + best_left_dir[0], hull_points[best_left_idx][1] + best_left_dir[1]),
-                       color="m", lw=6)
-            plt.axline((hull_points[best_right_idx][0], hull_points[best_right_idx][1]), (
-                hull_points[best_right_idx][0] + best_right_dir[0], hull_points[best_right_idx][1] + best_right_dir[1]),
-                       color="m", lw=6)
-            plt.axline((hull_points[best_top_idx][0], hull_points[best_top_idx][1]), (
-                hull_points[best_top_idx][0] + best_top_dir[0], hull_points[best_top_idx][1] + best_top_dir[1]),
-                       color="m", lw=6)
-
-            plt.plot(hull_points[best_bottom_idx][0], hull_points[best_bottom_idx][1],
-                     marker='o', markersize=21, color="g")
-            plt.plot(hull_points[best_left_idx][0], hull_points[best_left_idx][1],
-                     marker='o', markersize=21, color="g")
-            plt.plot(hull_points[best_right_idx][0], hull_points[best_right_idx][1],
-                     marker='o', markersize=21, color="g")
-            plt.plot(hull_points[best_top_idx][0], hull_points[best_top_idx][1],
-                     marker='o', markersize=21, color="g")
             plt.show()
-
-        third_t = np.array([np.cross(-vec, align_axis), -vec, align_axis])
-        trans_w2b = np.matmul(third_t, align_gravity)
-        aligned_points = np.matmul(trans_w2b, points.transpose()).transpose()
-
-        min_pt = np.amin(aligned_points, axis=0)
-        max_pt = np.amax(aligned_points, axis=0)
-
-        center = (min_pt + max_pt) / 2.0
-
-        trans_inv = np.linalg.inv(trans_w2b)
-        obb_center = np.matmul(trans_inv, center)
-        obb_size = max_pt - min_pt
-
         return obb_center, obb_size, trans_inv
 
     def o3d_render(self, output=None, win_width=640, win_height=480, show_obb=False, show_frame=False,
@@ -282,6 +198,63 @@ class TriMesh:
             vis.run()
             vis.destroy_window()
 
+    @staticmethod
+    def _cleanup_meshset(ms, min_iso_face_num=50):
+        ms.remove_duplicate_faces()
+        ms.remove_duplicate_vertices()
+        ms.remove_zero_area_faces()
+        ms.repair_non_manifold_edges_by_removing_faces()
+        ms.remove_isolated_pieces_wrt_face_num(mincomponentsize=min_iso_face_num)
+
+    @staticmethod
+    def cleanup_o3d_mesh(mesh, min_iso_face_num=50, log=None):
+        """clean up an open3d triangle mesh in memory, same as cleanup_mesh without the file round trip
+
+        :param mesh: open3d triangle mesh
+        :return: cleaned open3d triangle mesh with recomputed vertex normals
+        """
+        vertex_colors = None
+        if mesh.has_vertex_colors():
+            colors = np.asarray(mesh.vertex_colors)
+            vertex_colors = np.hstack([colors, np.ones((len(colors), 1))])
+        ms = pymeshlab.MeshSet()
+        if vertex_colors is not None:
+            ms.add_mesh(pymeshlab.Mesh(vertex_matrix=np.asarray(mesh.vertices),
+                                       face_matrix=np.asarray(mesh.triangles),
+                                       v_color_matrix=vertex_colors))
+        else:
+            ms.add_mesh(pymeshlab.Mesh(vertex_matrix=np.asarray(mesh.vertices),
+                                       face_matrix=np.asarray(mesh.triangles)))
+        if log:
+            log.debug(f"Number of vertices loaded: {ms.current_mesh().vertex_number()}")
+        TriMesh._cleanup_meshset(ms, min_iso_face_num)
+        ms.re_compute_vertex_normals(weightmode=0)
+
+        cleaned = ms.current_mesh()
+        result = o3d.geometry.TriangleMesh(o3d.utility.Vector3dVector(cleaned.vertex_matrix()),
+                                           o3d.utility.Vector3iVector(cleaned.face_matrix()))
+        result.vertex_normals = o3d.utility.Vector3dVector(cleaned.vertex_normal_matrix())
+        if vertex_colors is not None:
+            result.vertex_colors = o3d.utility.Vector3dVector(cleaned.vertex_color_matrix()[:, :3])
+        if log:
+            log.debug(f"Number of vertices after postprocessing: {cleaned.vertex_number()}")
+        return result
+
+    @staticmethod
+    def decimate_o3d_mesh(mesh, target_vertices):
+        """quadric edge collapse decimation of an open3d triangle mesh to about target_vertices vertices
+
+        :param mesh: open3d triangle mesh
+        :param target_vertices: number of vertices of the decimated mesh
+        :return: decimated open3d triangle mesh with vertex normals
+        """
+        # a triangle mesh has about twice as many triangles as vertices
+        target_triangles = max(1, min(2 * int(target_vertices), len(mesh.triangles)))
+        decimated = mesh.simplify_quadric_decimation(target_number_of_triangles=target_triangles)
+        decimated.remove_unreferenced_vertices()
+        decimated.compute_vertex_normals()
+        return decimated
+
     @staticmethod
     def cleanup_mesh(input_file, min_iso_face_num=50, output_file=None, log=None):
         if output_file is None:
@@ -290,11 +263,7 @@ class TriMesh:
         ms.load_new_mesh(input_file)
         if log:
             log.debug(f"Number of vertices loaded: {ms.current_mesh().vertex_number()}")
-        ms.remove_duplicate_faces()
-        ms.remove_duplicate_vertices()
-        ms.remove_zero_area_faces()
-        ms.repair_non_manifold_edges_by_removing_faces()
-        ms.remove_isolated_pieces_wrt_face_num(mincomponentsize=min_iso_face_num)
+        TriMesh._cleanup_meshset(ms, min_iso_face_num)
         # convert texture mesh to ply mesh with vertex colors
         if io.file_extension(input_file) == '.obj' and io.file_extension(output_file) == '.ply':
             ms.transfer_color_texture_to_vertex()
@@ -0,0 +1,201 @@
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+import open3d as o3d
+
+from multiscan.utils import io
+from multiscan.utils import ply
+
+log = logging.getLogger(__name__)
+
+# environment variable overriding the cache folder shared by the stage processes
+CACHE_DIR_ENV = 'MULTISCAN_MESH_CACHE'
+# environment variable overriding the size limit of the cache folder in bytes
+CACHE_BYTES_ENV = 'MULTISCAN_MESH_CACHE_BYTES'
+DEFAULT_CACHE_BYTES = 4 * 1024 ** 3
+# meshes a process keeps attached
+DEFAULT_MAX_MESHES = 8
+# cache entries being written by a process that did not finish them for this long are removed
+STALE_SECONDS = 3600
+# mesh arrays stored in the cache
+ARRAYS = ('vertices', 'faces', 'normals', 'colors')
+TMP_MARKER = '.tmp-'
+
+
+def default_cache_dir():
+    return os.environ.get(CACHE_DIR_ENV, os.path.join(tempfile.gettempdir(), 'multiscan-mesh-cache'))
+
+
+def _file_stamp(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def _folder_size(folder):
+    size = 0
+    for name in os.listdir(folder):
+        try:
+            size += os.path.getsize(os.path.join(folder, name))
+        except OSError:
+            pass
+    return size
+
+
+class MeshSession:
+    """meshes parsed once and shared by the stages of a pipeline running in separate processes
+
+    The arrays of a parsed ply mesh are saved as .npy files into a cache folder shared by the
+    processes, keyed by the path, size and mtime of the mesh, so a mesh rewritten by a later stage
+    is parsed again. Other processes memory map the arrays instead of parsing the ply file, they
+    share them through the page cache. The least recently used meshes are removed from the folder
+    once it holds more than max_bytes, and a process keeps at most max_meshes meshes attached.
+    """
+
+    def __init__(self, folder=None, max_bytes=None, max_meshes=DEFAULT_MAX_MESHES):
+        """
+        :param folder: cache folder, MULTISCAN_MESH_CACHE or multiscan-mesh-cache in the temp folder by default
+        :param max_bytes: size limit of the cache folder, MULTISCAN_MESH_CACHE_BYTES or 4 GB by default
+        :param max_meshes: number of meshes kept attached by the process
+        """
+        self.folder = folder or default_cache_dir()
+        if max_bytes is None:
+            max_bytes = int(os.environ.get(CACHE_BYTES_ENV, DEFAULT_CACHE_BYTES))
+        self.max_bytes = max_bytes
+        self.max_meshes = max_meshes
+        # number of ply files parsed by the process, the others were attached from the cache
+        self.parsed = 0
+        self._meshes = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entry(self, path, stamp):
+        key = hashlib.sha1(f'{path}\0{stamp[0]}\0{stamp[1]}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, key)
+
+    @staticmethod
+    def _attach(entry):
+        """memory mapped arrays of a cache entry, None if it is not cached"""
+        try:
+            names = [name for name in os.listdir(entry) if name.endswith('.npy')]
+            mesh = {name[:-len('.npy')]: np.load(os.path.join(entry, name), mmap_mode='r') for name in names}
+            # mark the entry as recently used
+            os.utime(entry)
+        except (FileNotFoundError, NotADirectoryError):
+            # not cached or removed by another process meanwhile
+            return None
+        return mesh
+
+    def _store(self, entry, mesh):
+        """save the arrays of a mesh as a cache entry and remove the least recently used entries"""
+        os.makedirs(self.folder, exist_ok=True)
+        # complete entries appear at once, concurrent writers of the same mesh keep the first
+        tmp = f'{entry}{TMP_MARKER}{os.getpid()}-{threading.get_ident()}'
+        os.makedirs(tmp)
+        try:
+            for name, array in mesh.items():
+                np.save(os.path.join(tmp, name + '.npy'), array)
+            os.rename(tmp, entry)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise
+        self._evict(keep=entry)
+
+    def _evict(self, keep=None):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.folder):
+            entry = os.path.join(self.folder, name)
+            try:
+                used = os.path.getmtime(entry)
+                if TMP_MARKER in name:
+                    if now - used > STALE_SECONDS:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    continue
+                entries.append((used, _folder_size(entry), entry))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for used, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def mesh(self, path):
+        """vertices, faces, and normals and colors if the vertices have them, of a ply mesh
+
+        The arrays are read only and have the types of multiscan.utils.ply.read_mesh.
+        """
+        path = os.path.abspath(path)
+        stamp = _file_stamp(path)
+        with self._lock:
+            cached = self._meshes.get(path)
+            if cached is not None and cached[0] == stamp:
+                self._meshes.move_to_end(path)
+                return cached[1]
+        entry = self._entry(path, stamp)
+        mesh = self._attach(entry)
+        if mesh is None:
+            # not memory mapped, stages may rewrite the file while the mesh is in use
+            data = ply.read_mesh(path, mmap=False)
+            mesh = {name: data[name] for name in ARRAYS if name in data}
+            for array in mesh.values():
+                array.flags.writeable = False
+            self.parsed += 1
+            try:
+                self._store(entry, mesh)
+            except OSError as e:
+                log.warning(f'Cannot cache {path} in {self.folder}: {e}')
+        with self._lock:
+            self._meshes[path] = (stamp, mesh)
+            self._meshes.move_to_end(path)
+            while len(self._meshes) > self.max_meshes:
+                self._meshes.popitem(last=False)
+        return mesh
+
+    def o3d_mesh(self, path):
+        """new open3d triangle mesh of a mesh file, meshes other than triangle ply are read by open3d"""
+        if io.file_extension(path).lower() != '.ply':
+            return o3d.io.read_triangle_mesh(path)
+        try:
+            mesh = self.mesh(path)
+        except (IOError, ValueError, KeyError) as e:
+            log.debug(f'Reading {path} with open3d: {e}')
+            return o3d.io.read_triangle_mesh(path)
+        o3d_mesh = o3d.geometry.TriangleMesh(
+            o3d.utility.Vector3dVector(mesh['vertices'].astype(np.float64)),
+            o3d.utility.Vector3iVector(mesh['faces']))
+        if 'normals' in mesh:
+            o3d_mesh.vertex_normals = o3d.utility.Vector3dVector(mesh['normals'].astype(np.float64))
+        if 'colors' in mesh:
+            o3d_mesh.vertex_colors = o3d.utility.Vector3dVector(mesh['colors'] / 255.0)
+        return o3d_mesh
+
+    def invalidate(self, path=None):
+        """drop a mesh from the process and the cache folder, or all meshes if path is None"""
+        with self._lock:
+            if path is None:
+                self._meshes.clear()
+                shutil.rmtree(self.folder, ignore_errors=True)
+                return
+            path = os.path.abspath(path)
+            self._meshes.pop(path, None)
+        if os.path.isfile(path):
+            shutil.rmtree(self._entry(path, _file_stamp(path)), ignore_errors=True)
+
+
+_session = MeshSession()
+
+
+def mesh_session():
+    """mesh session of the process"""
+    return _session
@@ -0,0 +1,195 @@
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+
+import psutil
+
+log = logging.getLogger(__name__)
+
+# environment variable telling child processes which cores were reserved for them
+ALLOCATED_CPUS_ENV = 'MULTISCAN_ALLOCATED_CPUS'
+# environment variable overriding the shared allocation state file
+STATE_FILE_ENV = 'MULTISCAN_CORES_FILE'
+
+
+def parse_cpu_list(text):
+    """parse linux cpu list format, e.g. 0-3,8,10-11
+
+    :param text: cpu list string
+    :return: sorted list of cpu ids
+    """
+    cpus = set()
+    for part in text.strip().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-')
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+
+def format_cpu_list(cpus):
+    return ','.join(str(c) for c in sorted(cpus))
+
+
+def numa_nodes(sys_path='/sys/devices/system/node'):
+    """cpu ids of each NUMA node, a single node with all cpus if topology is not available
+
+    :return: dict of node id to list of cpu ids
+    """
+    nodes = {}
+    if os.path.isdir(sys_path):
+        for name in os.listdir(sys_path):
+            match = re.match(r'node(\d+)$', name)
+            if not match:
+                continue
+            try:
+                with open(os.path.join(sys_path, name, 'cpulist'), 'r') as f:
+                    cpus = parse_cpu_list(f.read())
+            except OSError:
+                continue
+            if cpus:
+                nodes[int(match.group(1))] = cpus
+    if not nodes:
+        nodes[0] = list(range(psutil.cpu_count()))
+    return nodes
+
+
+def default_state_file():
+    return os.environ.get(STATE_FILE_ENV, os.path.join(tempfile.gettempdir(), 'multiscan-cores.json'))
+
+
+class CoreAllocator:
+    """hand out disjoint cpu sets to concurrent jobs
+
+    Allocations are kept in a json state file guarded by an exclusive file lock, so that
+    jobs started by different processes (e.g. two scans processed in parallel) see each other.
+    Allocations of processes that died without releasing are reclaimed automatically.
+    """
+
+    def __init__(self, state_file=None, cpus=None, poll_interval=1.0):
+        self.state_file = state_file or default_state_file()
+        self.lock_file = self.state_file + '.lock'
+        # cpus this process is allowed to hand out
+        self.cpus = sorted(cpus) if cpus is not None else sorted(os.sched_getaffinity(0))
+        self.nodes = {}
+        for node, node_cpus in numa_nodes().items():
+            node_cpus = [c for c in node_cpus if c in self.cpus]
+            if node_cpus:
+                self.nodes[node] = node_cpus
+        # cpus missing from the reported topology form a node of their own
+        unknown = [c for c in self.cpus if not any(c in node_cpus for node_cpus in self.nodes.values())]
+        if unknown:
+            self.nodes[-1] = unknown
+        self.poll_interval = poll_interval
+
+    @contextlib.contextmanager
+    def _locked_state(self):
+        with open(self.lock_file, 'a+') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                state = {}
+                if os.path.isfile(self.state_file) and os.path.getsize(self.state_file) > 0:
+                    try:
+                        with open(self.state_file, 'r') as f:
+                            state = json.load(f)
+                    except ValueError:
+                        log.warning(f'Corrupted core allocation state {self.state_file}, resetting')
+                # drop allocations of dead owners
+                state = {cpu: owner for cpu, owner in state.items() if psutil.pid_exists(owner.get('pid', -1))}
+                yield state
+                tmp_file = self.state_file + '.tmp'
+                with open(tmp_file, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_file, self.state_file)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _select(self, free, num):
+        # prefer the NUMA node able to hold the whole request with the fewest spare cores,
+        # otherwise spill over from the nodes with most free cores
+        free_per_node = {node: [c for c in cpus if c in free] for node, cpus in self.nodes.items()}
+        fitting = [node for node, cpus in free_per_node.items() if len(cpus) >= num]
+        if fitting:
+            node = min(fitting, key=lambda n: (len(free_per_node[n]), n))
+            return free_per_node[node][:num]
+        selected = []
+        for node in sorted(free_per_node, key=lambda n: (-len(free_per_node[n]), n)):
+            selected += free_per_node[node][:num - len(selected)]
+            if len(selected) == num:
+                break
+        return selected
+
+    def allocate(self, num, owner=None, tag='', wait=True, timeout=None):
+        """reserve up to num cores
+
+        Blocks until at least one core is free when wait is set. If fewer cores than requested
+        are free after the timeout, the free ones are returned.
+
+        :param num: number of cores requested
+        :param owner: pid owning the cores, allocation is reclaimed when it exits
+        :param tag: description stored with the allocation
+        :return: list of cpu ids
+        """
+        num = max(1, min(num, len(self.cpus)))
+        owner = owner or os.getpid()
+        start = time.time()
+        while True:
+            with self._locked_state() as state:
+                free = [c for c in self.cpus if str(c) not in state]
+                expired = timeout is not None and time.time() - start >= timeout
+                if len(free) >= num or (free and (not wait or expired)):
+                    cpus = self._select(free, num)
+                    for c in cpus:
+                        state[str(c)] = {'pid': owner, 'tag': tag, 'time': time.time()}
+                    return cpus
+            if not wait:
+                return []
+            time.sleep(self.poll_interval)
+
+    def release(self, cpus, owner=None):
+        owner = owner or os.getpid()
+        with self._locked_state() as state:
+            for c in cpus:
+                if state.get(str(c), {}).get('pid') == owner:
+                    del state[str(c)]
+
+    def allocations(self):
+        with self._locked_state() as state:
+            return dict(state)
+
+
+def inherited_cpus():
+    """cores reserved for this process by its parent, None if there are none"""
+    cpus = os.environ.get(ALLOCATED_CPUS_ENV)
+    if cpus:
+        return parse_cpu_list(cpus)
+    return None
+
+
+@contextlib.contextmanager
+def reserve(num, tag='', allocator=None, timeout=None):
+    """context manager reserving num disjoint cores for the duration of a job
+
+    Cores reserved by a parent process (passed down in MULTISCAN_ALLOCATED_CPUS) are reused
+    instead of allocating again, so nested jobs stay within the parent's share.
+    """
+    cpus = inherited_cpus()
+    if cpus is not None:
+        yield cpus[:num] if num > 0 else cpus
+        return
+    allocator = allocator or CoreAllocator()
+    cpus = allocator.allocate(num, tag=tag, timeout=timeout)
+    log.info(f'Reserved cpus {format_cpu_list(cpus)} for {tag or os.getpid()}')
+    try:
+        yield cpus
+    finally:
+        allocator.release(cpus)
@@ -0,0 +1,145 @@
+import json
+import os
+
+import numpy as np
+
+# file extension of frame stores, also used as --format of depth_decode.py
+EXT = '.frames'
+# name of the frame store inside a decoded frame folder
+DEFAULT_NAME = 'depth' + EXT
+
+MAGIC = b'MSFRAMES'
+VERSION = 1
+# header size, frames start page aligned after it
+HEADER_SIZE = 4096
+
+
+def find_store(folder):
+    """path of the frame store in a decoded frame folder, None if there is none"""
+    path = os.path.join(folder, DEFAULT_NAME)
+    if os.path.isfile(path):
+        return path
+    return None
+
+
+def _read_header(path):
+    with open(path, 'rb') as f:
+        header = f.read(HEADER_SIZE)
+    if not header.startswith(MAGIC):
+        raise IOError(f'{path} is not a frame store')
+    header = json.loads(header[len(MAGIC):].rstrip(b'\0').decode('utf-8'))
+    if header.get('version', 0) > VERSION:
+        raise IOError(f'Unsupported frame store version {header.get("version")} of {path}')
+    return header
+
+
+class FrameStoreWriter:
+    """write frames of equal size into a single memory mappable file
+
+    The file holds a fixed size json header, the raw frames in slot order and the frame index of
+    every slot. Slots can be written in any order and from several processes at once, since
+    every slot has a fixed offset. The header and the index are written by finalize once the
+    number of frames is known.
+    """
+
+    def __init__(self, path, height, width, dtype='uint16', create=True):
+        self.path = path
+        self.height = height
+        self.width = width
+        self.dtype = np.dtype(dtype)
+        self.frame_bytes = height * width * self.dtype.itemsize
+        if create:
+            with open(path, 'wb') as f:
+                f.write(b'\0' * HEADER_SIZE)
+        self._fd = None
+
+    def __getstate__(self):
+        # workers reopen the existing file on their first write
+        state = self.__dict__.copy()
+        state['_fd'] = None
+        return state
+
+    def __del__(self):
+        self.close()
+
+    def _file(self):
+        if self._fd is None:
+            self._fd = os.open(self.path, os.O_WRONLY)
+        return self._fd
+
+    def write(self, slot, frames):
+        """write a frame, or a stack of frames to consecutive slots starting at slot"""
+        frames = np.ascontiguousarray(frames, dtype=self.dtype)
+        os.pwrite(self._file(), frames.tobytes(), HEADER_SIZE + slot * self.frame_bytes)
+
+    def finalize(self, indices, **attributes):
+        """write the index and the header
+
+        :param indices: frame index of each slot
+        :param attributes: additional json serializable header fields
+        """
+        indices = np.asarray(indices, dtype='<i8')
+        index_offset = HEADER_SIZE + len(indices) * self.frame_bytes
+        fd = self._file()
+        os.pwrite(fd, indices.tobytes(), index_offset)
+        os.truncate(fd, index_offset + indices.nbytes)
+        header = dict(attributes)
+        header.update({
+            'version': VERSION,
+            'dtype': self.dtype.str,
+            'height': self.height,
+            'width': self.width,
+            'count': len(indices),
+            'data_offset': HEADER_SIZE,
+            'index_offset': index_offset,
+        })
+        header = MAGIC + json.dumps(header).encode('utf-8')
+        if len(header) > HEADER_SIZE:
+            raise ValueError('Frame store header attributes are too large')
+        os.pwrite(fd, header.ljust(HEADER_SIZE, b'\0'), 0)
+
+    def close(self):
+        if getattr(self, '_fd', None) is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class FrameStore:
+    """read only view of a frame store
+
+    Frames are memory mapped, store[k] returns the frame in slot k and frame(i) the frame
+    with frame index i.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = _read_header(path)
+        self.height = self.header['height']
+        self.width = self.header['width']
+        self.dtype = np.dtype(self.header['dtype'])
+        count = self.header['count']
+        self.frames = np.memmap(path, dtype=self.dtype, mode='r', offset=self.header['data_offset'],
+                                shape=(count, self.height, self.width))
+        self.indices = np.fromfile(path, dtype='<i8', count=count, offset=self.header['index_offset'])
+        self._slots = None
+
+    def __getstate__(self):
+        return {'path': self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, slot):
+        return self.frames[slot]
+
+    def __iter__(self):
+        for slot in range(len(self)):
+            yield self.frames[slot]
+
+    def frame(self, index):
+        if self._slots is None:
+            self._slots = {int(i): slot for slot, i in enumerate(self.indices)}
+        return self.frames[self._slots[index]]
@@ -1,3 +1,5 @@
+import collections
+import contextlib
 import datetime
 import json
 import hashlib
@@ -6,6 +8,8 @@ import re
 import shutil
 import subprocess as subp
 import sys
+import threading
+import time
 import traceback
 import psutil
 import resource
@@ -15,6 +19,8 @@ import multiprocessing.pool
 from timeit import default_timer as timer
 from enum import Enum
 
+from . import cores
+
 def file_exist(file_path, ext=''):
     if not os.path.exists(file_path) or not os.path.isfile(file_path):
         return False
@@ -40,8 +46,8 @@ def folder_exist(folder_path):
 
 def ensure_dir_exists(path):
     try:
-        if not os.path.isdir(path):
-            os.makedirs(path)
+        # concurrent steps may create the same folder
+        os.makedirs(path, exist_ok=True)
     except OSError:
         raise
 
@@ -58,6 +64,23 @@ def make_clean_folder(path_folder):
             raise
 
 
+_alphanum_split = re.compile('([0-9]+)')
+_frame_name = re.compile('([0-9]+)([^0-9]*)')
+
+
+def alphanum_key(text):
+    """natural sort key of a string, e.g. 2.png sorts before 10.png
+
+    :param text: a string
+    :return: tuple of alternating text and integer parts
+    """
+    # fast path for frame files named <number><ext>, gives the same key as the general split
+    match = _frame_name.fullmatch(text)
+    if match:
+        return ('', int(match.group(1)), match.group(2))
+    return tuple(int(c) if c.isdigit() else c for c in _alphanum_split.split(text))
+
+
 def sorted_alphanum(file_list):
     """sort the file list by arrange the numbers in filenames in increasing order
 
@@ -67,44 +90,101 @@ def sorted_alphanum(file_list):
     if len(file_list) <= 1:
         return file_list, [0]
 
-    def convert(text): return int(text) if text.isdigit() else text
+    keys = [alphanum_key(f) for f in file_list]
+    indices = sorted(range(len(file_list)), key=keys.__getitem__)
+    return [file_list[i] for i in indices], indices
+
+
+# directory listings keyed by path, reused while the directory mtime is unchanged
+_listing_cache = collections.OrderedDict()
+_listing_cache_size = 64
+_listing_cache_lock = threading.Lock()
 
-    def alphanum_key(key): return [convert(c)
-                                   for c in re.split('([0-9]+)', key)]
 
-    indices = [i[0]
-               for i in sorted(enumerate(file_list), key=lambda x: alphanum_key(x[1]))]
-    return sorted(file_list, key=alphanum_key), indices
+def iter_dir(path, ext='', files=True, folders=False, join_path=True):
+    """stream directory entries in file system order without sorting
 
-def get_file_list(path, ext='', join_path=True):
-    file_list = []
+    :param path: directory path
+    :param ext: only yield files with the extension
+    :param files: yield files
+    :param folders: yield folders
+    :param join_path: yield full paths instead of names
+    """
+    with os.scandir(path) as it:
+        for entry in it:
+            if files and (ext in os.path.splitext(entry.name)[1] or not ext) and entry.is_file():
+                yield entry.path if join_path else entry.name
+            elif folders and not ext and entry.is_dir():
+                yield entry.path if join_path else entry.name
+
+
+def _scan_sorted(path, cache=True):
+    # list of (name, extension, is_file, is_dir) sorted by natural order, and a dict of query results
+    st = os.stat(path)
+    if cache:
+        with _listing_cache_lock:
+            cached = _listing_cache.get(path)
+            if cached is not None and cached[0] == st.st_mtime_ns:
+                _listing_cache.move_to_end(path)
+                return cached[1], cached[2]
+
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            entries.append((alphanum_key(entry.name), entry.name, entry.is_file(), entry.is_dir()))
+    entries.sort(key=lambda e: e[0])
+    entries = [(name, os.path.splitext(name)[1], is_file, is_dir) for _, name, is_file, is_dir in entries]
+    queries = {}
+
+    # entries changed within the mtime resolution would be missed, only cache settled directories
+    if cache and time.time() - st.st_mtime > 1.0:
+        with _listing_cache_lock:
+            _listing_cache[path] = (st.st_mtime_ns, entries, queries)
+            _listing_cache.move_to_end(path)
+            while len(_listing_cache) > _listing_cache_size:
+                _listing_cache.popitem(last=False)
+    return entries, queries
+
+
+def scan_dir(path, ext='', files=True, folders=False, join_path=True, cache=True):
+    """list directory entries in natural order
+
+    :param path: directory path
+    :param ext: only list files with the extension
+    :param files: list files
+    :param folders: list folders
+    :param join_path: return full paths instead of names
+    :param cache: reuse the listing of an unchanged directory
+    :return: sorted list of entries
+    """
+    entries, queries = _scan_sorted(path, cache)
+    query = (ext, files, folders, join_path)
+    with _listing_cache_lock:
+        result = queries.get(query)
+    if result is None:
+        prefix = os.path.join(path, '') if join_path else ''
+        result = [prefix + name for name, name_ext, is_file, is_dir in entries
+                  if (files and is_file and (ext in name_ext or not ext)) or (folders and is_dir and not ext)]
+        # queries is shared with the cached listing
+        with _listing_cache_lock:
+            result = queries.setdefault(query, result)
+    return list(result)
+
+
+def clear_listing_cache():
+    with _listing_cache_lock:
+        _listing_cache.clear()
+
+
+def get_file_list(path, ext='', join_path=True, cache=True):
     if not os.path.exists(path):
-        return file_list
-
-    for filename in os.listdir(path):
-        file_ext = file_extension(filename)
-        if (ext in file_ext or not ext) and os.path.isfile(os.path.join(path, filename)):
-            if join_path:
-                file_list.append(os.path.join(path, filename))
-            else:
-                file_list.append(filename)
-    file_list, _ = sorted_alphanum(file_list)
-    return file_list
-
-def get_folder_list(path, join_path=True):
+        return []
+    return scan_dir(path, ext=ext, join_path=join_path, cache=cache)
+
+def get_folder_list(path, join_path=True, cache=True):
     if not os.path.exists(path):
         raise OSError('Path {} not exist!'.format(path))
-
-    folder_list = []
-    for foldername in os.listdir(path):
-        if not os.path.isdir(os.path.join(path, foldername)):
-            continue
-        if join_path:
-            folder_list.append(os.path.join(path, foldername))
-        else:
-            folder_list.append(foldername)
-    folder_list, _ = sorted_alphanum(folder_list)
-    return folder_list
+    return scan_dir(path, files=False, folders=True, join_path=join_path, cache=cache)
 
 
 def filesize(file_path):
@@ -138,64 +218,180 @@ def limit_memory(maxsize):
     # print(f'memory limit set to {maxsize} GB')
     resource.setrlimit(resource.RLIMIT_AS, (maxsize, hard))
 
-# TODO: make memory limitation configurable
-def call(cmd, log, rundir='', env=None, desc=None, cpu_num=0, mem=48, print_at_run=True, test_mode=False):
+
+# per-scan file collecting resource usage records of io.call, one json object per line
+_metrics_file = None
+
+
+def set_metrics_file(path):
+    global _metrics_file
+    _metrics_file = path
+
+
+def get_metrics_file():
+    return _metrics_file
+
+
+def read_metrics(filename):
+    records = []
+    if file_exist(filename):
+        with open(filename, 'r') as fp:
+            for line in fp:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    return records
+
+
+def write_metrics(record, filename):
+    # append mode with a single write keeps concurrent records on separate lines
+    with open(filename, 'a') as fp:
+        fp.write(json.dumps(record) + '\n')
+
+
+def exit_status(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    elif os.WIFEXITED(status):
+        return os.WEXITSTATUS(status)
+    return status
+
+
+def wait_with_rusage(prog):
+    """wait for a Popen child and collect its resource usage
+
+    :param prog: subprocess.Popen instance
+    :return: exit code and resource.struct_rusage of the child, rusage is None if already reaped
+    """
+    try:
+        _, status, rusage = os.wait4(prog.pid, 0)
+    except ChildProcessError:
+        return prog.wait(), None
+    # mark the child as reaped so Popen does not wait on it again
+    prog.returncode = exit_status(status)
+    return prog.returncode, rusage
+
+
+def usage_record(cmd, desc, start, wall_time, returncode, rusage):
+    record = {
+        'desc': desc,
+        'cmd': cmd,
+        'start': datetime.datetime.fromtimestamp(start).isoformat(),
+        'wall_time': wall_time,
+        'returncode': returncode,
+    }
+    if rusage is not None:
+        record['user_time'] = rusage.ru_utime
+        record['sys_time'] = rusage.ru_stime
+        record['cpu_time'] = rusage.ru_utime + rusage.ru_stime
+        record['cpu_utilization'] = record['cpu_time'] / wall_time if wall_time > 0 else 0.0
+        # linux reports maxrss in kilobytes and block io in 512 byte units
+        record['max_rss'] = rusage.ru_maxrss * 1024
+        record['read_bytes'] = rusage.ru_inblock * 512
+        record['write_bytes'] = rusage.ru_oublock * 512
+        record['major_faults'] = rusage.ru_majflt
+        record['voluntary_ctx_switches'] = rusage.ru_nvcsw
+        record['involuntary_ctx_switches'] = rusage.ru_nivcsw
+    return record
+
+
+# default address space limit of io.call in GB, raised by memory aware schedulers for retried jobs
+_call_mem_limit = 48
+
+# output of commands failing to allocate memory, e.g. when reaching their address space limit
+OUT_OF_MEMORY_MARKERS = (b'MemoryError', b'std::bad_alloc', b'out of memory', b'Cannot allocate memory')
+
+
+def set_call_memory_limit(mem):
+    global _call_mem_limit
+    _call_mem_limit = mem
+
+
+def get_call_memory_limit():
+    return _call_mem_limit
+
+
+def has_out_of_memory_marker(output):
+    return any(marker in output for marker in OUT_OF_MEMORY_MARKERS)
+
+
+def call(cmd, log, rundir='', env=None, desc=None, cpu_num=0, mem=None, print_at_run=True, test_mode=False,
+         metrics_file=None):
     if not cmd:
         log.warning('No command given')
         return 0
     if test_mode:
         log.info('Running ' + str(cmd))
         return -1
-    cwd = os.getcwd()
     res = -1
     prog = None
+    metrics_file = metrics_file or _metrics_file
+    mem = mem or _call_mem_limit
+    reservation = contextlib.ExitStack()
 
-    # constraint cpu usage with taskset
-    if cpu_num > 0:
-        all_cpus = list(range( min(psutil.cpu_count(), cpu_num)))
-        sub_cpus = all_cpus[:cpu_num]
-        str_cpus = ','.join(str(e) for e in sub_cpus)
-        taskset_cmd = ['taskset', '-c', str_cpus]
-        cmd = taskset_cmd + cmd
-    
     try:
+        # constraint cpu usage with taskset on cores not used by other concurrent jobs
+        if cpu_num > 0:
+            sub_cpus = reservation.enter_context(cores.reserve(cpu_num, tag=desc or os.path.basename(cmd[0])))
+            str_cpus = cores.format_cpu_list(sub_cpus)
+            taskset_cmd = ['taskset', '-c', str_cpus]
+            cmd = taskset_cmd + cmd
+            env = dict(os.environ if env is None else env)
+            env[cores.ALLOCATED_CPUS_ENV] = str_cpus
+
+        start = time.time()
         start_time = timer()
+        # run in rundir without changing the working directory, calls may run in concurrent threads
         if rundir:
-            os.chdir(rundir)
-            log.info('Currently in ' + os.getcwd())
+            log.info('Currently in ' + os.path.abspath(rundir))
         log.info('Running ' + str(cmd))
         log.info(f'memory limit set to {mem} GB')
         setlimits = lambda: limit_memory(mem*1000*1000*1000) # in GB
-        prog = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.STDOUT, env=env, preexec_fn=setlimits)
+        prog = subp.Popen(cmd, stdout=subp.PIPE, stderr=subp.STDOUT, env=env, preexec_fn=setlimits,
+                         cwd=rundir or None)
         # print output during the running
+        out_of_memory = False
         if print_at_run:
-            while True:
-                nextline = prog.stdout.readline()
-                if nextline == b'' and prog.poll() is not None:
-                    break
+            for nextline in iter(prog.stdout.readline, b''):
+                out_of_memory = out_of_memory or has_out_of_memory_marker(nextline)
                 sys.stdout.write(nextline.decode("utf-8"))
                 sys.stdout.flush()
-        
-        out, err = prog.communicate()
+            out = None
+        else:
+            out = prog.stdout.read()
+            out_of_memory = has_out_of_memory_marker(out)
+        prog.stdout.close()
+        # reap the child ourselves to get its rusage, Popen.poll/communicate would discard it
+        res, rusage = wait_with_rusage(prog)
         if out:
             log.info(out.decode("utf-8"))
-        if err:
-            log.error('Errors reported running ' + str(cmd))
-            log.error(err.decode("utf-8"))
         end_time = timer()
         delta_time = end_time - start_time
         desc_str = desc + ', ' if desc else ''
         desc_str = desc_str + 'cmd="' + str(cmd) + '"'
         log.info('Time=' + str(datetime.timedelta(seconds=delta_time)) + ' for ' + desc_str)
-        res = prog.returncode
+        record = usage_record(cmd, desc, start, delta_time, res, rusage)
+        record['out_of_memory'] = out_of_memory
+        if rusage is not None:
+            log.info(f'Usage user={record["user_time"]:.2f}s sys={record["sys_time"]:.2f}s '
+                     f'max_rss={natural_size(record["max_rss"])} read={natural_size(record["read_bytes"])} '
+                     f'write={natural_size(record["write_bytes"])} returncode={res} for {desc_str}')
+        if res != 0:
+            log.error('Errors reported running ' + str(cmd) + ', return code ' + str(res))
+        if metrics_file:
+            try:
+                write_metrics(record, metrics_file)
+            except OSError:
+                log.warning('Cannot write metrics to ' + metrics_file)
     except KeyboardInterrupt:
         log.warning("Keyboard interrupt")
     except Exception as e:
-        if prog is not None:
+        if prog is not None and prog.returncode is None:
             prog.kill()
-            out, err = prog.communicate()
+            prog.wait()
         log.error(traceback.format_exc())
-    os.chdir(cwd)
+    finally:
+        reservation.close()
     return res
 
 # https://stackoverflow.com/questions/3431825/generating-a-md5-checksum-of-a-file
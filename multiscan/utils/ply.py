@@ -0,0 +1,360 @@
+import io
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+# ply property types to numpy types
+PLY_TYPES = {
+    'char': 'i1', 'int8': 'i1',
+    'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2',
+    'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4',
+    'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4',
+    'double': 'f8', 'float64': 'f8',
+}
+# numpy kinds and sizes to ply property types, used when writing
+NUMPY_TYPES = {
+    'i1': 'char', 'u1': 'uchar', 'i2': 'short', 'u2': 'ushort',
+    'i4': 'int', 'u4': 'uint', 'f4': 'float', 'f8': 'double',
+}
+BYTE_ORDERS = {
+    'binary_little_endian': '<',
+    'binary_big_endian': '>',
+    'ascii': '=',
+}
+# field of the list length of a list property in the structured arrays
+COUNT_SUFFIX = '_count'
+
+
+def read_header(f):
+    """parse the header of a ply file
+
+    :param f: binary file object positioned at the start of the file
+    :return: (format, elements), elements is a list of (name, count, properties) with properties a
+        list of (name, type) for scalar and (name, count type, item type) for list properties
+    """
+    if f.readline().strip() != b'ply':
+        raise IOError('Not a ply file')
+    file_format = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise IOError('Unexpected end of ply header')
+        tokens = line.decode('ascii').split()
+        if not tokens or tokens[0] in ('comment', 'obj_info'):
+            continue
+        if tokens[0] == 'end_header':
+            break
+        if tokens[0] == 'format':
+            file_format = tokens[1]
+            if file_format not in BYTE_ORDERS:
+                raise IOError(f'Unsupported ply format {file_format}')
+        elif tokens[0] == 'element':
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == 'property':
+            if tokens[1] == 'list':
+                elements[-1][2].append((tokens[4], PLY_TYPES[tokens[2]], PLY_TYPES[tokens[3]]))
+            else:
+                elements[-1][2].append((tokens[2], PLY_TYPES[tokens[1]]))
+    return file_format, elements
+
+
+def element_dtype(properties, byte_order, list_length=None):
+    """structured dtype of an element with list properties of fixed length
+
+    A list property is a field of list_length items, preceded by a <name>_count field with the
+    list length of each row.
+
+    :param list_length: dict of list property name to its length
+    """
+    fields = []
+    for prop in properties:
+        if len(prop) == 2:
+            fields.append((prop[0], byte_order + prop[1]))
+        else:
+            name, count_type, item_type = prop
+            fields.append((name + COUNT_SUFFIX, byte_order + count_type))
+            fields.append((name, byte_order + item_type, (list_length[name],)))
+    return np.dtype(fields)
+
+
+def _list_lengths(buffer, offset, properties, byte_order):
+    """list lengths of the first row of an element, None if it has a list after another list"""
+    lengths = {}
+    for prop in properties:
+        if len(prop) == 2:
+            offset += np.dtype(prop[1]).itemsize
+            continue
+        if lengths:
+            # the offset of a second list depends on the length of the first one in every row
+            return None
+        name, count_type, item_type = prop
+        count = int(np.frombuffer(buffer, dtype=byte_order + count_type, count=1, offset=offset)[0])
+        lengths[name] = count
+        offset += np.dtype(count_type).itemsize + count * np.dtype(item_type).itemsize
+    return lengths
+
+
+def _read_binary_rows(buffer, offset, count, properties, byte_order):
+    """read an element with variable length lists row by row, lists are padded with zeros
+
+    :return: (structured array, offset after the element)
+    """
+    rows = []
+    for _ in range(count):
+        row = []
+        for prop in properties:
+            if len(prop) == 2:
+                dtype = np.dtype(byte_order + prop[1])
+                row.append(np.frombuffer(buffer, dtype=dtype, count=1, offset=offset)[0])
+                offset += dtype.itemsize
+            else:
+                count_dtype = np.dtype(byte_order + prop[1])
+                item_dtype = np.dtype(byte_order + prop[2])
+                num = int(np.frombuffer(buffer, dtype=count_dtype, count=1, offset=offset)[0])
+                offset += count_dtype.itemsize
+                row.append(num)
+                row.append(np.frombuffer(buffer, dtype=item_dtype, count=num, offset=offset))
+                offset += num * item_dtype.itemsize
+        rows.append(row)
+    return _pack_rows(rows, properties, '='), offset
+
+
+def _pack_rows(rows, properties, byte_order):
+    lengths = {}
+    column = 0
+    for prop in properties:
+        if len(prop) == 3:
+            lengths[prop[0]] = max((len(row[column + 1]) for row in rows), default=0)
+            column += 1
+        column += 1
+    data = np.zeros(len(rows), dtype=element_dtype(properties, byte_order, lengths))
+    column = 0
+    for prop in properties:
+        if len(prop) == 2:
+            data[prop[0]] = [row[column] for row in rows]
+        else:
+            data[prop[0] + COUNT_SUFFIX] = [row[column] for row in rows]
+            for i, row in enumerate(rows):
+                data[prop[0]][i, :len(row[column + 1])] = row[column + 1]
+            column += 1
+        column += 1
+    return data
+
+
+def _read_ascii(f, elements):
+    data = OrderedDict()
+    for name, count, properties in elements:
+        lines = [f.readline() for _ in range(count)]
+        if not any(len(prop) == 3 for prop in properties):
+            values = np.loadtxt(lines, dtype=np.float64, ndmin=2) if count else np.empty((0, len(properties)))
+            element = np.empty(count, dtype=element_dtype(properties, '='))
+            for i, prop in enumerate(properties):
+                element[prop[0]] = values[:, i]
+            data[name] = element
+            continue
+        rows = []
+        for line in lines:
+            tokens = line.split()
+            row = []
+            position = 0
+            for prop in properties:
+                if len(prop) == 2:
+                    row.append(float(tokens[position]))
+                    position += 1
+                else:
+                    num = int(tokens[position])
+                    row.append(num)
+                    row.append(np.asarray(tokens[position + 1:position + 1 + num], dtype=np.float64))
+                    position += 1 + num
+            rows.append(row)
+        data[name] = _pack_rows(rows, properties, '=')
+    return data
+
+
+def read_ply(source, mmap=True):
+    """read the elements of a ply file into structured arrays
+
+    Elements of binary files whose list properties have the same length in every row, such as the
+    triangles of a mesh, are memory mapped without a copy. Other elements are read row by row.
+
+    :param source: path or binary file object
+    :param mmap: memory map files given by path, read them into memory otherwise
+    :return: OrderedDict of element name to structured array, e.g. data['vertex']['x'] and
+        data['face']['vertex_indices'] as an (F, 3) array
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            file_format, elements = read_header(f)
+            offset = f.tell()
+            if file_format == 'ascii':
+                return _read_ascii(f, elements)
+            if mmap and os.path.getsize(source) > offset:
+                # copy on write, arrays can be modified without changing the file
+                buffer = np.memmap(f, dtype=np.uint8, mode='c')
+            else:
+                f.seek(0)
+                buffer = bytearray(f.read())
+    else:
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        file_format, elements = read_header(source)
+        if file_format == 'ascii':
+            return _read_ascii(source, elements)
+        offset = source.tell()
+        source.seek(0)
+        buffer = bytearray(source.read())
+
+    byte_order = BYTE_ORDERS[file_format]
+    data = OrderedDict()
+    for name, count, properties in elements:
+        if count:
+            lengths = _list_lengths(buffer, offset, properties, byte_order)
+        else:
+            lengths = {prop[0]: 0 for prop in properties if len(prop) == 3}
+        if lengths is not None:
+            dtype = element_dtype(properties, byte_order, lengths)
+            element = np.frombuffer(buffer, dtype=dtype, count=count, offset=offset)
+            # every row must have the list lengths of the first one
+            if all(np.all(element[prop + COUNT_SUFFIX] == length) for prop, length in lengths.items()):
+                data[name] = element
+                offset += count * dtype.itemsize
+                continue
+        data[name], offset = _read_binary_rows(buffer, offset, count, properties, byte_order)
+    return data
+
+
+def columns(element, names, dtype=np.float64):
+    """(N, len(names)) array of the properties names of an element"""
+    return np.column_stack([np.asarray(element[name], dtype=dtype) for name in names]) \
+        if len(names) else np.empty((len(element), 0), dtype=dtype)
+
+
+def float_dtype(element, names):
+    """float type of the properties names of an element, float64 if any is stored as double"""
+    stored = [element.dtype.fields[name][0] for name in names]
+    return np.float64 if any(dtype.kind == 'f' and dtype.itemsize == 8 for dtype in stored) else np.float32
+
+
+def faces(face, name='vertex_indices'):
+    """(F, 3) int32 vertex indices of a face element of triangles
+
+    The indices are a view of the face element if they are stored as native 32 bit integers.
+    """
+    if name not in face.dtype.names and 'vertex_index' in face.dtype.names:
+        name = 'vertex_index'
+    indices = face[name]
+    if not len(indices):
+        return np.empty((0, 3), dtype=np.int32)
+    if indices.ndim != 2 or indices.shape[1] != 3:
+        raise ValueError(f'Faces are not triangles, {indices.shape[1:]} vertices per face')
+    if indices.dtype.kind in 'iu' and indices.dtype.itemsize == 4 and indices.dtype.isnative:
+        return indices.view(np.int32)
+    return indices.astype(np.int32)
+
+
+def read_mesh(source, mmap=True):
+    """read a triangle mesh
+
+    :return: dict with 'vertices' (N, 3), 'faces' (F, 3) int32, 'normals' (N, 3) and 'colors'
+        (N, 3) uint8 if the vertices have them, and the 'vertex' and 'face' elements with all
+        properties such as the per face objectId and partId of annotated scans. Vertices and
+        normals are float64 if they are stored as double, e.g. by open3d, and float32 otherwise
+    """
+    data = read_ply(source, mmap=mmap)
+    vertex = data['vertex']
+    names = vertex.dtype.names
+    xyz = ('x', 'y', 'z')
+    mesh = {'vertex': vertex, 'vertices': columns(vertex, xyz, dtype=float_dtype(vertex, xyz))}
+    normal_names = ('nx', 'ny', 'nz')
+    if all(name in names for name in normal_names):
+        mesh['normals'] = columns(vertex, normal_names, dtype=float_dtype(vertex, normal_names))
+    if all(name in names for name in ('red', 'green', 'blue')):
+        mesh['colors'] = columns(vertex, ('red', 'green', 'blue'), dtype=np.uint8)
+    if 'face' in data:
+        mesh['face'] = data['face']
+        mesh['faces'] = faces(data['face'])
+    else:
+        mesh['faces'] = np.empty((0, 3), dtype=np.int32)
+    return mesh
+
+
+def write_ply(filename, elements, comments=()):
+    """write structured arrays as the elements of a binary little endian ply file
+
+    Fields with a subarray shape (n,) are written as list properties of length n with uchar counts.
+    The <name>_count fields of arrays returned by read_ply are skipped.
+
+    :param elements: OrderedDict or list of (name, structured array)
+    """
+    if isinstance(elements, dict):
+        elements = list(elements.items())
+    header = ['ply', 'format binary_little_endian 1.0']
+    header += [f'comment {comment}' for comment in comments]
+    outputs = []
+    for name, element in elements:
+        header.append(f'element {name} {len(element)}')
+        fields = []
+        for field in element.dtype.names:
+            base, shape = element.dtype.fields[field][0].base, element.dtype.fields[field][0].shape
+            if field.endswith(COUNT_SUFFIX) and field[:-len(COUNT_SUFFIX)] in element.dtype.names \
+                    and element.dtype.fields[field[:-len(COUNT_SUFFIX)]][0].shape:
+                continue
+            ply_type = NUMPY_TYPES[base.kind + str(base.itemsize)]
+            if shape:
+                header.append(f'property list uchar {ply_type} {field}')
+                fields.append((field + COUNT_SUFFIX, 'u1'))
+                fields.append((field, '<' + base.kind + str(base.itemsize), shape))
+            else:
+                header.append(f'property {ply_type} {field}')
+                fields.append((field, '<' + base.kind + str(base.itemsize)))
+        output = np.empty(len(element), dtype=np.dtype(fields))
+        for field in output.dtype.names:
+            if field.endswith(COUNT_SUFFIX) and field not in element.dtype.names:
+                output[field] = output.dtype.fields[field[:-len(COUNT_SUFFIX)]][0].shape[0]
+            else:
+                output[field] = element[field]
+        outputs.append(output)
+    header.append('end_header')
+    with open(filename, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        for output in outputs:
+            output.tofile(f)
+
+
+def write_mesh(filename, vertices, faces, normals=None, colors=None, face_properties=None, comments=()):
+    """write a triangle mesh as binary ply
+
+    :param vertices: (N, 3) vertex positions, written as float
+    :param faces: (F, 3) vertex indices
+    :param normals: (N, 3) vertex normals
+    :param colors: (N, 3) uint8 vertex colors
+    :param face_properties: dict of name to (F,) per face values, e.g. objectId and partId
+    """
+    vertex_fields = [('x', '<f4'), ('y', '<f4'), ('z', '<f4')]
+    if normals is not None:
+        vertex_fields += [('nx', '<f4'), ('ny', '<f4'), ('nz', '<f4')]
+    if colors is not None:
+        vertex_fields += [('red', 'u1'), ('green', 'u1'), ('blue', 'u1')]
+    vertex = np.empty(len(vertices), dtype=vertex_fields)
+    for i, name in enumerate('xyz'):
+        vertex[name] = vertices[:, i]
+    if normals is not None:
+        for i, name in enumerate(('nx', 'ny', 'nz')):
+            vertex[name] = normals[:, i]
+    if colors is not None:
+        for i, name in enumerate(('red', 'green', 'blue')):
+            vertex[name] = colors[:, i]
+
+    face_properties = face_properties or {}
+    face_fields = [('vertex_indices', '<i4', (3,))]
+    face_fields += [(name, np.asarray(values).dtype.newbyteorder('<')) for name, values in face_properties.items()]
+    face = np.empty(len(faces), dtype=face_fields)
+    face['vertex_indices'] = faces
+    for name, values in face_properties.items():
+        face[name] = values
+    write_ply(filename, [('vertex', vertex), ('face', face)], comments=comments)
@@ -0,0 +1,186 @@
+import collections
+import logging
+import math
+import signal
+import threading
+
+from . import io
+from .io import NoDaemonPool
+
+log = logging.getLogger(__name__)
+
+GB = 1000 * 1000 * 1000
+
+
+def read_meminfo(path='/proc/meminfo'):
+    """read /proc/meminfo
+
+    :return: dict of field name to size in bytes
+    """
+    info = {}
+    with open(path, 'r') as f:
+        for line in f:
+            sline = line.split()
+            if len(sline) >= 2:
+                value = int(sline[1])
+                if len(sline) > 2 and sline[2] == 'kB':
+                    value *= 1024
+                info[sline[0].rstrip(':')] = value
+    return info
+
+
+def available_memory():
+    """memory available to new jobs without swapping, in bytes"""
+    info = read_meminfo()
+    if 'MemAvailable' in info:
+        return info['MemAvailable']
+    # kernels before 3.14 do not report MemAvailable
+    return info.get('MemFree', 0) + info.get('Buffers', 0) + info.get('Cached', 0)
+
+
+def total_memory():
+    return read_meminfo().get('MemTotal', 0)
+
+
+# signals of processes killed by the kernel OOM killer or aborting on a failed allocation (std::bad_alloc)
+OOM_SIGNALS = (signal.SIGKILL, signal.SIGABRT)
+
+
+def is_out_of_memory(result):
+    # io.call returns the negative signal number of a killed child
+    return isinstance(result, int) and -result in OOM_SIGNALS
+
+
+def is_oom_record(record):
+    """whether an io.call metrics record shows a command running out of memory
+
+    Commands are OOM-killed, abort on a failed allocation, or exit with an error after reporting
+    an allocation failure at their address space limit (e.g. MemoryError).
+    """
+    returncode = record.get('returncode')
+    return is_out_of_memory(returncode) or (returncode != 0 and record.get('out_of_memory', False))
+
+
+class Job:
+    def __init__(self, fn, args, kwargs, mem, name):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.mem = mem
+        self.name = name
+        self.attempt = 0
+        self.mem_limit = None
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MemoryAwarePool:
+    """process pool admitting jobs by their memory estimate
+
+    A job is started only when its estimated memory fits into the budget left by the running
+    jobs, where the budget is a fraction of the available memory (MemAvailable).
+    Jobs that do not fit wait in a queue instead of running into MemoryError. The first queued
+    job is always started when nothing else runs, so a single oversized job cannot block the queue.
+
+    A job that runs out of memory (raises MemoryError or runs out of memory as reported by is_oom)
+    is retried alone, with no other job running, at most max_retries times.
+    Jobs receive the address space limit of their commands in GB through the mem_limit keyword
+    when pass_limit is set. The limit is independent of the admission budget, since processes such
+    as CUDA and open3d reserve much more address space than they use. It is at least min_limit GB
+    (the io.call default) and grows by retry_factor with each retry.
+    """
+
+    def __init__(self, processes, fraction=0.8, max_retries=1, retry_factor=1.5, is_oom=is_out_of_memory,
+                 pass_limit=True, min_limit=None):
+        self.processes = processes
+        self.fraction = fraction
+        self.max_retries = max_retries
+        self.retry_factor = max(1.0, retry_factor)
+        self.min_limit = min_limit or io.get_call_memory_limit()
+        self.is_oom = is_oom
+        self.pass_limit = pass_limit
+        self._pool = NoDaemonPool(processes)
+        self._lock = threading.Lock()
+        self._queue = collections.deque()
+        self._running = []
+        self._exclusive = False
+        self._jobs = []
+        self._capacity = available_memory() * fraction
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, fn, *args, mem=0, name=None, **kwargs):
+        """queue fn(*args, **kwargs) with an estimated peak memory of mem bytes
+
+        :return: Job, wait on job.done for its result
+        """
+        job = Job(fn, args, kwargs, mem, name or getattr(fn, '__name__', 'job'))
+        with self._lock:
+            self._jobs.append(job)
+            self._queue.append(job)
+            self._schedule()
+        return job
+
+    def _budget(self):
+        # memory left for a new job, running jobs may not have reached their peak yet
+        reserved = sum(job.mem for job in self._running)
+        return min(self._capacity - reserved, available_memory() * self.fraction)
+
+    def _schedule(self):
+        # called with the lock held
+        while self._queue and len(self._running) < self.processes and not self._exclusive:
+            job = self._queue[0]
+            exclusive = job.attempt > 0
+            if self._running:
+                if exclusive or job.mem > self._budget():
+                    break
+            self._queue.popleft()
+            if job.mem_limit is None:
+                job.mem_limit = max(self.min_limit, int(math.ceil(job.mem / GB)))
+            self._exclusive = exclusive
+            self._running.append(job)
+            log.info(f'Start {job.name} (attempt {job.attempt + 1}), estimated memory {job.mem / GB:.1f} GB, '
+                     f'limit {job.mem_limit} GB')
+            kwargs = dict(job.kwargs)
+            if self.pass_limit:
+                kwargs['mem_limit'] = job.mem_limit
+            self._pool.apply_async(job.fn, job.args, kwargs,
+                                   callback=lambda result, job=job: self._finish(job, result, None),
+                                   error_callback=lambda error, job=job: self._finish(job, None, error))
+
+    def _finish(self, job, result, error):
+        with self._lock:
+            self._running.remove(job)
+            self._exclusive = False
+            oom = isinstance(error, MemoryError) or (error is None and self.is_oom(result))
+            if oom and job.attempt < self.max_retries:
+                job.attempt += 1
+                job.mem_limit = int(math.ceil(job.mem_limit * self.retry_factor))
+                log.warning(f'{job.name} ran out of memory, retry alone with memory limit {job.mem_limit} GB')
+                self._queue.appendleft(job)
+            else:
+                if oom:
+                    log.error(f'{job.name} ran out of memory after {job.attempt + 1} attempts')
+                job.result = result
+                job.error = error
+                job.done.set()
+            self._schedule()
+
+    def join(self):
+        """wait for all submitted jobs
+
+        :return: list of results in submission order, exceptions for failed jobs
+        """
+        for job in list(self._jobs):
+            job.done.wait()
+        return [job.error if job.error is not None else job.result for job in self._jobs]
+
+    def close(self):
+        self.join()
+        self._pool.close()
+        self._pool.join()
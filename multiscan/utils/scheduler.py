@@ -0,0 +1,125 @@
+import logging
+import os
+import threading
+import traceback
+
+from .pool import available_memory, GB
+
+log = logging.getLogger(__name__)
+
+
+class Node:
+    def __init__(self, name, fn, args, kwargs, inputs, outputs, after, cpus, mem, strict):
+        self.name = name
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)
+        self.cpus = cpus
+        self.mem = mem
+        self.strict = strict
+        self.deps = []
+        self.result = None
+        self.error = None
+
+
+class StageScheduler:
+    """run the steps of a dependency graph concurrently under cpu and memory budgets
+
+    A step depends on the earlier added steps producing one of its inputs and on the steps named
+    in its after list, so adding the steps in their sequential order gives an acyclic graph that
+    runs them in the same order when the budgets only admit one step at a time.
+    Ready steps start in the order they were added while their cores and estimated memory fit into
+    what the running steps leave, a step that does not fit alone runs when nothing else runs.
+    Steps depending on a step that raised are skipped. Return codes of steps do not stop dependents,
+    unless the dependent is strict and a step it depends on returned a non-zero return code.
+    """
+
+    def __init__(self, cpus=0, fraction=0.8):
+        """
+        :param cpus: number of cores shared by the steps, 0 for the cores available to the process
+        :param fraction: fraction of the available memory shared by the steps
+        """
+        self.cpus = cpus or len(os.sched_getaffinity(0))
+        self.capacity = available_memory() * fraction
+        self._nodes = []
+        self._cond = threading.Condition()
+
+    def add(self, name, fn, *args, inputs=(), outputs=(), after=(), cpus=1, mem=0, strict=False, **kwargs):
+        """add step name running fn(*args, **kwargs)
+
+        :param inputs: names of the files or artifacts the step reads
+        :param outputs: names of the files or artifacts the step writes
+        :param after: names of steps that must finish before the step, e.g. steps whose inputs it removes
+        :param cpus: number of cores the step uses
+        :param mem: estimated peak memory of the step in bytes
+        :param strict: skip the step when a step it depends on returned a non-zero return code
+        """
+        node = Node(name, fn, args, kwargs, inputs, outputs, after, max(1, cpus), mem, strict)
+        node.deps = [other for other in self._nodes
+                     if other.name in node.after or any(output in node.inputs for output in other.outputs)]
+        self._nodes.append(node)
+        return node
+
+    def _fits(self, node, running):
+        if not running:
+            return True
+        cpus = sum(other.cpus for other in running)
+        mem = sum(other.mem for other in running)
+        return cpus + node.cpus <= self.cpus and mem + node.mem <= min(self.capacity, available_memory())
+
+    def _run_node(self, node, running):
+        try:
+            node.result = node.fn(*node.args, **node.kwargs)
+        except Exception as e:
+            log.error(traceback.format_exc())
+            node.error = e
+        with self._cond:
+            running.remove(node)
+            self._cond.notify()
+
+    def run(self):
+        """run all steps and wait for them
+
+        :return: dict of step name to its return value, or exception for failed and skipped steps
+        """
+        pending = list(self._nodes)
+        running = []
+        threads = []
+        with self._cond:
+            while pending or running:
+                changed = True
+                while changed:
+                    changed = False
+                    finished = [node for node in self._nodes if node not in pending and node not in running]
+                    for node in list(pending):
+                        if any(dep not in finished for dep in node.deps):
+                            continue
+                        failed = [dep.name for dep in node.deps
+                                  if dep.error is not None or (node.strict and dep.result)]
+                        if failed:
+                            node.error = RuntimeError(f'skipped, {", ".join(failed)} failed')
+                            log.error(f'Skip {node.name}: {", ".join(failed)} failed')
+                        elif self._fits(node, running):
+                            log.info(f'Start {node.name}, {node.cpus} cores, '
+                                     f'estimated memory {node.mem / GB:.1f} GB')
+                            running.append(node)
+                            thread = threading.Thread(target=self._run_node, args=(node, running),
+                                                      name=node.name, daemon=True)
+                            threads.append(thread)
+                            thread.start()
+                        else:
+                            continue
+                        pending.remove(node)
+                        # skipped steps can resolve the dependencies of later steps
+                        changed = True
+                if running:
+                    self._cond.wait()
+                elif pending:
+                    raise RuntimeError('Steps with unresolvable dependencies: ' +
+                                       ', '.join(node.name for node in pending))
+        for thread in threads:
+            thread.join()
+        return {node.name: node.error if node.error is not None else node.result for node in self._nodes}
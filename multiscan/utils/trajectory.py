@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+CACHE_EXT = '.npz'
+CACHE_VERSION = 1
+
+# ARKit camera pose (+x along long axis of device toward home button, +y upwards, +z away from device)
+# to open3d camera pose (flip y and z)
+ARKIT_TO_OPEN3D = np.diag([1.0, -1.0, -1.0, 1.0])
+
+
+def cache_path(filename):
+    return filename + CACHE_EXT
+
+
+def _source_stamp(filename):
+    stat = os.stat(filename)
+    return np.array([CACHE_VERSION, stat.st_size, stat.st_mtime_ns], dtype='int64')
+
+
+def parse_trajectory(filename):
+    """parse a camera trajectory .jsonl file
+
+    :return: dict with ARKit camera poses 'transforms' (N, 4, 4) and 'intrinsics' (N, 3, 3),
+        intrinsics of frames without intrinsics are NaN
+    """
+    with open(filename, 'r') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    # a single json document is parsed much faster than one document per line
+    cameras = json.loads('[' + ','.join(lines) + ']')
+    num = len(cameras)
+    transforms = np.empty((num, 16), dtype=np.float64)
+    intrinsics = np.full((num, 9), np.nan, dtype=np.float64)
+    for i, cam_info in enumerate(cameras):
+        transform = cam_info.get('transform', None)
+        assert transform is not None, f'Camera {i} in {filename} has no transform'
+        transforms[i] = transform
+        K = cam_info.get('intrinsics', None)
+        if K is not None:
+            intrinsics[i] = K
+    # stored column major
+    return {
+        'transforms': transforms.reshape(num, 4, 4).transpose(0, 2, 1),
+        'intrinsics': intrinsics.reshape(num, 3, 3).transpose(0, 2, 1),
+    }
+
+
+def load_trajectory(filename, cache=True):
+    """camera trajectory of a .jsonl file, read from its .npz sidecar when it is up to date
+
+    :param cache: read and write the sidecar <filename>.npz, keyed by file size and mtime
+    :return: dict as returned by parse_trajectory
+    """
+    sidecar = cache_path(filename)
+    stamp = _source_stamp(filename)
+    if cache and os.path.isfile(sidecar):
+        try:
+            with np.load(sidecar) as data:
+                if np.array_equal(data['stamp'], stamp):
+                    return {'transforms': data['transforms'], 'intrinsics': data['intrinsics']}
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'Ignoring invalid trajectory cache {sidecar}: {e}')
+    trajectory = parse_trajectory(filename)
+    if cache:
+        tmp = sidecar + '.tmp%d' % os.getpid()
+        try:
+            with open(tmp, 'wb') as f:
+                np.savez(f, stamp=stamp, **trajectory)
+            os.replace(tmp, sidecar)
+        except OSError as e:
+            log.warning(f'Cannot save trajectory cache {sidecar}: {e}')
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    return trajectory
+
+
+def arkit_to_open3d(transforms):
+    """convert ARKit camera poses (N, 4, 4) to open3d camera to world poses"""
+    poses = np.matmul(transforms, ARKIT_TO_OPEN3D)
+    return poses / poses[:, 3:4, 3:4]
+
+
+def camera_poses(filename, cache=True):
+    """open3d camera to world poses (N, 4, 4) of a trajectory file"""
+    return arkit_to_open3d(load_trajectory(filename, cache)['transforms'])
+
+
+def camera_extrinsics(filename, cache=True):
+    """open3d world to camera extrinsics (N, 4, 4) of a trajectory file"""
+    return np.linalg.inv(camera_poses(filename, cache))
+
+
+def fill_intrinsics(intrinsics, default):
+    """replace missing (NaN) intrinsics with default intrinsics
+
+    :param intrinsics: (N, 3, 3) intrinsics
+    :param default: intrinsics stored column major as 9 values, e.g. from the scan metadata
+    """
+    intrinsics = intrinsics.copy()
+    missing = np.isnan(intrinsics).any(axis=(1, 2))
+    if missing.any():
+        intrinsics[missing] = np.asarray(default, dtype=np.float64).reshape(3, 3).transpose()
+    return intrinsics
+
+
+def select_keyframes(extrinsics, min_translation=0.0, min_rotation=0.0, max_gap=0):
+    """select frames where the camera moved enough since the last selected frame
+
+    The first frame is always selected, a frame is selected when the camera center moved more
+    than min_translation or the camera rotated more than min_rotation since the last selected frame.
+
+    :param extrinsics: (N, 4, 4) world to camera transforms of the candidate frames
+    :param min_translation: minimum camera translation
+    :param min_rotation: minimum camera rotation in degrees
+    :param max_gap: select a frame anyway when max_gap candidates were skipped, 0 for no limit
+    :return: positions of the selected frames in extrinsics
+    """
+    extrinsics = np.asarray(extrinsics, dtype=np.float64)
+    if len(extrinsics) == 0:
+        return np.empty(0, dtype=np.int64)
+    rotations = extrinsics[:, :3, :3]
+    # camera centers in world coordinates
+    centers = -np.einsum('nji,nj->ni', rotations, extrinsics[:, :3, 3])
+    # the rotation angle theta of R_a R_b^T satisfies trace = 1 + 2 cos(theta)
+    min_trace = 1.0 + 2.0 * np.cos(np.deg2rad(min_rotation))
+    min_sq_translation = min_translation * min_translation
+
+    selected = [0]
+    last = 0
+    for i in range(1, len(extrinsics)):
+        if max_gap > 0 and i - last > max_gap:
+            moved = True
+        else:
+            offset = centers[i] - centers[last]
+            moved = offset.dot(offset) > min_sq_translation or \
+                np.einsum('ij,ij->', rotations[i], rotations[last]) < min_trace
+        if moved:
+            selected.append(i)
+            last = i
+    return np.asarray(selected, dtype=np.int64)
+
+
+def frustum_blocks(extrinsics, intrinsics, width, height, depth_min, depth_max, block_size, chunk_size=64):
+    """voxel blocks within the view frustums of the cameras
+
+    The frustums are sampled at half the block size, the blocks hit approximate the blocks a TSDF
+    integration of the frames can allocate. Blocks only clipped at a frustum edge may be missed.
+
+    :param extrinsics: (N, 4, 4) world to camera transforms
+    :param intrinsics: (N, 3, 3) intrinsics at the resolution width x height
+    :param depth_min: minimum depth of the frustums
+    :param depth_max: maximum depth of the frustums
+    :param block_size: edge length of a voxel block
+    :return: (M, 3) integer coordinates of the blocks
+    """
+    extrinsics = np.asarray(extrinsics, dtype=np.float64)
+    intrinsics = np.asarray(intrinsics, dtype=np.float64)
+    if len(extrinsics) == 0:
+        return np.empty((0, 3), dtype=np.int64)
+    # sample the far plane at least twice per block
+    focal = np.min(intrinsics[:, [0, 1], [0, 1]])
+    num_u = int(np.ceil(2 * depth_max * width / focal / block_size)) + 1
+    num_v = int(np.ceil(2 * depth_max * height / focal / block_size)) + 1
+    u, v = np.meshgrid(np.linspace(0, width, num_u), np.linspace(0, height, num_v))
+    pixels = np.stack([u.ravel(), v.ravel(), np.ones(u.size)])
+    depths = np.arange(depth_min, depth_max + block_size / 2, block_size / 2)
+
+    poses = np.linalg.inv(extrinsics)
+    blocks = []
+    for start in range(0, len(extrinsics), chunk_size):
+        stop = start + chunk_size
+        # rays at unit depth, (n, 3, P)
+        rays = np.matmul(np.linalg.inv(intrinsics[start:stop]), pixels)
+        # world points, (n, 3, P * D)
+        points = (rays[..., None] * depths).reshape(len(rays), 3, -1)
+        points = np.matmul(poses[start:stop, :3, :3], points) + poses[start:stop, :3, 3:]
+        keys = np.floor(points.transpose(0, 2, 1).reshape(-1, 3) / block_size).astype(np.int64)
+        blocks.append(np.unique(keys, axis=0))
+    return np.unique(np.concatenate(blocks), axis=0)
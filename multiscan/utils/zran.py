@@ -0,0 +1,365 @@
+"""random access to raw deflate streams
+
+Builds an index of inflate checkpoints in the manner of zlib's examples/zran.c: at deflate block
+boundaries, roughly every span bytes of output, the input offset, the bit offset into the input
+byte and the last 32K of output (the window) are recorded. Inflation can then be resumed from any
+checkpoint, so a frame in the middle of a depth or confidence stream is decoded without inflating
+the stream from the start. The index is stored as a sidecar next to the stream (<stream>.zidx)
+and rebuilt when the stream changes.
+
+Python's zlib module cannot stop at block boundaries or prime bits, libz is used through ctypes.
+"""
+import ctypes
+import ctypes.util
+import logging
+import os
+import zlib
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+WINSIZE = 32768
+CHUNK = 1 << 16
+INDEX_EXT = '.zidx'
+INDEX_VERSION = 1
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_NEED_DICT = 2
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p),
+        ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p),
+        ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p),
+        ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p),
+        ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int),
+        ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+_libz = None
+
+
+def _zlib():
+    global _libz
+    if _libz is None:
+        lib = ctypes.CDLL(ctypes.util.find_library('z') or 'libz.so.1')
+        stream_p = ctypes.POINTER(_ZStream)
+        lib.zlibVersion.restype = ctypes.c_char_p
+        lib.inflateInit2_.argtypes = [stream_p, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        lib.inflate.argtypes = [stream_p, ctypes.c_int]
+        lib.inflateEnd.argtypes = [stream_p]
+        lib.inflatePrime.argtypes = [stream_p, ctypes.c_int, ctypes.c_int]
+        lib.inflateSetDictionary.argtypes = [stream_p, ctypes.c_void_p, ctypes.c_uint]
+        _libz = lib
+    return _libz
+
+
+def available():
+    """whether libz can be loaded for random access"""
+    try:
+        _zlib()
+        return True
+    except OSError:
+        return False
+
+
+class _Inflater:
+    """raw inflate stream reading its input from a file"""
+
+    def __init__(self, file):
+        self.lib = _zlib()
+        self.strm = _ZStream()
+        ret = self.lib.inflateInit2_(ctypes.byref(self.strm), -zlib.MAX_WBITS, self.lib.zlibVersion(),
+                                     ctypes.sizeof(_ZStream))
+        if ret != Z_OK:
+            raise zlib.error(f'inflateInit2 failed with {ret}')
+        self.file = file
+        self.input = ctypes.create_string_buffer(CHUNK)
+        self.eof = False
+        self.finished = False
+
+    def fill(self):
+        if self.strm.avail_in == 0 and not self.eof:
+            n = self.file.readinto(self.input)
+            if not n:
+                self.eof = True
+                n = 0
+            self.strm.next_in = ctypes.addressof(self.input)
+            self.strm.avail_in = n
+
+    def prime(self, bits, value):
+        self.lib.inflatePrime(ctypes.byref(self.strm), bits, value)
+
+    def set_dictionary(self, window):
+        window = np.ascontiguousarray(window, dtype='uint8')
+        ret = self.lib.inflateSetDictionary(ctypes.byref(self.strm), window.ctypes.data, window.size)
+        if ret != Z_OK:
+            raise zlib.error(f'inflateSetDictionary failed with {ret}')
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """single inflate call, refilling the input first
+
+        :return: zlib return code, number of input bytes consumed, number of output bytes produced
+        """
+        self.fill()
+        avail_in = self.strm.avail_in
+        avail_out = self.strm.avail_out
+        ret = self.lib.inflate(ctypes.byref(self.strm), flush)
+        if ret == Z_STREAM_END:
+            self.finished = True
+        elif ret not in (Z_OK, Z_BUF_ERROR):
+            msg = self.strm.msg.decode() if self.strm.msg else ret
+            raise zlib.error(f'Error while inflating {getattr(self.file, "name", "stream")}: {msg}')
+        return ret, avail_in - self.strm.avail_in, avail_out - self.strm.avail_out
+
+    def read_into(self, out):
+        """inflate into the contiguous uint8 array out
+
+        :return: number of bytes written, less than out.size at the end of the stream
+        """
+        self.strm.next_out = out.ctypes.data
+        self.strm.avail_out = out.size
+        while self.strm.avail_out > 0 and not self.finished:
+            _, consumed, produced = self.inflate()
+            if not consumed and not produced and self.eof:
+                # truncated stream
+                break
+        return out.size - self.strm.avail_out
+
+    def close(self):
+        if self.strm is not None:
+            self.lib.inflateEnd(ctypes.byref(self.strm))
+            self.strm = None
+
+
+def build_index(path, span):
+    """build the checkpoint index of a raw deflate stream
+
+    :param path: raw deflate stream
+    :param span: minimum distance of checkpoints in bytes of output
+    :return: dict of numpy arrays, out and inp offsets, bits and windows of the checkpoints
+    """
+    outs, inps, bits, windows = [], [], [], []
+    window = np.zeros(WINSIZE, dtype='uint8')
+    totin = totout = last = 0
+    with open(path, 'rb') as f:
+        inflater = _Inflater(f)
+        try:
+            strm = inflater.strm
+            while not inflater.finished:
+                if strm.avail_out == 0:
+                    strm.next_out = window.ctypes.data
+                    strm.avail_out = WINSIZE
+                _, consumed, produced = inflater.inflate(Z_BLOCK)
+                totin += consumed
+                totout += produced
+                if inflater.finished:
+                    break
+                if not consumed and not produced and inflater.eof:
+                    log.warning(f'{path} is truncated, indexed the first {totout} bytes')
+                    break
+                # checkpoint at the end of a block, which is not the last block
+                if strm.data_type & 128 and not strm.data_type & 64 and (totout == 0 or totout - last > span):
+                    left = strm.avail_out
+                    outs.append(totout)
+                    inps.append(totin)
+                    bits.append(strm.data_type & 7)
+                    windows.append(np.concatenate([window[WINSIZE - left:], window[:WINSIZE - left]]))
+                    last = totout
+        finally:
+            inflater.close()
+    return {
+        'out': np.asarray(outs, dtype='int64'),
+        'inp': np.asarray(inps, dtype='int64'),
+        'bits': np.asarray(bits, dtype='uint8'),
+        'windows': np.stack(windows) if windows else np.zeros((0, WINSIZE), dtype='uint8'),
+        'total_out': np.int64(totout),
+        'span': np.int64(span),
+    }
+
+
+def index_path(path):
+    return path + INDEX_EXT
+
+
+def _source_stamp(path):
+    stat = os.stat(path)
+    return np.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype='int64')
+
+
+def load_index(path, span, rebuild=False):
+    """checkpoint index of a raw deflate stream, read from its sidecar or built and saved
+
+    The sidecar is reused when it was built from the same stream (size and mtime) with a span
+    not larger than requested.
+    """
+    sidecar = index_path(path)
+    stamp = _source_stamp(path)
+    if not rebuild and os.path.isfile(sidecar):
+        try:
+            with np.load(sidecar) as data:
+                if np.array_equal(data['stamp'], stamp) and data['span'] <= span:
+                    return {key: data[key] for key in data.files}
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'Ignoring invalid stream index {sidecar}: {e}')
+    index = build_index(path, span)
+    index['stamp'] = stamp
+    tmp = sidecar + '.tmp%d' % os.getpid()
+    try:
+        with open(tmp, 'wb') as f:
+            np.savez(f, **index)
+        os.replace(tmp, sidecar)
+    except OSError as e:
+        log.warning(f'Cannot save stream index {sidecar}: {e}')
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    return index
+
+
+class ZranStream:
+    """random access reader of a raw deflate stream
+
+    Consecutive reads continue inflating from the end of the previous read, other reads resume
+    from the closest checkpoint before the requested offset.
+    """
+
+    def __init__(self, path, span=1 << 22, index=None):
+        self.path = path
+        self.span = span
+        self.index = index if index is not None else load_index(path, span)
+        self.size = int(self.index['total_out'])
+        self._file = None
+        self._inflater = None
+        self._pos = 0
+
+    def __getstate__(self):
+        return {'path': self.path, 'span': self.span}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['span'])
+
+    def _seek(self, offset):
+        point = int(np.searchsorted(self.index['out'], offset, side='right')) - 1
+        if self._inflater is not None and self._pos <= offset and (point < 0 or self.index['out'][point] <= self._pos):
+            # continuing is not farther than the closest checkpoint
+            return
+        self.close()
+        self._file = open(self.path, 'rb')
+        self._inflater = _Inflater(self._file)
+        self._pos = 0
+        if point < 0:
+            return
+        bits = int(self.index['bits'][point])
+        inp = int(self.index['inp'][point])
+        self._file.seek(inp - (1 if bits else 0))
+        if bits:
+            value = self._file.read(1)[0]
+            self._inflater.prime(bits, value >> (8 - bits))
+        if self.index['out'][point] > 0:
+            self._inflater.set_dictionary(self.index['windows'][point])
+        self._pos = int(self.index['out'][point])
+
+    def read(self, offset, size):
+        """inflated bytes [offset, offset + size) as uint8 array, shorter at the end of the stream"""
+        size = max(0, min(size, self.size - offset))
+        out = np.empty(size, dtype='uint8')
+        if size == 0:
+            return out
+        self._seek(offset)
+        skip = offset - self._pos
+        if skip > 0:
+            scratch = np.empty(min(skip, CHUNK * 16), dtype='uint8')
+            while skip > 0:
+                n = self._inflater.read_into(scratch[:min(skip, scratch.size)])
+                if n == 0:
+                    break
+                skip -= n
+                self._pos += n
+        n = self._inflater.read_into(out)
+        self._pos += n
+        return out[:n]
+
+    def close(self):
+        if self._inflater is not None:
+            self._inflater.close()
+            self._inflater = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ZranFrames:
+    """frames of equal size in a raw deflate stream, indexed like a (N, H, W) array
+
+    Supports integers, slices and integer arrays as keys, the frames covered by a key are
+    inflated in a single pass.
+    """
+
+    def __init__(self, path, shape, dtype, checkpoint_frames=16):
+        self.path = path
+        self.frame_shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.checkpoint_frames = checkpoint_frames
+        self.frame_size = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        self.stream = ZranStream(path, span=self.frame_size * checkpoint_frames)
+
+    def __getstate__(self):
+        return {'path': self.path, 'shape': self.frame_shape, 'dtype': self.dtype.str,
+                'checkpoint_frames': self.checkpoint_frames}
+
+    def __setstate__(self, state):
+        self.__init__(state['path'], state['shape'], state['dtype'], state['checkpoint_frames'])
+
+    def __len__(self):
+        return self.stream.size // self.frame_size
+
+    @property
+    def shape(self):
+        return (len(self),) + self.frame_shape
+
+    def read(self, start, count):
+        """frames [start, start + count) as (count, H, W) array"""
+        data = self.stream.read(start * self.frame_size, count * self.frame_size)
+        count = data.size // self.frame_size
+        return data[:count * self.frame_size].view(self.dtype).reshape((count,) + self.frame_shape)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            frames = range(*key.indices(len(self)))
+            if not len(frames):
+                return np.empty((0,) + self.frame_shape, dtype=self.dtype)
+            lo, hi = min(frames[0], frames[-1]), max(frames[0], frames[-1])
+            return self.read(lo, hi - lo + 1)[frames[0] - lo::frames.step]
+        if np.ndim(key) == 0:
+            key = int(key)
+            if key < 0:
+                key += len(self)
+            if not 0 <= key < len(self):
+                raise IndexError(f'frame {key} out of range')
+            return self.read(key, 1)[0]
+        key = np.asarray(key, dtype='int64')
+        key = np.where(key < 0, key + len(self), key)
+        if key.size == 0:
+            return np.empty((0,) + self.frame_shape, dtype=self.dtype)
+        lo, hi = int(key.min()), int(key.max())
+        if lo < 0 or hi >= len(self):
+            raise IndexError('frame index out of range')
+        return self.read(lo, hi - lo + 1)[key - lo]
+
+    def close(self):
+        self.stream.close()
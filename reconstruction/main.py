@@ -1,4 +1,5 @@
 import os
+import sys
 import psutil
 import hydra
 import logging
@@ -7,7 +8,9 @@ from hydra.utils import get_original_cwd
 from omegaconf import DictConfig
 
 from reconstruction.scripts.reconstruct import Reconstruct
-from reconstruction.scripts.bridge import Bridge, File
+from reconstruction.scripts.bridge import Bridge
+
+from multiscan.utils import cores
 
 log = logging.getLogger('reconstruct')
 
@@ -25,43 +28,43 @@ def main_from_cfg(cfg : DictConfig):
     log.info(f'Output decimated mesh will be saved to {cfg.output.decimated_mesh_filename}')
     log.info(f'Output mesh coordinate alignment file will be saved to {cfg.output.mesh_alignment_filename}')
 
-    # set number of cpus to use
+    # set number of cpus to use, cores reserved by the calling process are reused,
+    # otherwise cores not used by other concurrent jobs are reserved
     pid = os.getpid()
     p = psutil.Process(pid)
-    cpu_num = min(len(p.cpu_affinity()), cfg.settings.cpu_num)
-    p.cpu_affinity(p.cpu_affinity()[0:cpu_num])
-
-    log.info(f'{cpu_num} CPUs will be used in reconstruction')
+    affinity = p.cpu_affinity()
+    with cores.reserve(cfg.settings.cpu_num, tag='recons') as cpus:
+        cpus = [c for c in cpus if c in affinity] or affinity[0:cfg.settings.cpu_num]
+        p.cpu_affinity(cpus)
+        cpu_num = len(cpus)
 
-    try:
-        if cfg.settings.with_camera_poses:
-            log.info('Start reconstruction with known camera poses')
-            bridge = Bridge(cfg)
-            if os.path.isdir(cfg.input.depth_stream):
-                log.info('Reconstruction with decoded images')
-                bridge.open_file(cfg.input.metadata_file, File.META)
-                bridge.open_file(cfg.input.trajectory_file, File.POSE)
-            else:
-                log.info('Reconstruction with compressed streams')
-                bridge.open_all()
-            bridge.read_metadata()
-        
-            recon = Reconstruct(cfg, bridge)
-            recon.run()
+        log.info(f'{cpu_num} CPUs will be used in reconstruction')
 
-            bridge.close_all()
-        else:
-            log.info('Start multiway registration reconstruction')
-            recon = Reconstruct(cfg)
-            recon.run()
-    except ValueError as e:
-        raise e
-    except IOError as e:
-        raise e
+        try:
+            if cfg.settings.with_camera_poses:
+                log.info('Start reconstruction with known camera poses')
+                bridge = Bridge(cfg)
+                if os.path.isdir(cfg.input.depth_stream):
+                    log.info('Reconstruction with decoded images')
+                else:
+                    log.info('Reconstruction with compressed streams')
+                bridge.open_inputs()
+            
+                recon = Reconstruct(cfg, bridge)
+                recon.run()
 
-    # reset affinity against all cpus
-    all_cpus = list(range(psutil.cpu_count()))
-    p.cpu_affinity(all_cpus)
+                bridge.close_all()
+            else:
+                log.info('Start multiway registration reconstruction')
+                recon = Reconstruct(cfg)
+                recon.run()
+        except ValueError as e:
+            raise e
+        except IOError as e:
+            raise e
+        finally:
+            # reset affinity to the cpus available before reconstruction
+            p.cpu_affinity(affinity)
 
 
 @hydra.main(config_path="../config", config_name="config")
@@ -89,4 +92,7 @@ def main(cfg : DictConfig) -> None:
     main_from_cfg(cfg)
 
 if __name__ == '__main__':
+    # --resume continues an interrupted integration from its last checkpoint
+    if '--resume' in sys.argv:
+        sys.argv = [arg for arg in sys.argv if arg != '--resume'] + ['reconstruction.settings.resume=true']
     main()
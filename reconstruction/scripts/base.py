@@ -6,6 +6,7 @@ from collections import namedtuple
 import logging
 
 from multiscan.utils import io
+from multiscan.utils.framestore import FrameStore, find_store
 
 FrameFiles = namedtuple('Frames', 'colors depths num')
 
@@ -42,14 +43,18 @@ class ReconBase:
     def read_images(self):
         """read input RGB and depth images
 
-        :return: FrameFiles('colors depths num')
+        :return: FrameFiles('colors depths num'), depths is a FrameStore if the depth frames are in a frame store
         """
         try:
             color_folder = self.config.input.color_stream
             depth_folder = self.config.input.depth_stream
             depth_files = []
             color_files = []
-            if os.path.isdir(depth_folder):
+            depth_store = find_store(depth_folder)
+            if depth_store:
+                # depth frames decoded into a single frame store
+                depth_files = FrameStore(depth_store)
+            elif os.path.isdir(depth_folder):
                 depth_files = io.get_file_list(depth_folder, ext='.png')
             if os.path.isdir(color_folder) and self.config.alg_param.integration.with_color:
                 color_files = io.get_file_list(color_folder, ext='.png')
@@ -9,10 +9,15 @@ from decord import VideoReader
 from decord import cpu
 
 from multiscan.utils import io
-from reconstruction.scripts.utils import decompress
+from multiscan.utils import trajectory
+from multiscan.utils import zran
+from reconstruction.scripts.utils import decompress, resize_nearest
 
 log = logging.getLogger('reconstruct')
 
+# forward gaps of opencv color reads decoded sequentially instead of seeking to a keyframe
+MAX_SEQUENTIAL_SKIP = 60
+
 class File(Enum):
     META = 0
     COLOR = 1
@@ -21,14 +26,69 @@ class File(Enum):
     CONFIDENCE = 4
 
 
+class FrameCache:
+    """ring buffer of the most recently read frames of a frame stack, keyed by frame index
+
+    misses counts the frames read from the stack, hits the lookups served from the buffer.
+    """
+
+    def __init__(self, frames, size=4):
+        self.frames = frames
+        self.buffer = np.empty((max(size, 2),) + frames.shape[1:], dtype=frames.dtype)
+        self.slots = {}
+        self.next = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, idx):
+        return idx in self.slots
+
+    def _store(self, idx, frame):
+        slot = self.next
+        self.next = (self.next + 1) % len(self.buffer)
+        # evict the frame previously held by the slot
+        for key in [key for key, value in self.slots.items() if value == slot]:
+            del self.slots[key]
+        self.buffer[slot] = frame
+        self.slots[idx] = slot
+
+    def load(self, start, count):
+        """read count consecutive frames in a single access"""
+        frames = self.frames[start:start + count]
+        for i, frame in enumerate(frames):
+            if start + i not in self.slots:
+                self.misses += 1
+                self._store(start + i, frame)
+
+    def get(self, idx):
+        if idx in self.slots:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._store(idx, self.frames[idx])
+        return self.buffer[self.slots[idx]]
+
+
 class Bridge:
     def __init__(self, config):
         self.config = config
         self.meta_file = None
+        self.color_stream = None
         self.color_cap = None
+        # size color frames are decoded at, next frame of the opencv capture
+        self.color_size = None
+        self._color_pos = 0
         self.depth_file = None
         self.confidence_file = None
-        self.pose_file = None
+        self.pose_path = None
+        # compressed streams read on demand through a checkpoint index
+        self.depth_stream = None
+        self.confidence_stream = None
+        self.depth_frames = None
+        self.confidence_frames = None
+        self.depth_cache = None
+        # preallocated buffers of filtered_depthframe
+        self._filter_buffers = None
 
         self.meta = {}
         self.extrinsics = []
@@ -50,16 +110,21 @@ class Bridge:
         if self.color_cap:
             if self.config.alg_param.frames.use_opencv:
                 self.color_cap.release()
-            else:
-                del self.color_cap
+            self.color_cap = None
+        if self.depth_cache:
+            log.info(f'Depth frame cache: {self.depth_cache.hits} hits, {self.depth_cache.misses} misses')
+            self.depth_cache = None
+        for frames in (self.depth_frames, self.confidence_frames):
+            if isinstance(frames, zran.ZranFrames):
+                frames.close()
+        self.depth_frames = None
+        self.confidence_frames = None
         if self.depth_file:
             os.unlink(self.depth_file.name)
         if self.confidence_file:
             os.unlink(self.confidence_file.name)
         if self.meta_file:
             self.meta_file.close()
-        if self.pose_file:
-            self.pose_file.close()
 
     def open_file(self, path, type=File.COLOR):
         options = {
@@ -73,31 +138,58 @@ class Bridge:
         options[type](path)
 
     def _open_colorfile(self, path):
+        # the decoder is created once the depth resolution is known, see open_color
         if io.file_exist(path, '.mp4'):
-            if self.config.alg_param.frames.use_opencv:
-                self.color_cap = cv2.VideoCapture(path)
-            else:
-                self.color_cap = VideoReader(path, ctx=cpu(0))
+            self.color_stream = path
         else:
             raise f'Color stream {path} does not exist'
 
+    def open_color(self):
+        """open the color decoder and reconcile the number of color frames with the metadata
+
+        With alg_param.frames.color_at_depth_resolution, color frames are returned at the
+        depth resolution, so they need no resizing before integration. They are sampled like
+        the nearest neighbour resize of align_color2depth, which gives the same frames.
+        """
+        if self.color_cap is not None or self.color_stream is None:
+            return
+        if self.config.alg_param.frames.get('color_at_depth_resolution', True) and 'depth_width' in self.meta:
+            self.color_size = (self.meta['depth_width'], self.meta['depth_height'])
+        if self.config.alg_param.frames.use_opencv:
+            self.color_cap = cv2.VideoCapture(self.color_stream)
+            self._color_pos = 0
+            num_frames = int(self.color_cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        else:
+            self.color_cap = VideoReader(self.color_stream, ctx=cpu(0))
+            num_frames = len(self.color_cap)
+        if 'num_frames' in self.meta and num_frames != self.meta['num_frames']:
+            logging.warning(f"color frames number not match in video and meta, "
+                            f"{num_frames} in video, {self.meta['num_frames']} in metadata")
+            self.meta['num_frames'] = min(self.meta['num_frames'], num_frames)
+
     def _open_depthfile(self, path):
         filename = os.path.basename(path)
         if io.file_exist(path, '.zlib') and os.path.splitext(filename)[0].split('.')[1] == 'depth':
-            self.depth_file = decompress(path)
+            if self.random_access():
+                self.depth_stream = path
+            else:
+                self.depth_file = decompress(path)
         else:
             raise f'Depth stream {path} does not exist'
 
     def _open_confidencefile(self, path):
         filename = os.path.basename(path)
         if io.file_exist(path, '.zlib') and os.path.splitext(filename)[0].split('.')[1] == 'confidence':
-            self.confidence_file = decompress(path)
+            if self.random_access():
+                self.confidence_stream = path
+            else:
+                self.confidence_file = decompress(path)
         else:
             raise f'Confidence stream {path} does not exist'
 
     def _open_posefile(self, path):
         if io.file_exist(path, '.jsonl'):
-            self.pose_file = open(path, 'r')
+            self.pose_path = path
         else:
             raise f'Camera trajectory file {path} does not exist'
 
@@ -107,122 +199,190 @@ class Bridge:
         else:
             raise f'Meta file {path} does not exist'
 
+    def random_access(self):
+        return self.config.alg_param.frames.get('random_access', False) and zran.available()
+
+    def _stream_frames(self, path, dtype):
+        return zran.ZranFrames(path, (self.meta['depth_height'], self.meta['depth_width']), dtype,
+                               self.config.alg_param.frames.get('checkpoint_frames', 16))
+
+    def _map_frames(self, path, dtype):
+        # whole decompressed stream as a (N, H, W) array, trailing partial frames are ignored
+        height = self.meta['depth_height']
+        width = self.meta['depth_width']
+        num_frames = os.stat(path).st_size // (height * width * np.dtype(dtype).itemsize)
+        if num_frames == 0:
+            return np.zeros((0, height, width), dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(num_frames, height, width))
+
+    def open_frames(self):
+        """map depth and confidence frames once and reconcile the number of frames with the metadata"""
+        if self.meta['depth_format'] == 'm':
+            depth_type = 'float16'
+        elif self.meta['depth_format'] == 'mm':
+            depth_type = 'uint16'
+        else:
+            raise ValueError(f"Unsupported depth unit {self.meta['depth_format']}")
+
+        if self.depth_file:
+            self.depth_frames = self._map_frames(self.depth_file.name, depth_type)
+        elif self.depth_stream:
+            self.depth_frames = self._stream_frames(self.depth_stream, depth_type)
+        if self.confidence_file:
+            self.confidence_frames = self._map_frames(self.confidence_file.name, 'uint8')
+        elif self.confidence_stream:
+            self.confidence_frames = self._stream_frames(self.confidence_stream, 'uint8')
+
+        if self.depth_frames is not None:
+            self.depth_cache = FrameCache(self.depth_frames, self.config.alg_param.frames.get('cache_size', 4))
+
+        for name, frames in (('depth', self.depth_frames), ('confidence', self.confidence_frames)):
+            if frames is None:
+                continue
+            num_frames = len(frames)
+            if num_frames != self.meta.get('num_frames', 0):
+                logging.warning(f"{name} frames number not match in .zlib and meta, "
+                                f"{num_frames} in .zlib, {self.meta.get('num_frames', 0)} in metadata")
+                self.meta['num_frames'] = min(self.meta.get('num_frames', 0), num_frames)
+
+    def open_inputs(self):
+        """open the decoded images or compressed streams of the input and read the metadata"""
+        if os.path.isdir(self.config.input.depth_stream):
+            self.open_file(self.config.input.metadata_file, File.META)
+            self.open_file(self.config.input.trajectory_file, File.POSE)
+        else:
+            self.open_all()
+        self.read_metadata()
+
     def read_metadata(self):
         if self.meta_file != None:
             self.get_meta()
+            self.open_frames()
+            # color frames only limit the number of frames when they are integrated
+            if self.config.alg_param.integration.with_color:
+                self.open_color()
 
     def cap_colorframe(self, idx=0):
-        if self.config.alg_param.frames.use_opencv:
-            num_frames = self.color_cap.get(cv2.CAP_PROP_FRAME_COUNT)
-        else:
-            num_frames = len(self.color_cap)
-        if num_frames != self.meta.get('num_frames', 0):
-            logging.warning(f"color frames number not match in cv2 and meta, \
-                     {num_frames} in .zlib, {self.meta.get('num_frames', 0)} in metadata")
-            num_frames = min(self.meta.get('num_frames', 0), num_frames)
-
-        self.meta['num_frames'] = num_frames
+        """decode a color frame as RGB, None for indices out of range
 
+        OpenCV reads continue from the previous frame when possible instead of seeking.
+        """
+        self.open_color()
+        if not 0 <= idx < self.meta.get('num_frames', 0):
+            return None
         if self.config.alg_param.frames.use_opencv:
-            if idx >= 0 and idx < num_frames:
+            if not self._color_pos <= idx <= self._color_pos + MAX_SEQUENTIAL_SKIP:
                 self.color_cap.set(cv2.CAP_PROP_POS_FRAMES, idx)
-                success, frame = self.color_cap.read()
+                self._color_pos = idx
+            while self._color_pos < idx:
+                self.color_cap.grab()
+                self._color_pos += 1
+            success, frame = self.color_cap.read()
+            self._color_pos += 1
             if success:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                return frame
+                return self._convert_colorframe(frame)
         else:
-            if idx >= 0 and idx < num_frames:
-                frame = self.color_cap[idx].asnumpy()
-                return frame
+            return self._resize_colorframes(self.color_cap[idx].asnumpy())
+
+    def _resize_colorframes(self, frames):
+        # frames (H, W, 3) or (N, H, W, 3) at the video resolution
+        if self.color_size and frames.shape[-3:-1] != self.color_size[::-1]:
+            frames = resize_nearest(frames, self.color_size)
+        return frames
+
+    def _convert_colorframe(self, frame):
+        # opencv frames are BGR at the video resolution
+        return self._resize_colorframes(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+
+    def iter_colorframes(self, indices):
+        """decode the color frames of a list of increasing indices
 
-    def filtered_depthframe(self, idx=0, level=2, delta_thresh=0.05):
+        decord decodes the frames in batches of alg_param.frames.color_batch_size with get_batch,
+        opencv decodes them sequentially.
+
+        :return: generator of RGB frames in the order of indices, None for indices out of range
+        """
+        self.open_color()
+        num_frames = self.meta.get('num_frames', 0)
+        if self.config.alg_param.frames.use_opencv:
+            for idx in indices:
+                yield self.cap_colorframe(idx)
+            return
+        batch_size = self.config.alg_param.frames.get('color_batch_size', 32)
+        for start in range(0, len(indices), batch_size):
+            batch = list(indices[start:start + batch_size])
+            valid = [idx for idx in batch if 0 <= idx < num_frames]
+            frames = iter(self._resize_colorframes(self.color_cap.get_batch(valid).asnumpy()) if valid else [])
+            for idx in batch:
+                yield next(frames) if 0 <= idx < num_frames else None
+
+    def filtered_depthframe(self, idx=0, level=2, delta_thresh=0.05, out=None):
+        """depth frame filtered by the depth difference to the previous frame and by confidence
+
+        Raw frames come from a small cache, so the previous frame read for the delta filter is
+        usually the frame read by the previous call. With a frame step, only the frame and its
+        predecessor are read.
+
+        :param out: optional float32 array receiving the frame, a new array is returned otherwise
+        :return: float32 depth frame
+        """
         if self.meta['depth_format'] == 'mm':
             delta_thresh *= 1000
 
-        fp = self.raw_depthframe(idx)
+        num_frames = self.meta['num_frames']
+        idx = min(max(idx, 0), num_frames - 1)
+        last_idx = max(idx - 1, 0)
+        cache = self.depth_cache
+        if delta_thresh > 0 and idx not in cache and last_idx not in cache:
+            # read both frames in a single pass
+            cache.load(last_idx, idx - last_idx + 1)
+
+        if self._filter_buffers is None:
+            shape = self.depth_frames.shape[1:]
+            self._filter_buffers = (np.empty(shape, dtype=self.depth_frames.dtype),
+                                    np.empty(shape, dtype=self.depth_frames.dtype),
+                                    np.empty(shape, dtype=bool))
+        fp, delta, mask = self._filter_buffers
+        np.copyto(fp, cache.get(idx))
         if delta_thresh > 0:
-            fp_last = self.raw_depthframe(idx - 1)
-            delta = np.abs(fp_last - fp)
-            fp[delta > delta_thresh] = 0
+            np.subtract(cache.get(last_idx), fp, out=delta)
+            np.abs(delta, out=delta)
+            np.greater(delta, delta_thresh, out=mask)
+            np.putmask(fp, mask, 0)
 
-        if level >= 0 and self.confidence_file != None:
+        if level >= 0 and self.confidence_frames is not None:
             fp_confidence = self.raw_confidenceframe(idx)
-            fp[fp_confidence < level] = 0
-            
-        return np.array(fp).astype(np.float32)
-
-    def raw_depthframe(self, idx=0):
-        file_size = os.stat(self.depth_file.name).st_size
-        frame_size = self.meta['depth_width'] * self.meta['depth_height'] * self.config.alg_param.frames.depth_pixel_size
-        num_frames = int(file_size / frame_size)
-        if num_frames != self.meta.get('num_frames', 0):
-            logging.warning(f"depth frames number not match in .zlib and meta, \
-                     {num_frames} in .zlib, {self.meta.get('num_frames', 0)} in metadata")
-            num_frames = min(self.meta.get('num_frames', 0), num_frames)
-
-        self.meta['num_frames'] = num_frames
-
-        height = self.meta['depth_height']
-        width = self.meta['depth_width']
+            np.less(fp_confidence, level, out=mask)
+            np.putmask(fp, mask, 0)
 
-        if self.meta['depth_format'] == 'm':
-            depth_type = 'float16'
-        elif self.meta['depth_format'] == 'mm':
-            depth_type = 'uint16'
+        if out is None:
+            out = np.empty(fp.shape, dtype=np.float32)
+        np.copyto(out, fp)
+        return out
 
-        if idx >= 0 and idx < num_frames:
-            fp = np.memmap(self.depth_file.name, dtype=depth_type, mode='r', 
-                shape=(height, width), offset=frame_size * idx).copy()
-        elif idx <= 0:
-            fp = np.memmap(self.depth_file.name, dtype=depth_type, mode='r', 
-                shape=(height, width), offset=frame_size * 0).copy()
-        else:
-            fp = np.memmap(self.depth_file.name, dtype=depth_type, mode='r', 
-                shape=(height, width), offset=frame_size * (num_frames - 1)).copy()
-        return fp
+    def raw_depthframe(self, idx=0):
+        """read only view of a depth frame, indices out of range are clamped to the first and last frame"""
+        num_frames = self.meta['num_frames']
+        return self.depth_frames[min(max(idx, 0), num_frames - 1)]
 
     def raw_confidenceframe(self, idx=0):
-        file_size = os.stat(self.confidence_file.name).st_size
-        frame_size = self.meta['depth_width'] * self.meta['depth_height'] * self.config.alg_param.frames.confidence_pixel_size
-        num_frames = int(file_size / frame_size)
-        if num_frames != self.meta.get('num_frames', 0):
-            logging.warning(f"confidence frames number not match in .zlib and meta, \
-                     {num_frames} in .zlib, {self.meta.get('num_frames', 0)} in metadata")
-            num_frames = min(self.meta.get('num_frames', 0), num_frames)
-
-        self.meta['num_frames'] = num_frames
-
-        height = self.meta['depth_height']
-        width = self.meta['depth_width']
-        if idx >= 0 and idx < num_frames:
-            fp = np.memmap(self.confidence_file.name, dtype='uint8', mode='r', 
-                shape=(height, width), offset=int(frame_size * idx)).copy()
-            return fp
+        """read only view of a confidence frame, None for indices out of range"""
+        if 0 <= idx < self.meta['num_frames']:
+            return self.confidence_frames[idx]
 
     def all_cameras(self):
         start_time = time.time()
-        for line in self.pose_file:
-            cam_info = json.loads(line)
-            C= cam_info.get('transform', None) # ARKit pose (+x along long axis of device toward home button, +y upwards, +z away from device)
-            assert C!= None
-            C= np.asarray(C)
-            C= C.reshape(4, 4).transpose()
-
-            C= np.matmul(C, np.diag([1, -1, -1, 1])) # open3d camera pose (flip y and z)
-            C= C / C[3][3]
-            self.extrinsics.append(np.linalg.inv(C))
-
-            scale_d2c_x = float(self.meta['depth_width']) / self.meta['color_width']
-            scale_d2c_y = float(self.meta['depth_height']) / self.meta['color_height']
-
-            K = cam_info.get('intrinsics', self.meta['intrinsic_data'])
-
-            K = np.asarray(K)
-            K = K.reshape(3, 3).transpose()
-            scale = np.array([scale_d2c_x, scale_d2c_y, 1.0])
-            K_depth = np.matmul(np.diag(scale), K)
-            self.intrinsics.append(K_depth)
-        
+        trajectory_data = trajectory.load_trajectory(self.pose_path)
+        # world to camera transforms of the open3d camera poses
+        self.extrinsics = np.linalg.inv(trajectory.arkit_to_open3d(trajectory_data['transforms']))
+
+        scale_d2c_x = float(self.meta['depth_width']) / self.meta['color_width']
+        scale_d2c_y = float(self.meta['depth_height']) / self.meta['color_height']
+        scale = np.array([scale_d2c_x, scale_d2c_y, 1.0])
+
+        K = trajectory.fill_intrinsics(trajectory_data['intrinsics'], self.meta['intrinsic_data'])
+        self.intrinsics = scale[None, :, None] * K
+
         log.info("--- %s seconds read camera extrinsics and intrinsics ---" % (time.time() - start_time))
         return self.extrinsics, self.intrinsics
 
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import open3d as o3d
+
+log = logging.getLogger('reconstruct')
+
+VOLUME_FILE = 'volume.npz'
+CURSOR_FILE = 'cursor.json'
+
+
+# voxel block hash map API of the open3d version built by CMakeLists.txt (0.13)
+HASHMAP_METHODS = ('get_active_addrs', 'get_key_tensor', 'get_value_tensor', 'activate')
+
+
+def check_volume(volume):
+    """raise a RuntimeError if the voxel blocks of volume cannot be checkpointed
+
+    Checkpoints read and write the block hash map of a TSDFVoxelGrid, exposed by open3d 0.13 as
+    get_block_hashmap.
+    """
+    if not hasattr(volume, 'get_block_hashmap'):
+        raise RuntimeError(f'Integration checkpoints need the voxel block hash map of open3d 0.13, '
+                           f'{type(volume).__name__} of open3d {o3d.__version__} has no get_block_hashmap')
+    hashmap = volume.get_block_hashmap()
+    missing = [name for name in HASHMAP_METHODS if not hasattr(hashmap, name)]
+    if missing:
+        raise RuntimeError(f'Integration checkpoints need the hash map methods {", ".join(missing)} '
+                           f'of open3d 0.13, not available in open3d {o3d.__version__}')
+
+
+def save_volume(volume, path):
+    """save the allocated voxel blocks of a TSDFVoxelGrid
+
+    Keys and values of the active hash map entries are stored as they are, so the checkpoint
+    does not depend on the voxel layout.
+    """
+    hashmap = volume.get_block_hashmap()
+    indices = hashmap.get_active_addrs().to(o3d.core.Dtype.Int64)
+    keys = hashmap.get_key_tensor()[indices].cpu().numpy()
+    values = hashmap.get_value_tensor()[indices].cpu().numpy()
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.savez(f, keys=keys, values=values)
+    os.replace(tmp, path)
+    return len(keys)
+
+
+def load_volume(volume, path, device):
+    """insert the voxel blocks saved by save_volume into an empty TSDFVoxelGrid"""
+    hashmap = volume.get_block_hashmap()
+    with np.load(path) as data:
+        keys = o3d.core.Tensor(data['keys']).to(device)
+        values = o3d.core.Tensor(data['values']).to(device)
+    indices, masks = hashmap.activate(keys)
+    if not masks.cpu().numpy().all():
+        raise IOError(f'Voxel blocks of {path} could not be restored')
+    hashmap.get_value_tensor()[indices.to(o3d.core.Dtype.Int64)] = values
+    return int(keys.shape[0])
+
+
+class IntegrationCheckpoint:
+    """periodic checkpoints of a TSDF integration
+
+    The folder holds the voxel blocks of the volume and a cursor with the number of integrated
+    frames. A checkpoint is only resumed if it was written for the same frames and volume.
+    """
+
+    def __init__(self, folder, frame_indices, volume_parameters, every=0):
+        """
+        :param folder: checkpoint folder
+        :param frame_indices: frames of the integration
+        :param volume_parameters: json serializable parameters the volume depends on
+        :param every: number of frames between checkpoints, 0 disables checkpoints
+        """
+        self.folder = folder
+        self.every = every
+        digest = hashlib.sha1(np.asarray(frame_indices, dtype='<i8').tobytes())
+        digest.update(json.dumps(volume_parameters, sort_keys=True).encode('utf-8'))
+        self.digest = digest.hexdigest()
+        self.num_frames = len(frame_indices)
+
+    def due(self, position):
+        """whether a checkpoint is due after position frames were integrated"""
+        return self.every > 0 and position % self.every == 0 and position < self.num_frames
+
+    def save(self, volume, position):
+        """save the volume after position frames were integrated"""
+        os.makedirs(self.folder, exist_ok=True)
+        num_blocks = save_volume(volume, os.path.join(self.folder, VOLUME_FILE))
+        cursor_path = os.path.join(self.folder, CURSOR_FILE)
+        with open(cursor_path + '.tmp', 'w') as f:
+            json.dump({'digest': self.digest, 'position': position, 'blocks': num_blocks}, f)
+        os.replace(cursor_path + '.tmp', cursor_path)
+        log.info(f'Checkpoint of {num_blocks} voxel blocks after {position} of {self.num_frames} frames')
+
+    def load(self, volume, device):
+        """restore the volume of the last checkpoint
+
+        :return: number of frames integrated into the restored volume, 0 without a matching checkpoint
+        """
+        cursor_path = os.path.join(self.folder, CURSOR_FILE)
+        if not os.path.isfile(cursor_path):
+            log.info(f'No integration checkpoint in {self.folder}, start from the first frame')
+            return 0
+        with open(cursor_path, 'r') as f:
+            cursor = json.load(f)
+        if cursor.get('digest') != self.digest:
+            log.warning('Integration checkpoint was written for other frames or volume parameters, '
+                        'start from the first frame')
+            return 0
+        num_blocks = load_volume(volume, os.path.join(self.folder, VOLUME_FILE), device)
+        log.info(f'Resume integration after {cursor["position"]} of {self.num_frames} frames '
+                 f'with {num_blocks} voxel blocks')
+        return cursor['position']
+
+    def remove(self):
+        if os.path.isdir(self.folder):
+            shutil.rmtree(self.folder)
@@ -1,5 +1,8 @@
+import collections
 import os
+import queue
 import sys
+import threading
 import time
 import logging
 
@@ -9,9 +12,12 @@ from progress.bar import Bar
 
 from reconstruction.scripts.utils import align_color2depth
 from reconstruction.scripts.base import ReconBase
+from reconstruction.scripts import tiled
+from reconstruction.scripts.checkpoint import IntegrationCheckpoint, check_volume
 
 from multiscan.meshproc import TriMesh
 from multiscan.utils import io
+from multiscan.utils import trajectory
 
 log = logging.getLogger('reconstruct')
 
@@ -62,12 +68,16 @@ class Reconstruct(ReconBase):
             self._num_frames = bridge.meta['num_frames']
             self._frame_i_abs = list(range(0, self._num_frames))
         
+        self._block_count = None
+        self._checkpoint = None
         self._skip_step = 1
         if self.config.alg_param.frames.step > 0:
             self._skip_step = self.config.alg_param.frames.step
 
         if self.config.settings.debug:
             log.setLevel(logging.DEBUG)
+        # accumulated seconds per integration stage
+        self._stage_timers = collections.defaultdict(float)
 
     def export(self, volume):
         """export reconstruction results
@@ -75,57 +85,106 @@ class Reconstruct(ReconBase):
         :param volume: integration volume
         :return: None
         """
-        cfg_output = self.config.output
-        io.ensure_dir_exists(self.save_folder())
+        mesh = None
+        pcd = None
         if self.config.settings.extract_mesh:
-            mesh_path = os.path.join(self.save_folder(), cfg_output.mesh_filename)
             log.info("Extract triangle mesh")
             if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
                 mesh = volume.cpu().extract_surface_mesh(weight_threshold=self.config.alg_param.extract.weight_threshold).to_legacy_triangle_mesh()
             else:
                 mesh = volume.extract_triangle_mesh()
+        if self.config.settings.extract_pcd:
+            log.info("Extract point cloud")
+            if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
+                pcd = volume.cpu().extract_surface_points().to_legacy_point_cloud()
+            else:
+                pcd = volume.extract_point_cloud()
+        self.export_geometry(mesh, pcd)
+
+    def export_geometry(self, mesh=None, pcd=None):
+        """save, decimate and align the extracted mesh and save the point cloud
+
+        :param mesh: legacy triangle mesh extracted from the volume
+        :param pcd: legacy point cloud extracted from the volume
+        :return: None
+        """
+        cfg_output = self.config.output
+        io.ensure_dir_exists(self.save_folder())
+        if self.config.settings.extract_mesh:
+            # the mesh stays in memory through cleanup, alignment and transformation,
+            # only instant meshes reads and writes files
+            timers = collections.OrderedDict()
+            mesh_path = os.path.join(self.save_folder(), cfg_output.mesh_filename)
             unaligned_mesh_filename = os.path.splitext(mesh_path)[0] + '_unaligned.ply'
+            num_vertices = len(mesh.vertices)
+            start_time = time.time()
+            mesh = TriMesh.cleanup_o3d_mesh(mesh, log=log)
+            timers['cleanup'] = time.time() - start_time
+            start_time = time.time()
             success = o3d.io.write_triangle_mesh(
                 unaligned_mesh_filename, mesh, write_vertex_normals=True)
-            TriMesh.cleanup_mesh(unaligned_mesh_filename)
+            timers['write'] = time.time() - start_time
             log.info("Result saved to : {}".format(unaligned_mesh_filename))
 
             if success and io.is_non_zero_file(unaligned_mesh_filename):
-                # mesh decimation with instant meshes
                 decimated_mesh_path = os.path.join(self.save_folder(), cfg_output.decimated_mesh_filename)
-                unaligned_decimated_mesh_path = os.path.splitext(decimated_mesh_path)[0] + '_unaligned.ply'
-                log.info(f'Start mesh decimation')
                 cfg_decimation = self.config.alg_param.decimation
-                set_dominant = '--dominant' if cfg_decimation.dominant else ''
-                ret = io.call(
-                    ['./' + self.config.settings.instant_meshes_bin, unaligned_mesh_filename, 
-                    '-c', str(cfg_decimation.crease), set_dominant,
-                    '-r', str(cfg_decimation.rosy), '-p', str(cfg_decimation.posy), 
-                    '-v', str(int(np.asarray(mesh.vertices).shape[0] / cfg_decimation.degree)),
-                    '-o', unaligned_decimated_mesh_path], log, self.config.settings.instant_meshes_path)
-                if not ret:
+                target_vertices = int(num_vertices / cfg_decimation.degree)
+                backend = cfg_decimation.get('backend', 'instant_meshes')
+                log.info(f'Start mesh decimation with {backend}')
+                decimated_mesh = None
+                if backend == 'quadric':
+                    # quadric edge collapse in process on the cleaned mesh
+                    start_time = time.time()
+                    decimated_mesh = TriMesh.decimate_o3d_mesh(mesh, target_vertices)
+                    timers['decimation'] = time.time() - start_time
+                elif backend == 'instant_meshes':
+                    # mesh decimation with instant meshes
+                    unaligned_decimated_mesh_path = os.path.splitext(decimated_mesh_path)[0] + '_unaligned.ply'
+                    set_dominant = '--dominant' if cfg_decimation.dominant else ''
+                    start_time = time.time()
+                    ret = io.call(
+                        ['./' + self.config.settings.instant_meshes_bin, unaligned_mesh_filename, 
+                        '-c', str(cfg_decimation.crease), set_dominant,
+                        '-r', str(cfg_decimation.rosy), '-p', str(cfg_decimation.posy), 
+                        '-v', str(target_vertices),
+                        '-o', unaligned_decimated_mesh_path], log, self.config.settings.instant_meshes_path)
+                    timers['decimation'] = time.time() - start_time
+                    if not ret:
+                        start_time = time.time()
+                        decimated_mesh = o3d.io.read_triangle_mesh(unaligned_decimated_mesh_path)
+                        timers['read decimated'] = time.time() - start_time
+                else:
+                    raise ValueError(f'Unknown decimation backend {backend}')
+
+                if decimated_mesh is not None:
                     # mesh clean up and coordinate alignment
-                    TriMesh.cleanup_mesh(unaligned_decimated_mesh_path)
-                    decimated_mesh = TriMesh(unaligned_decimated_mesh_path)
+                    start_time = time.time()
+                    decimated_mesh = TriMesh(TriMesh.cleanup_o3d_mesh(decimated_mesh, log=log))
+                    timers['cleanup decimated'] = time.time() - start_time
+                    start_time = time.time()
                     transform_mat = decimated_mesh.align_mesh(
-                        os.path.join(self.save_folder(), cfg_output.mesh_alignment_filename))
+                        os.path.join(self.save_folder(), cfg_output.mesh_alignment_filename),
+                        max_points=self.config.alg_param.get('alignment', {}).get('outlier_max_points', 100000))
+                    timers['align'] = time.time() - start_time
+                    start_time = time.time()
                     o3d.io.write_triangle_mesh(
                         decimated_mesh_path, decimated_mesh.o3d_mesh, write_vertex_normals=True)
+                    timers['write decimated'] = time.time() - start_time
                     log.info("Decimated mesh saved to : {}".format(decimated_mesh_path))
 
-                    raw_mesh = TriMesh(unaligned_mesh_filename)
-                    raw_mesh.o3d_mesh.transform(np.linalg.inv(transform_mat))
+                    start_time = time.time()
+                    mesh.transform(np.linalg.inv(transform_mat))
+                    timers['transform'] = time.time() - start_time
+                    start_time = time.time()
                     o3d.io.write_triangle_mesh(
-                        mesh_path, raw_mesh.o3d_mesh, write_vertex_normals=True)
+                        mesh_path, mesh, write_vertex_normals=True)
+                    timers['write undecimated'] = time.time() - start_time
                     log.info("Undecimated mesh saved to : {}".format(mesh_path))
+            log.info('Mesh export took ' + ', '.join(f'{name} {seconds:.2f}s' for name, seconds in timers.items()))
 
         if self.config.settings.extract_pcd:
             pcd_path = os.path.join(self.save_folder(), cfg_output.pcd_filename)
-            log.info("Extract point cloud")
-            if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
-                pcd = volume.cpu().extract_surface_points().to_legacy_point_cloud()
-            else:
-                pcd = volume.extract_point_cloud()
             o3d.io.write_point_cloud(pcd_path, pcd)
             log.info("Result saved to : {}".format(pcd_path))
 
@@ -177,6 +236,9 @@ class Reconstruct(ReconBase):
         color = None
         if isinstance(depth_input, str) and os.path.isfile(depth_input):
             depth = o3d.t.io.read_image(depth_input).to(self.device)
+        elif isinstance(depth_input, np.ndarray):
+            # frame from a frame store
+            depth = o3d.t.geometry.Image(o3d.core.Tensor(np.ascontiguousarray(depth_input)[:, :, None])).to(self.device)
         elif isinstance(depth_input, int) and 0 <= depth_input < self._num_frames:
             level = self.config.alg_param.depth_filter.level
             thresh = self.config.alg_param.depth_filter.delta_thresh
@@ -188,118 +250,340 @@ class Reconstruct(ReconBase):
         elif isinstance(color_input, int) and 0 <= color_input < self._num_frames:
             color = o3d.geometry.Image(self.bridge.cap_colorframe(color_input))
             color = align_color2depth(color, depth)
+        elif isinstance(color_input, np.ndarray):
+            # frame decoded by the bridge, already at depth resolution unless disabled
+            color = align_color2depth(o3d.geometry.Image(np.ascontiguousarray(color_input)), depth)
         
         return depth, color
 
-    def _integrate_with_traj(self, volume):
-        """integrate frames use input camera poses
+    def _prepare_frame(self, abs_idx, color_frame=None):
+        """read, filter and convert a frame for integration
 
-        :param volume: integration volume
-        :return: None
+        :param abs_idx: index of the frame
+        :param color_frame: decoded color frame of compressed streams
+        :return: (depth, rgb, intrinsic, extrinsic) as expected by the volume type, None if the frame is skipped
         """
-        num_camera_pose = len(self._extrinsics)
-        total = num_camera_pose
-        if num_camera_pose != self._num_frames:
-            total = min(num_camera_pose, self._num_frames)
-            log.warning('Camera poses and frames have different length, only use first {:d} frames'.format(total))
-
         debug = self.config.settings.debug
-        bar = Bar('Integration', max=int(total / self._skip_step), 
-                  suffix='%(percent)d%% - %(index)d-th image added into the volume')
-        for i in range(0, total, self._skip_step):
-            bar.next()
-            
-            if debug:
-                start_time = time.time()
-            
-            abs_idx = self._frame_i_abs[i]
+        timers = self._stage_timers
+        start_time = time.time()
+
+        if 0 <= abs_idx < len(self._intrinsics):
+            intrinsic = self._intrinsics[abs_idx]
+        else:
+            intrinsic = self._intrinsics[0]
+        extrinsic = self._extrinsics[abs_idx]
+
+        # read depth and color images
+        depth = None
+        rgb = None
+        if os.path.isfile(self.config.input.depth_stream):
+            if self.config.alg_param.integration.with_color:
+                depth, rgb = self.read_depth_and_color_image(abs_idx, color_frame)
+            else:
+                depth, rgb = self.read_depth_and_color_image(abs_idx)
             
-            if 0 <= abs_idx < len(self._intrinsics):
-                intrinsic = self._intrinsics[abs_idx]
+            depth_raw = np.asarray(depth)
+            if float(np.count_nonzero(depth_raw)) / depth_raw.size < self.config.alg_param.depth_filter.min_portion:
+                timers['read'] += time.time() - start_time
+                return None
+        elif os.path.isdir(self.config.input.depth_stream):
+            if self.config.alg_param.integration.with_color:
+                depth, rgb = self.read_depth_and_color_image(self._frame_files.depths[abs_idx], self._frame_files.colors[abs_idx])
             else:
-                intrinsic = self._intrinsics[0]
-            extrinsic = self._extrinsics[abs_idx]
+                depth, rgb = self.read_depth_and_color_image(self._frame_files.depths[abs_idx])
+            depth_raw = depth.as_tensor()
+            if float(len(depth_raw.nonzero()[0])) / (depth_raw.shape[0] * depth_raw.shape[1]) < self.config.alg_param.depth_filter.min_portion:
+                timers['read'] += time.time() - start_time
+                return None
+        else:
+            raise ValueError('Depth input stream is invalid')
+        timers['read'] += time.time() - start_time
+        if debug:
+            log.debug("--- %s seconds read images ---" % (time.time() - start_time))
 
-            # read depth and color images
-            depth = None
-            rgb = None
+        start_time = time.time()
+        if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
             if os.path.isfile(self.config.input.depth_stream):
-                if self.config.alg_param.integration.with_color:
-                    depth, rgb = self.read_depth_and_color_image(abs_idx, abs_idx)
-                else:
-                    depth, rgb = self.read_depth_and_color_image(abs_idx)
-                
-                depth_raw = np.asarray(depth)
-                if float(np.count_nonzero(depth_raw)) / depth_raw.size < self.config.alg_param.depth_filter.min_portion:
-                    continue
-            elif os.path.isdir(self.config.input.depth_stream):
-                if self.config.alg_param.integration.with_color:
-                    depth, rgb = self.read_depth_and_color_image(self._frame_files.depths[abs_idx], self._frame_files.colors[abs_idx])
-                else:
-                    depth, rgb = self.read_depth_and_color_image(self._frame_files.depths[abs_idx])
-                depth_raw = depth.as_tensor()
-                if float(len(depth_raw.nonzero()[0])) / (depth_raw.shape[0] * depth_raw.shape[1]) < self.config.alg_param.depth_filter.min_portion:
-                    continue
-            else:
-                raise ValueError('Depth input stream is invalid')
-            if debug:
-                log.debug("--- %s seconds read images ---" % (time.time() - start_time))
-
-            if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
-                if debug:
-                    tmp_time = time.time()
-                if os.path.isfile(self.config.input.depth_stream):
-                    if depth:
-                        depth = o3d.t.geometry.Image.from_legacy_image(depth, self.device)
-                    if rgb:
-                        rgb = o3d.t.geometry.Image.from_legacy_image(rgb, self.device)
-                extrinsic = o3d.core.Tensor(extrinsic, o3d.core.Dtype.Float64, self.device)
-                intrinsic = o3d.core.Tensor(intrinsic, o3d.core.Dtype.Float64, self.device)
-                if debug:
-                    log.debug("--- %s seconds data to tensor ---" % (time.time() - tmp_time))
-                    tmp_time = time.time()
-                
+                if depth:
+                    depth = o3d.t.geometry.Image.from_legacy_image(depth, self.device)
                 if rgb:
-                    volume.integrate(depth, rgb, intrinsic, extrinsic,
-                                    self.config.alg_param.depth_thresh.scale,
-                                    self.config.alg_param.depth_thresh.max)
-                else:
-                    volume.integrate(depth, intrinsic, extrinsic,
-                                    self.config.alg_param.depth_thresh.scale,
-                                    self.config.alg_param.depth_thresh.max)
-                    if debug:
-                        log.debug("--- %s seconds integrate one frame ---" % (time.time() - tmp_time))
+                    rgb = o3d.t.geometry.Image.from_legacy_image(rgb, self.device)
+            extrinsic = o3d.core.Tensor(extrinsic, o3d.core.Dtype.Float64, self.device)
+            intrinsic = o3d.core.Tensor(intrinsic, o3d.core.Dtype.Float64, self.device)
+        else:
+            if os.path.isdir(self.config.input.depth_stream):
+                if depth:
+                    depth = depth.to_legacy_image()
+                if rgb:
+                    rgb = rgb.to_legacy_image()
+            assert rgb is not None, "ScalableTSDFVolume need color frames as input"
+
+            depth_raw = np.asarray(depth)
+            K = intrinsic.flatten('F').tolist()
+            intrinsic = o3d.camera.PinholeCameraIntrinsic(width = depth_raw.shape[1], height = depth_raw.shape[0], 
+                                                          fx = K[0], fy = K[4], cx = K[6], cy = K[7])
+        timers['convert'] += time.time() - start_time
+        if debug:
+            log.debug("--- %s seconds data to tensor ---" % (time.time() - start_time))
+        return depth, rgb, intrinsic, extrinsic
+
+    def _integrate_frame(self, volume, frame):
+        depth, rgb, intrinsic, extrinsic = frame
+        start_time = time.time()
+        if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
+            if rgb:
+                volume.integrate(depth, rgb, intrinsic, extrinsic,
+                                self.config.alg_param.depth_thresh.scale,
+                                self.config.alg_param.depth_thresh.max)
             else:
-                if os.path.isdir(self.config.input.depth_stream):
-                    if depth:
-                        depth = depth.to_legacy_image()
-                    if rgb:
-                        rgb = rgb.to_legacy_image()
-
-                assert rgb is not None, "ScalableTSDFVolume need color frames as input"
-
-                rgbd = o3d.geometry.RGBDImage.create_from_color_and_depth(
-                        rgb,
-                        depth,
-                        depth_scale=self.config.alg_param.depth_thresh.scale,
-                        depth_trunc=self.config.alg_param.depth_thresh.max,
-                        convert_rgb_to_intensity=False)
-                
-                depth_raw = np.asarray(depth)
-                
-                K = intrinsic.flatten('F').tolist()
-                o3d_intrinsic = o3d.camera.PinholeCameraIntrinsic(width = depth_raw.shape[1], height = depth_raw.shape[0], 
-                                                               fx = K[0], fy = K[4], cx = K[6], cy = K[7])
-                volume.integrate(rgbd, o3d_intrinsic, extrinsic)
-                if debug:
-                    log.debug("--- %s seconds integrate one frame ---" % (time.time() - tmp_time))
-            if debug:
-                log.debug("--- %s seconds ---" % (time.time() - start_time))
+                volume.integrate(depth, intrinsic, extrinsic,
+                                self.config.alg_param.depth_thresh.scale,
+                                self.config.alg_param.depth_thresh.max)
+        else:
+            rgbd = o3d.geometry.RGBDImage.create_from_color_and_depth(
+                    rgb,
+                    depth,
+                    depth_scale=self.config.alg_param.depth_thresh.scale,
+                    depth_trunc=self.config.alg_param.depth_thresh.max,
+                    convert_rgb_to_intensity=False)
+            volume.integrate(rgbd, intrinsic, extrinsic)
+        self._stage_timers['integrate'] += time.time() - start_time
+        if self.config.settings.debug:
+            log.debug("--- %s seconds integrate one frame ---" % (time.time() - start_time))
 
-    def integrate(self):
-        """volume integration of all RGBD frames with camera poses
+    def _iter_prepared_frames(self, frame_indices, color_frames=None):
+        """frames prepared for integration in order, None for skipped frames
 
-        :return:None
+        With alg_param.integration.prefetch > 0 a producer thread prepares up to that many frames
+        ahead, so reading and filtering overlaps with integration.
+        """
+        prefetch = self.config.alg_param.integration.get('prefetch', 0)
+        if prefetch <= 0:
+            for i in frame_indices:
+                color_frame = next(color_frames) if color_frames is not None else None
+                yield self._prepare_frame(self._frame_i_abs[i], color_frame)
+            return
+
+        frames = queue.Queue(maxsize=prefetch)
+        stop = threading.Event()
+        end = object()
+
+        def produce():
+            try:
+                for i in frame_indices:
+                    if stop.is_set():
+                        break
+                    color_frame = next(color_frames) if color_frames is not None else None
+                    frames.put(self._prepare_frame(self._frame_i_abs[i], color_frame))
+            except Exception as e:
+                frames.put(e)
+            finally:
+                frames.put(end)
+
+        producer = threading.Thread(target=produce, name='frame-producer', daemon=True)
+        producer.start()
+        try:
+            while True:
+                start_time = time.time()
+                frame = frames.get()
+                self._stage_timers['wait'] += time.time() - start_time
+                if frame is end:
+                    break
+                if isinstance(frame, Exception):
+                    raise frame
+                yield frame
+        finally:
+            # unblock and stop the producer if integration ended early
+            stop.set()
+            while producer.is_alive():
+                try:
+                    frames.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+
+    def _select_frames(self):
+        """frames to integrate out of the frames with camera poses
+
+        alg_param.frames.selection 'step' integrates every step-th frame, 'motion' integrates only
+        the step-th frames where the camera moved by more than min_translation (meter) or min_rotation
+        (degree) since the last integrated frame, and at least every max_gap frames.
+
+        :return: list of frame indices
+        """
+        num_camera_pose = len(self._extrinsics)
+        total = num_camera_pose
+        if num_camera_pose != self._num_frames:
+            total = min(num_camera_pose, self._num_frames)
+            log.warning('Camera poses and frames have different length, only use first {:d} frames'.format(total))
+
+        parameters = self.config.alg_param.frames
+        frame_indices = list(range(0, total, self._skip_step))
+        selection = parameters.get('selection', 'step')
+        if selection == 'step' or not frame_indices:
+            return frame_indices
+        if selection != 'motion':
+            raise ValueError(f'Unknown frame selection {selection}')
+
+        extrinsics = np.asarray(self._extrinsics)[[self._frame_i_abs[i] for i in frame_indices]]
+        # max_gap in number of candidate frames
+        max_gap = parameters.get('max_gap', 0)
+        if max_gap > 0:
+            max_gap = max(max_gap // self._skip_step, 1)
+        selected = trajectory.select_keyframes(extrinsics,
+                                               min_translation=parameters.get('min_translation', 0.0),
+                                               min_rotation=parameters.get('min_rotation', 0.0),
+                                               max_gap=max_gap)
+        num_skipped = len(frame_indices) - len(selected)
+        log.info(f'Frame selection integrates {len(selected)} of {len(frame_indices)} frames, '
+                 f'skipped {num_skipped} frames with little camera motion '
+                 f'({len(frame_indices) / len(selected):.2f}x fewer frames)')
+        return [frame_indices[i] for i in selected]
+
+    def _integration_checkpoint(self, frame_indices):
+        """checkpoints of the integration of frame_indices, None if they are not requested"""
+        cfg_integration = self.config.alg_param.integration
+        cfg_checkpoint = cfg_integration.get('checkpoint', None)
+        every = cfg_checkpoint.get('every', 0) if cfg_checkpoint is not None else 0
+        resume = self.config.settings.get('resume', False)
+        if every <= 0 and not resume:
+            return None
+        if VolumeType[self.config.alg_param.volume_type] != VolumeType.TSDFVoxelGrid:
+            raise ValueError('Integration checkpoints need a TSDFVoxelGrid volume')
+        folder = cfg_checkpoint.get('folder', 'integration_checkpoint') if cfg_checkpoint is not None \
+            else 'integration_checkpoint'
+        volume_parameters = {name: cfg_integration[name] for name in
+                             ('voxel_len_fine', 'block_resolution', 'sdf_trunc', 'with_color')}
+        volume_parameters['voxel_type'] = dict(cfg_integration.voxel_type)
+        return IntegrationCheckpoint(os.path.join(self.save_folder(), folder), frame_indices,
+                                     volume_parameters, every)
+
+    def _integrate_with_traj(self, volume, frame_indices=None):
+        """integrate frames use input camera poses
+
+        With alg_param.integration.checkpoint.every > 0 the volume is checkpointed into the output
+        folder every that many frames, settings.resume continues from the last checkpoint. Requesting
+        checkpoints for a volume that cannot be checkpointed raises an error.
+
+        :param volume: integration volume
+        :param frame_indices: frames to integrate, selected by _select_frames if None
+        :return: the volume, a new one if restoring a checkpoint failed
+        """
+        if frame_indices is None:
+            frame_indices = self._select_frames()
+        checkpoint = self._integration_checkpoint(frame_indices)
+        position = 0
+        if checkpoint is not None:
+            check_volume(volume)
+            if self.config.settings.get('resume', False):
+                try:
+                    position = checkpoint.load(volume, self.device)
+                except IOError as e:
+                    log.warning(f'Cannot resume the integration, start from the first frame: {e}')
+                    volume = None
+        if volume is None:
+            volume = self.create_volume(self._block_count)
+        remaining = frame_indices[position:]
+
+        bar = Bar('Integration', max=len(remaining),
+                  suffix='%(percent)d%% - %(index)d-th image added into the volume')
+        # color frames of the compressed stream are decoded in order ahead of the loop
+        color_frames = None
+        if os.path.isfile(self.config.input.depth_stream) and self.config.alg_param.integration.with_color:
+            color_frames = self.bridge.iter_colorframes([self._frame_i_abs[i] for i in remaining])
+
+        self._stage_timers = collections.defaultdict(float)
+        start_time = time.time()
+        frames = self._iter_prepared_frames(remaining, color_frames)
+        try:
+            for frame in frames:
+                bar.next()
+                if frame is not None:
+                    self._integrate_frame(volume, frame)
+                position += 1
+                if checkpoint is not None and checkpoint.due(position):
+                    try:
+                        checkpoint.save(volume, position)
+                    except IOError as e:
+                        log.warning(f'Cannot checkpoint the integration, disable checkpoints: {e}')
+                        checkpoint = None
+        finally:
+            frames.close()
+        bar.finish()
+        # removed once the results are exported
+        self._checkpoint = checkpoint
+        timers = self._stage_timers
+        log.info(f"Integration of {len(remaining)} frames took {time.time() - start_time:.2f}s: read {timers['read']:.2f}s, "
+                 f"convert {timers['convert']:.2f}s, integrate {timers['integrate']:.2f}s, "
+                 f"waiting for frames {timers['wait']:.2f}s")
+        return volume
+
+    def _estimate_block_count(self, frame_indices):
+        """number of voxel blocks to allocate for the integration of the frames
+
+        The blocks within the view frustums of the frames up to depth_thresh.max bound the blocks
+        the integration can touch. The estimate is scaled by block_margin, raised to at least
+        min_block_count and capped last, so the blocks always fit into block_memory_cap megabytes.
+
+        :param frame_indices: frames to integrate
+        :return: (block count, number of blocks within the frustums or None without estimate)
+        """
+        parameters = self.config.alg_param
+        cfg_integration = parameters.integration
+        block_count = cfg_integration.block_count
+        if block_count != 'auto':
+            return int(block_count), None
+        default_count = cfg_integration.get('default_block_count', 30000)
+        intrinsics = np.asarray(self._intrinsics) if len(self._intrinsics) == len(self._extrinsics) else None
+        if intrinsics is None or intrinsics.ndim != 3 or not len(frame_indices):
+            log.warning(f'Cannot estimate the volume from the camera frustums, use {default_count} blocks')
+            return default_count, None
+
+        start_time = time.time()
+        abs_indices = [self._frame_i_abs[i] for i in frame_indices]
+        intrinsics = intrinsics[abs_indices]
+        if self.bridge is not None and 'depth_width' in self.bridge.meta:
+            width, height = self.bridge.meta['depth_width'], self.bridge.meta['depth_height']
+        else:
+            # assume a centered principal point
+            width, height = 2.0 * intrinsics[0, 0, 2], 2.0 * intrinsics[0, 1, 2]
+        block_size = cfg_integration.voxel_len_fine * cfg_integration.block_resolution
+        num_blocks = len(trajectory.frustum_blocks(np.asarray(self._extrinsics)[abs_indices], intrinsics,
+                                                   width, height, parameters.depth_thresh.min,
+                                                   parameters.depth_thresh.max, block_size))
+
+        voxel_bytes = sum(np.dtype(cfg_integration.voxel_type[name].lower()).itemsize * channels
+                          for name, channels in (('tsdf', 1), ('weight', 1), ('color', 3)))
+        block_bytes = voxel_bytes * cfg_integration.block_resolution ** 3
+        max_count = int(cfg_integration.get('block_memory_cap', 4096) * 1024 * 1024 // block_bytes)
+        # the frustum sampling can miss a few blocks, keep a small safety minimum for tiny volumes
+        block_count = max(int(np.ceil(num_blocks * cfg_integration.get('block_margin', 1.2))),
+                          cfg_integration.get('min_block_count', 1000))
+        if block_count > max_count:
+            log.warning(f'{block_count} estimated blocks exceed the memory cap, use {max_count} blocks')
+            block_count = max_count
+        block_count = max(block_count, 1)
+        log.info(f'Estimated {num_blocks} voxel blocks within the camera frustums in {time.time() - start_time:.2f}s, '
+                 f'allocate {block_count} blocks ({block_count * block_bytes / 1024 / 1024:.0f} MB)')
+        return block_count, num_blocks
+
+    @staticmethod
+    def _volume_block_usage(volume):
+        """number of allocated voxel blocks of a TSDFVoxelGrid, None if open3d does not expose it"""
+        for name in ('hashmap', 'get_block_hashmap'):
+            hashmap = getattr(volume, name, None)
+            if hashmap is not None:
+                try:
+                    return int(hashmap().size())
+                except (AttributeError, RuntimeError, TypeError):
+                    pass
+        return None
+
+    def create_volume(self, block_count=None):
+        """create an empty integration volume of alg_param.volume_type
+
+        :param block_count: number of voxel blocks of a TSDFVoxelGrid
+        :return: integration volume
         """
         parameters = self.config.alg_param
         if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
@@ -314,7 +598,7 @@ class Reconstruct(ReconBase):
                 sdf_trunc=min(parameters.integration.sdf_trunc,
                               parameters.integration.voxel_len_fine * 0.42 * parameters.integration.block_resolution),
                 block_resolution=parameters.integration.block_resolution,
-                block_count=parameters.integration.block_count,
+                block_count=block_count,
                 device=self.device
             )
         else:
@@ -323,9 +607,53 @@ class Reconstruct(ReconBase):
                 sdf_trunc=parameters.integration.sdf_trunc,
                 color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8,
             )
-        
-        self._integrate_with_traj(volume)
+        return volume
+
+    def _use_tiled_integration(self):
+        """whether alg_param.integration.tiled is enabled and supported"""
+        cfg_tiled = self.config.alg_param.integration.get('tiled', None)
+        if cfg_tiled is None or not cfg_tiled.enabled:
+            return False
+        if VolumeType[self.config.alg_param.volume_type] != VolumeType.TSDFVoxelGrid or self.to_gpu:
+            log.warning('Tiled integration needs a TSDFVoxelGrid on cpu, integrate into a single volume')
+            return False
+        intrinsics = np.asarray(self._intrinsics)
+        if intrinsics.ndim != 3 or len(intrinsics) != len(self._extrinsics):
+            log.warning('Tiled integration needs intrinsics of every frame, integrate into a single volume')
+            return False
+        return True
+
+    def integrate(self):
+        """volume integration of all RGBD frames with camera poses
+
+        With alg_param.integration.tiled.enabled, world space is split into tiles integrated in
+        parallel processes, see tiled.integrate_tiled.
+
+        :return:None
+        """
+        frame_indices = self._select_frames()
+        if self._use_tiled_integration():
+            if self.config.settings.get('resume', False):
+                log.warning('Tiled integration has no checkpoints, integrate all frames')
+            mesh, pcd = tiled.integrate_tiled(self, frame_indices)
+            self.export_geometry(mesh, pcd)
+            return
+
+        block_count = None
+        if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
+            block_count, predicted_blocks = self._estimate_block_count(frame_indices)
+        self._block_count = block_count
+        volume = self.create_volume(block_count)
+
+        volume = self._integrate_with_traj(volume, frame_indices)
+        if VolumeType[self.config.alg_param.volume_type] == VolumeType.TSDFVoxelGrid:
+            used_blocks = self._volume_block_usage(volume)
+            if used_blocks is not None:
+                log.info(f'Voxel blocks used {used_blocks} of {block_count} allocated, '
+                         f'predicted {predicted_blocks if predicted_blocks is not None else "-"}')
         self.export(volume)
+        if self._checkpoint is not None:
+            self._checkpoint.remove()
 
     def run(self):
         """run reconstruction pipeline
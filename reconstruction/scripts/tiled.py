@@ -0,0 +1,262 @@
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import open3d as o3d
+from progress.bar import Bar
+
+from multiscan.utils import trajectory
+from reconstruction.scripts.bridge import Bridge
+
+log = logging.getLogger('reconstruct')
+
+# reconstruction of a tile worker process
+_recons = None
+
+
+def plan_tiles(extrinsics, intrinsics, width, height, depth_min, depth_max, tile_size, overlap, block_size):
+    """assign frames to the tiles their view frustums reach
+
+    Tiles are cubes of edge tile_size aligned to the world origin, a frame is assigned to every
+    tile whose box, grown by overlap, its frustum intersects.
+
+    :param extrinsics: (N, 4, 4) world to camera transforms
+    :param intrinsics: (N, 3, 3) intrinsics at the resolution width x height
+    :return: dict of tile coordinates to the positions of their frames in extrinsics
+    """
+    # grow the frustum blocks by the overlap and a block for blocks missed by the sampling, the grown
+    # blocks are sampled at most a tile apart so tiles between their corners are not skipped
+    margin = overlap + block_size
+    steps = np.linspace(-margin, margin, int(np.ceil(2 * margin / tile_size)) + 1)
+    offsets = np.array(list(itertools.product(steps, repeat=3)))
+    tiles = collections.defaultdict(list)
+    for i in range(len(extrinsics)):
+        blocks = trajectory.frustum_blocks(extrinsics[i:i + 1], intrinsics[i:i + 1], width, height,
+                                           depth_min, depth_max, block_size)
+        centers = (blocks + 0.5) * block_size
+        keys = np.floor((centers[:, None, :] + offsets) / tile_size).astype(np.int64).reshape(-1, 3)
+        for key in np.unique(keys, axis=0):
+            tiles[tuple(key.tolist())].append(i)
+    return dict(tiles)
+
+
+def clip_depth_to_box(depth, intrinsic, extrinsic, depth_scale, depth_max, box_min, box_max, sdf_trunc):
+    """zero the depth of pixels whose ray misses a box
+
+    A pixel updates the voxels along its ray up to sdf_trunc behind the surface, so the voxels in
+    the box get the same updates from the clipped depth as from the full depth.
+
+    :param depth: (H, W) depth image, modified in place
+    :param intrinsic: (3, 3) intrinsic matrix
+    :param extrinsic: (4, 4) world to camera transform
+    :return: number of pixels kept
+    """
+    height, width = depth.shape[:2]
+    z = depth.reshape(height, width).astype(np.float64) / depth_scale
+    valid = (z > 0) & (z <= depth_max)
+    v, u = np.nonzero(valid)
+    z = z[v, u]
+    rays = np.stack([(u - intrinsic[0, 2]) / intrinsic[0, 0], (v - intrinsic[1, 2]) / intrinsic[1, 1], np.ones(len(u))])
+    # extend the rays by sdf_trunc behind the surface
+    points = rays * (z + sdf_trunc / np.linalg.norm(rays, axis=0))
+    rotation = extrinsic[:3, :3]
+    origin = -rotation.T @ extrinsic[:3, 3]
+    directions = (rotation.T @ points).T
+    # slab test of the segments origin + t * direction, t in [0, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t0 = (np.asarray(box_min) - origin) / directions
+        t1 = (np.asarray(box_max) - origin) / directions
+    t_near = np.fmax.reduce(np.fmin(t0, t1), axis=1)
+    t_far = np.fmin.reduce(np.fmax(t0, t1), axis=1)
+    hit = (t_far >= np.maximum(t_near, 0.0)) & (t_near <= 1.0)
+    clipped = np.ones((height, width), dtype=bool)
+    clipped[v[hit], u[hit]] = False
+    depth.reshape(height, width)[clipped] = 0
+    return int(np.count_nonzero(hit))
+
+
+def crop_mesh(mesh, box_min, box_max):
+    """vertices, triangles and vertex attributes of the triangles with centroid in [box_min, box_max)"""
+    vertices = np.asarray(mesh.vertices)
+    triangles = np.asarray(mesh.triangles)
+    centroids = vertices[triangles].mean(axis=1)
+    keep = np.all((centroids >= box_min) & (centroids < box_max), axis=1)
+    triangles = triangles[keep]
+    used, triangles = np.unique(triangles, return_inverse=True)
+    part = {'vertices': vertices[used], 'triangles': triangles.reshape(-1, 3)}
+    if mesh.has_vertex_normals():
+        part['normals'] = np.asarray(mesh.vertex_normals)[used]
+    if mesh.has_vertex_colors():
+        part['colors'] = np.asarray(mesh.vertex_colors)[used]
+    return part
+
+
+def crop_points(pcd, box_min, box_max):
+    """points and point attributes within [box_min, box_max)"""
+    points = np.asarray(pcd.points)
+    keep = np.all((points >= box_min) & (points < box_max), axis=1)
+    part = {'points': points[keep]}
+    if pcd.has_normals():
+        part['normals'] = np.asarray(pcd.normals)[keep]
+    if pcd.has_colors():
+        part['colors'] = np.asarray(pcd.colors)[keep]
+    return part
+
+
+def stitch_meshes(parts):
+    """merge cropped tile meshes, vertices on tile borders are shared by the merged triangles"""
+    mesh = o3d.geometry.TriangleMesh()
+    parts = [part for part in parts if len(part['triangles'])]
+    if not parts:
+        return mesh
+    offsets = np.cumsum([0] + [len(part['vertices']) for part in parts[:-1]])
+    mesh.vertices = o3d.utility.Vector3dVector(np.concatenate([part['vertices'] for part in parts]))
+    mesh.triangles = o3d.utility.Vector3iVector(
+        np.concatenate([part['triangles'] + offset for part, offset in zip(parts, offsets)]).astype(np.int32))
+    if all('normals' in part for part in parts):
+        mesh.vertex_normals = o3d.utility.Vector3dVector(np.concatenate([part['normals'] for part in parts]))
+    if all('colors' in part for part in parts):
+        mesh.vertex_colors = o3d.utility.Vector3dVector(np.concatenate([part['colors'] for part in parts]))
+    mesh.remove_duplicated_vertices()
+    return mesh
+
+
+def stitch_points(parts):
+    pcd = o3d.geometry.PointCloud()
+    parts = [part for part in parts if len(part['points'])]
+    if not parts:
+        return pcd
+    pcd.points = o3d.utility.Vector3dVector(np.concatenate([part['points'] for part in parts]))
+    if all('normals' in part for part in parts):
+        pcd.normals = o3d.utility.Vector3dVector(np.concatenate([part['normals'] for part in parts]))
+    if all('colors' in part for part in parts):
+        pcd.colors = o3d.utility.Vector3dVector(np.concatenate([part['colors'] for part in parts]))
+    return pcd
+
+
+def init_worker(config, extrinsics, intrinsics):
+    """build the reconstruction of a tile worker with its own stream readers and color decoder"""
+    global _recons
+    # reconstruct imports this module
+    from reconstruction.scripts.reconstruct import Reconstruct
+    bridge = Bridge(config)
+    bridge.open_inputs()
+    _recons = Reconstruct(config, bridge)
+    _recons._extrinsics = extrinsics
+    _recons._intrinsics = intrinsics
+
+
+def integrate_tile(task):
+    """integrate the frames of a tile into its own volume and extract the surface within the tile
+
+    :param task: (tile coordinates, frame indices, block count)
+    :return: (tile coordinates, cropped mesh or None, cropped points or None, stage timers)
+    """
+    key, frame_indices, block_count = task
+    recons = _recons
+    parameters = recons.config.alg_param
+    cfg_tiled = parameters.integration.tiled
+    box_min = np.asarray(key) * cfg_tiled.tile_size
+    box_max = box_min + cfg_tiled.tile_size
+    recons._stage_timers = collections.defaultdict(float)
+
+    volume = recons.create_volume(block_count)
+    color_frames = None
+    if os.path.isfile(recons.config.input.depth_stream) and parameters.integration.with_color:
+        color_frames = recons.bridge.iter_colorframes([recons._frame_i_abs[i] for i in frame_indices])
+    frames = recons._iter_prepared_frames(frame_indices, color_frames)
+    try:
+        for i, frame in zip(frame_indices, frames):
+            if frame is None:
+                continue
+            abs_idx = recons._frame_i_abs[i]
+            depth, rgb, intrinsic, extrinsic = frame
+            depth = np.asarray(depth.as_tensor().cpu().numpy())
+            kept = clip_depth_to_box(depth, np.asarray(recons._intrinsics[abs_idx]),
+                                     np.asarray(recons._extrinsics[abs_idx]),
+                                     parameters.depth_thresh.scale, parameters.depth_thresh.max,
+                                     box_min - cfg_tiled.overlap, box_max + cfg_tiled.overlap,
+                                     parameters.integration.sdf_trunc)
+            if not kept:
+                continue
+            depth = o3d.t.geometry.Image(o3d.core.Tensor(depth)).to(recons.device)
+            recons._integrate_frame(volume, (depth, rgb, intrinsic, extrinsic))
+    finally:
+        frames.close()
+
+    mesh_part = None
+    points_part = None
+    volume = volume.cpu()
+    if recons.config.settings.extract_mesh:
+        mesh = volume.extract_surface_mesh(weight_threshold=parameters.extract.weight_threshold).to_legacy_triangle_mesh()
+        mesh_part = crop_mesh(mesh, box_min, box_max)
+    if recons.config.settings.extract_pcd:
+        pcd = volume.extract_surface_points().to_legacy_point_cloud()
+        points_part = crop_points(pcd, box_min, box_max)
+    return key, mesh_part, points_part, dict(recons._stage_timers)
+
+
+def integrate_tiled(recons, frame_indices):
+    """integrate frames tile by tile in worker processes
+
+    Workers are spawned rather than forked, the parent may run decoder and integration threads
+    that a forked child would inherit in an undefined state.
+
+    :param recons: Reconstruct with camera poses, integration volumes are created on its device
+    :param frame_indices: frames to integrate
+    :return: (stitched mesh or None, stitched point cloud or None)
+    """
+    parameters = recons.config.alg_param
+    cfg_integration = parameters.integration
+    cfg_tiled = cfg_integration.tiled
+    block_size = cfg_integration.voxel_len_fine * cfg_integration.block_resolution
+
+    start_time = time.time()
+    abs_indices = [recons._frame_i_abs[i] for i in frame_indices]
+    extrinsics = np.asarray(recons._extrinsics)[abs_indices]
+    intrinsics = np.asarray(recons._intrinsics)[abs_indices]
+    if recons.bridge is not None and 'depth_width' in recons.bridge.meta:
+        width, height = recons.bridge.meta['depth_width'], recons.bridge.meta['depth_height']
+    else:
+        width, height = 2.0 * intrinsics[0, 0, 2], 2.0 * intrinsics[0, 1, 2]
+    tiles = plan_tiles(extrinsics, intrinsics, width, height, parameters.depth_thresh.min,
+                       parameters.depth_thresh.max, cfg_tiled.tile_size, cfg_tiled.overlap, block_size)
+    num_routed = sum(len(frames) for frames in tiles.values())
+    log.info(f'Planned {len(tiles)} tiles of {cfg_tiled.tile_size}m in {time.time() - start_time:.2f}s, '
+             f'{num_routed / max(len(frame_indices), 1):.2f} tiles per frame')
+
+    # tile blocks with the overlap, the hash maps grow if more blocks are touched
+    tile_blocks = int(np.ceil((cfg_tiled.tile_size + 2 * cfg_tiled.overlap) / block_size)) ** 3
+    # integrate the tiles with most frames first
+    tasks = [(key, [frame_indices[i] for i in frames], tile_blocks)
+             for key, frames in sorted(tiles.items(), key=lambda item: -len(item[1]))]
+    processes = cfg_tiled.get('processes', 0) or len(os.sched_getaffinity(0))
+    processes = max(1, min(processes, len(tasks)))
+
+    start_time = time.time()
+    bar = Bar('Integration', max=len(tasks), suffix='%(percent)d%% - %(index)d-th tile integrated')
+    mesh_parts = []
+    points_parts = []
+    timers = collections.defaultdict(float)
+    initargs = (recons.config, np.asarray(recons._extrinsics), np.asarray(recons._intrinsics))
+    with multiprocessing.get_context('spawn').Pool(processes, initializer=init_worker, initargs=initargs) as pool:
+        for key, mesh_part, points_part, tile_timers in pool.imap_unordered(integrate_tile, tasks):
+            bar.next()
+            if mesh_part is not None:
+                mesh_parts.append(mesh_part)
+            if points_part is not None:
+                points_parts.append(points_part)
+            for name, value in tile_timers.items():
+                timers[name] += value
+    bar.finish()
+    log.info(f"Tiled integration of {len(frame_indices)} frames in {len(tasks)} tiles with {processes} processes "
+             f"took {time.time() - start_time:.2f}s: read {timers['read']:.2f}s, convert {timers['convert']:.2f}s, "
+             f"integrate {timers['integrate']:.2f}s summed over tiles")
+
+    mesh = stitch_meshes(mesh_parts) if recons.config.settings.extract_mesh else None
+    pcd = stitch_points(points_parts) if recons.config.settings.extract_pcd else None
+    return mesh, pcd
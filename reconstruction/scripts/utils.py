@@ -23,6 +23,23 @@ def align_color2depth(o3d_color, o3d_depth, fast=True):
         return o3d.geometry.Image(np.asarray(color))
     return o3d_color
 
+
+def nearest_indices(size_in, size_out):
+    # source pixels of a nearest neighbour resize along an axis, PIL accumulates the source coordinate
+    scale = size_in / size_out
+    coords = np.add.accumulate(np.concatenate([[scale * 0.5], np.full(size_out - 1, scale)]))
+    return np.minimum(coords.astype(np.int64), size_in - 1)
+
+
+def resize_nearest(frames, size):
+    """resize an (H, W, C) frame or a stack of (N, H, W, C) frames to size (width, height)
+
+    Gives the same pixels as the nearest neighbour resize of align_color2depth.
+    """
+    rows = nearest_indices(frames.shape[-3], size[1])
+    cols = nearest_indices(frames.shape[-2], size[0])
+    return frames[..., rows[:, None], cols, :]
+
 # convert intrinsic_depth.txt in ScanNet to Open3D format
 def intrinsic_txt2json(src_file, dst_file, width, height):
     if io.file_exist(src_file, '.txt'):
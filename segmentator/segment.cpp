@@ -10,9 +10,20 @@ Segmentator::Segmentator(TriMesh* trimesh, const bool face_based) {
   _face_based = face_based;
 }
 
+void Segmentator::build_graphs() {
+  graph_construct_with_normal(1.0);
+  _normal_graph = _graph;
+  graph_construct_with_color();
+  _graphs_built = true;
+}
+
 void Segmentator::segment(const float kthr, const int seg_min_size, const float color_weight,
                           const float c_kthr, const int c_seg_min_size) {
-  graph_construct_with_normal(1.0);
+  // the graphs only depend on the mesh, build them once for all thresholds
+  if (!_graphs_built)
+    build_graphs();
+  // segment_impl sorts the graph in place
+  _graph = _normal_graph;
   std::vector<int> indices;
   if (_face_based)
     indices.resize(_mesh->getFaceNum());
@@ -23,7 +34,7 @@ void Segmentator::segment(const float kthr, const int seg_min_size, const float
   _segm_coarse = segment_impl(_graph, indices, kthr, seg_min_size, _num_segm_coarse);
   _segm_fine = _segm_coarse;
 
-  graph_construct_with_color(color_weight);
+  apply_color_graph(color_weight);
 
   std::unordered_map<int, vector<int>> comp_vert_indices;
   for (int i = 0; i < _segm_fine.size(); i++) {
@@ -129,7 +140,16 @@ vec3f Segmentator::rgb2hsv(const vec3f &rgb) {
   return vec3f(h, s, v);
 }
 
-void Segmentator::graph_construct_with_color(const float weight) {
+void Segmentator::apply_color_graph(const float weight) {
+  // the color graph holds the color distance of each mesh edge, empty without vertex colors
+  for (int i = 0; i < _color_graph.size(); i++) {
+    _graph[i].a = _color_graph[i].a;
+    _graph[i].b = _color_graph[i].b;
+    _graph[i].w = (1.0 - weight) * _graph[i].w + weight * _color_graph[i].w;
+  }
+}
+
+void Segmentator::graph_construct_with_color() {
   // vector<edge>& edges = _half_edge->get_undirected_edges();
   vector<edge>& edges = _mesh->edges;
 
@@ -138,7 +158,8 @@ void Segmentator::graph_construct_with_color(const float weight) {
     std::cerr << "No color property exists in the mesh" << std::endl;
   else {
     //std::cout << "Constructing edge graph based on mesh connectivity..." << std::endl;
-    for (int i = 0; i < _graph.size(); i++) {
+    _color_graph.resize(edges.size());
+    for (int i = 0; i < _color_graph.size(); i++) {
       vec3f rgb1, rgb2;
 
       if (_face_based) {
@@ -146,8 +167,8 @@ void Segmentator::graph_construct_with_color(const float weight) {
         int f1 = he.f;
         int f2 = _half_edge->get_halfedge(he.opposite).f;
 
-        _graph[i].a = f1;
-        _graph[i].b = f2;
+        _color_graph[i].a = f1;
+        _color_graph[i].b = f2;
 
         int fbase = 3 * f1;
         uint32_t i1 = _mesh->faces[fbase];
@@ -173,8 +194,8 @@ void Segmentator::graph_construct_with_color(const float weight) {
         int a = edges[i].a;
         int b = edges[i].b;
 
-        _graph[i].a = a;
-        _graph[i].b = b;
+        _color_graph[i].a = a;
+        _color_graph[i].b = b;
 
         rgb1 = _mesh->colors[a];
         rgb2 = _mesh->colors[b];
@@ -195,7 +216,7 @@ void Segmentator::graph_construct_with_color(const float weight) {
       float ds = kds * sqrt(c1.y * c1.y + c2.y * c2.y - 2.0 * cos(theta) * c1.y * c2.y);
       dc = sqrt(dv * dv + ds * ds) / sqrt(kdv * kdv + kds * kds);
       dc = log2(1 + dc);
-      _graph[i].w = (1.0 - weight) * _graph[i].w + weight * dc;
+      _color_graph[i].w = dc;
     }
   }
   //std::cout << "Constructed graph" << std::endl;
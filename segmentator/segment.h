@@ -96,8 +96,10 @@ public:
 protected:
   universe *segment_graph(std::vector<int>& indices, std::vector<edge>& graph, const float c);
   vec3f rgb2hsv(const vec3f &rgb);
+  void build_graphs();
   void graph_construct_with_normal(const float weight);
-  void graph_construct_with_color(const float weight);
+  void graph_construct_with_color();
+  void apply_color_graph(const float weight);
   std::vector<int> segment_impl(std::vector<edge> &graph, std::vector<int> &indices, const float kthr, const int segMinVerts, size_t &num_sets);
 
 private:
@@ -106,6 +108,10 @@ private:
   bool _face_based;
 
   std::vector<edge> _graph;
+  // graphs of the mesh shared by the segmentations with different thresholds
+  bool _graphs_built = false;
+  std::vector<edge> _normal_graph;
+  std::vector<edge> _color_graph;
 
   size_t _num_segm_coarse;
   size_t _num_segm_fine;
@@ -85,31 +85,37 @@ void writeToJSON(const string &filename, const string &scanId,
   ofs.close();
 }
 
-void process(const std::string &meshFile, const float kthr, const int segMinVerts, const float colorWeight,
-             const float ckthr, const int cSegMinVerts, const string &scanID, const string &outputFile, const bool face_based) {
+void process(const std::string &meshFile, const vector<float> &kthrs, const int segMinVerts, const float colorWeight,
+             const vector<float> &ckthrs, const int cSegMinVerts, const string &scanID,
+             const vector<string> &outputFiles, const bool face_based) {
   // import mesh from file
   TriMesh *mesh = new TriMesh(meshFile);
 
+  // the mesh and its graphs are shared by the segmentations of all thresholds
   Segmentator* segmentator = new Segmentator(mesh, face_based);
-  segmentator->segment(kthr, segMinVerts, colorWeight, ckthr, cSegMinVerts);
-
-  size_t num_segm_coarse = segmentator->get_num_segm_coarse();
-  size_t num_segm_fine = segmentator->get_num_segm_fine();
-  std::vector<int> segm_coarse = segmentator->get_segm_coarse();
-  std::vector<int> segm_fine = segmentator->get_segm_fine();
+  const string baseName = meshFile.substr(0, meshFile.find_last_of("."));
+  for (size_t i = 0; i < kthrs.size(); i++) {
+    const float kthr = kthrs[i];
+    const float ckthr = ckthrs[i];
+    segmentator->segment(kthr, segMinVerts, colorWeight, ckthr, cSegMinVerts);
+
+    size_t num_segm_coarse = segmentator->get_num_segm_coarse();
+    size_t num_segm_fine = segmentator->get_num_segm_fine();
+    std::vector<int> segm_coarse = segmentator->get_segm_coarse();
+    std::vector<int> segm_fine = segmentator->get_segm_fine();
+
+    // output segmentation result to a json file
+    string segFile = baseName + "." + std::to_string(kthr) + ".segs.json";
+    if (i < outputFiles.size() && !outputFiles[i].empty())
+      segFile = outputFiles[i];
+    writeToJSON(segFile, scanID, kthr, segMinVerts, colorWeight, ckthr, cSegMinVerts, segm_coarse, segm_fine, face_based);
+    printf("Segmentation written to %s with %lu segments with normals and %lu segments with added colors\n",
+           segFile.c_str(), num_segm_coarse, num_segm_fine);
+  }
 
   // deconstruct triangle mesh instance
   delete segmentator;
   delete mesh;
-  // output segmentation result to a json file
-  const string baseName = meshFile.substr(0, meshFile.find_last_of("."));
-  const int lastslash = meshFile.find_last_of("/");
-  string segFile = baseName + "." + std::to_string(kthr) + ".segs.json";
-  if (!outputFile.empty())
-    segFile = outputFile;
-  writeToJSON(segFile, scanID, kthr, segMinVerts, colorWeight, ckthr, cSegMinVerts, segm_coarse, segm_fine, face_based);
-  printf("Segmentation written to %s with %lu segments with normals and %lu segments with added colors\n",
-         segFile.c_str(), num_segm_coarse, num_segm_fine);
 }
 
 int main(int argc, const char **argv) {
@@ -122,6 +128,9 @@ int main(int argc, const char **argv) {
     int cSegMinVerts;
     string scanID;
     string outputFile;
+    vector<float> kthrs;
+    vector<float> ckthrs;
+    vector<string> outputFiles;
     bool face_based = false;
 
     po::options_description desc("Segmentator options");
@@ -136,7 +145,13 @@ int main(int argc, const char **argv) {
         ("colorSegMinVerts", po::value<int>(&cSegMinVerts)->default_value(20),
          "set minimum segment size in second stage")
         ("scanID", po::value<string>(&scanID)->default_value("default"), "set the scan ID in the output json file")
-        ("output", po::value<string>(&outputFile)->default_value(""), "set the filepath of the output json file");
+        ("output", po::value<string>(&outputFile)->default_value(""), "set the filepath of the output json file")
+        ("kThreshList", po::value<vector<float>>(&kthrs)->multitoken(),
+         "set k thresholds, segments the mesh once per threshold instead of kThresh")
+        ("colorKThreshList", po::value<vector<float>>(&ckthrs)->multitoken(),
+         "set k thresholds in second stage, one per k threshold of kThreshList")
+        ("outputList", po::value<vector<string>>(&outputFiles)->multitoken(),
+         "set the filepaths of the output json files, one per k threshold of kThreshList");
 
     po::variables_map vm;
     po::store(po::parse_command_line(argc, argv, desc), vm);
@@ -156,8 +171,22 @@ int main(int argc, const char **argv) {
       }
     }
 
-    if (vm.count("output")) {
-      const string extension = outputFile.substr(outputFile.find_last_of(".")+1);
+    if (kthrs.empty()) {
+      kthrs.push_back(kthr);
+      ckthrs.push_back(ckthr);
+      outputFiles.push_back(outputFile);
+    } else if (ckthrs.size() != kthrs.size()) {
+      std::cerr << "colorKThreshList should have one threshold per k threshold of kThreshList" << std::endl;
+      return 1;
+    } else if (!outputFiles.empty() && outputFiles.size() != kthrs.size()) {
+      std::cerr << "outputList should have one file per k threshold of kThreshList" << std::endl;
+      return 1;
+    }
+
+    for (const string &file : outputFiles) {
+      if (file.empty())
+        continue;
+      const string extension = file.substr(file.find_last_of(".")+1);
       if (extension != "json") {
         std::cerr << "Output file should be in json format" << std::endl;
         return 1;
@@ -169,11 +198,12 @@ int main(int argc, const char **argv) {
     else
       printf("Segmenting based on vertices\n");
 
-    printf("Segmenting %s with kThresh=%f, segMinVerts=%d, colorWeight=%f, colorKThresh=%f, colorSegMinVerts=%d, ...\n",
-           meshFile.c_str(), kthr,
-           segMinVerts, colorWeight, ckthr, cSegMinVerts);
+    for (size_t i = 0; i < kthrs.size(); i++)
+      printf("Segmenting %s with kThresh=%f, segMinVerts=%d, colorWeight=%f, colorKThresh=%f, colorSegMinVerts=%d, ...\n",
+             meshFile.c_str(), kthrs[i],
+             segMinVerts, colorWeight, ckthrs[i], cSegMinVerts);
 
-    process(meshFile, kthr, segMinVerts, colorWeight, ckthr, cSegMinVerts, scanID, outputFile, face_based);
+    process(meshFile, kthrs, segMinVerts, colorWeight, ckthrs, cSegMinVerts, scanID, outputFiles, face_based);
   } catch (const std::exception &e) {
     std::string error_msg = std::string("Caught a fatal error: ") + std::string(e.what());
 #if defined(_WIN32)
@@ -1,11 +1,12 @@
 #!/usr/bin/env python
 #
-# Compute times from process.log
+# Compute times from process.log, or resource usage from process_metrics.jsonl when available
 # May need pip install pytimeparse
 
 import argparse
 import collections
 import csv
+import json
 import logging
 import os
 import re
@@ -15,12 +16,21 @@ import traceback
 from datetime import timedelta
 
 import pytimeparse
+from omegaconf import OmegaConf
 
 FORMAT = '%(asctime)-15s [%(levelname)s] %(message)s'
 logging.basicConfig(format=FORMAT)
 log = logging.getLogger('computeTimings')
 log.setLevel(logging.INFO)
 
+metricFields = ['user_time', 'sys_time', 'max_rss', 'read_bytes', 'write_bytes', 'returncode']
+configFile = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'config', 'config.yaml')
+
+
+def getMetricsFilename():
+    # name of the per-scan metrics file written by scan_processor
+    return OmegaConf.load(configFile).process.metrics_file
+
 
 def getTotal(times):
     secs = 0
@@ -76,6 +86,32 @@ def computeTimings(input):
     return times
 
 
+def computeMetrics(input):
+    # structured resource usage records written by io.call
+    times = collections.OrderedDict()
+    try:
+        with open(input) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                record = json.loads(line)
+                cmdname = record.get('desc')
+                if cmdname is None:
+                    continue
+                secs = record.get('wall_time', 0)
+                row = {'name': cmdname, 'time': str(timedelta(seconds=secs)), 'secs': secs}
+                for key in metricFields:
+                    if key in record:
+                        row[key] = record[key]
+                times[cmdname] = row
+    except:
+        log.warning('Error extracting metrics from %s', input)
+        traceback.print_exc()
+        return None
+    return times
+
+
 def saveCsv(fieldnames, data, csvfile):
     writer = csv.DictWriter(csvfile, fieldnames=fieldnames, extrasaction='ignore')
     writer.writeheader()
@@ -85,9 +121,13 @@ def saveCsv(fieldnames, data, csvfile):
 
 def computeAndOutputTimings(args):
     input = args.get('inputfile')
-    times = computeTimings(input)
+    fieldnames = ['name', 'time', 'secs']
+    if args.get('metricsfile'):
+        times = computeMetrics(args.get('metricsfile'))
+        fieldnames += metricFields
+    else:
+        times = computeTimings(input)
     if times is not None:
-        fieldnames = ['name', 'time', 'secs']
         if args.get('output'):
             with open(args.get('output'), 'w') as outfile:
                 saveCsv(fieldnames, times, outfile)
@@ -102,10 +142,17 @@ def main():
     parser = argparse.ArgumentParser(description='Compute timings for processing of a scan')
     parser.add_argument('input', help='Input directory or log')
     parser.add_argument('output', nargs='?')
+    parser.add_argument('--metrics_file', default=None,
+                        help='Metrics file name in the input directory, process.metrics_file of the config by default')
 
     args = parser.parse_args()
     if os.path.isdir(args.input):
         args.inputfile = os.path.join(args.input, 'process.log')
+        metricsfile = os.path.join(args.input, args.metrics_file or getMetricsFilename())
+        if os.path.isfile(metricsfile):
+            args.metricsfile = metricsfile
+    elif os.path.isfile(args.input) and args.input.endswith('.jsonl'):
+        args.metricsfile = args.input
     elif os.path.isfile(args.input):
         args.inputfile = args.input
     else:
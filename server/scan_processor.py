@@ -10,6 +10,7 @@ import re
 import shutil
 import traceback
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 from PIL import Image
 
@@ -18,6 +19,8 @@ from hydra.utils import get_original_cwd
 from omegaconf import DictConfig, OmegaConf
 
 from multiscan.utils import io
+from multiscan.utils.pool import MemoryAwarePool, GB, is_oom_record
+from multiscan.utils.scheduler import StageScheduler
 from multiscan.meshproc import TriMesh
 import util
 from util import ProcessStage, TexturingMethod
@@ -64,7 +67,7 @@ def decode_depth(cfg):
 
             env = os.environ.copy()
             env['PYTHONPATH'] = ":".join(cfg.process.scripts_path)
-            ret = io.call(['python', 'depth_decode.py',
+            cmd = ['python', 'depth_decode.py',
                         '-in', depth_stream, 
                         '-in_confi', confidence_stream,
                         '-o', depth_out,
@@ -77,7 +80,15 @@ def decode_depth(cfg):
                         '--pixel_size', str(cfg.process.decode.pixel_size),
                         '--unit', depth_unit,
                         '--format', cfg.process.decode.depth_format,
-                        ], log, cfg.process.scripts_path, env=env, cpu_num=cfg.process.decode.cpus)
+                        '--cpus', str(cfg.process.decode.cpus),
+                        '--batch_size', str(cfg.process.decode.get('batch_size', 0)),
+                        ]
+            if cfg.process.decode.get('random_access', False):
+                cmd.append('--random_access')
+            elif cfg.process.decode.get('stream', False):
+                cmd.append('--stream')
+            ret = io.call(cmd, log, cfg.process.scripts_path, env=env, desc='decode depth stream',
+                        cpu_num=cfg.process.decode.cpus)
                 
         log.info(f'Decoding depth stream is ended, return code {ret}')
         return ret
@@ -97,57 +108,122 @@ def decode(cfg):
             log.error('Scan at %s aborted: decode depth stream failed' % cfg.process.scan_dir)
             return ret
 
-        color_frames = io.get_file_list(cfg.process.color_dir, '.png')
-        depth_frames = io.get_file_list(cfg.process.depth_dir, cfg.process.decode.depth_format)
-        if len(color_frames) == 0:
-            log.error('Scan at %s aborted: no decoded color images (convert failed)' % cfg.process.scan_dir)
-            return ret
-        if len(depth_frames) == 0:
-            log.error('Scan at %s aborted: no decoded depth images (convert failed)' % cfg.process.scan_dir)
-            return ret
+        if not check_decoded_frames(cfg):
+            return 1
         return ret
     except Exception as e:
         log.error(traceback.format_exc())
         raise e
 
 
-def mesh_segmentation(cfg, mesh_file):
+def check_decoded_frames(cfg):
+    # whether both streams were decoded to frames
+    color_frames = io.get_file_list(cfg.process.color_dir, '.png')
+    depth_frames = io.get_file_list(cfg.process.depth_dir, cfg.process.decode.depth_format)
+    if len(color_frames) == 0:
+        log.error('Scan at %s aborted: no decoded color images (convert failed)' % cfg.process.scan_dir)
+        return False
+    if len(depth_frames) == 0:
+        log.error('Scan at %s aborted: no decoded depth images (convert failed)' % cfg.process.scan_dir)
+        return False
+    return True
+
+
+def validate_decode(cfg):
+    # the scheduler runs this step only when decode_color and decode_depth returned 0,
+    # raising skips the steps reading the frames, as process_preliminary stops when decode() fails
+    if not check_decoded_frames(cfg):
+        raise RuntimeError('no decoded frames')
+    return 0
+
+
+def segmentator_command(cfg, mesh_file, kthresh_list, color_kthresh_list, segs_files):
+    face_based = '--face_based' if cfg.process.segmentation.face_based else ''
+    cmd = ['./segmentator',
+           '--input', mesh_file,
+           face_based,
+           '--segMinVerts', str(cfg.process.segmentation.seg_min_verts),
+           '--colorWeight', str(cfg.process.segmentation.color_weight),
+           '--colorSegMinVerts', str(cfg.process.segmentation.color_seg_min_verts),
+           '--scanID', cfg.process.scan_name,
+           ]
+    if len(kthresh_list) == 1:
+        cmd += ['--kThresh', str(kthresh_list[0]),
+                '--colorKThresh', str(color_kthresh_list[0]),
+                '--output', segs_files[0]]
+    else:
+        # a single run loads the mesh and builds its graphs once for all thresholds
+        cmd += ['--kThreshList'] + [str(kthresh) for kthresh in kthresh_list]
+        cmd += ['--colorKThreshList'] + [str(kthresh) for kthresh in color_kthresh_list]
+        cmd += ['--outputList'] + segs_files
+    return cmd
+
+
+def render_segmentations(cfg, mesh_file, segs_files):
+    # create visualize result of the segmentations with a single segm_viz run
+    segs_files = [segs_file for segs_file in segs_files if io.is_non_zero_file(segs_file)]
+    if not segs_files or not cfg.process.segmentation.render:
+        return 0
+    log.info(f'Start creating visualization images of {len(segs_files)} segmentations')
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = ":".join(cfg.process.scripts_path)
+    return io.call(['python', 'segm_viz.py',
+                    '-i', mesh_file,
+                    '-segs'] + segs_files + [
+                    '-o', os.path.dirname(segs_files[0]),
+                    '--output_mesh',
+                    '--width', str(cfg.process.segmentation.render_res[0]),
+                    '--height', str(cfg.process.segmentation.render_res[1]),
+                    ], log, cfg.process.scripts_path, env=env)
+
+
+def segmentation_files(cfg, mesh_file, indices=None):
+    # segmentation result files of the thresholds at indices, all thresholds if None
+    output_dir = os.path.join(os.path.dirname(mesh_file), cfg.process.segmentation.result_folder)
+    basename = os.path.basename(mesh_file)
+    kthresh_list = OmegaConf.to_object(cfg.process.segmentation.kthesh)
+    return [os.path.join(output_dir, os.path.splitext(basename)[0] + (cfg.process.segmentation.segs_ext % kthresh_list[i]))
+            for i in range(len(kthresh_list)) if indices is None or i in indices]
+
+
+def mesh_segmentation(cfg, mesh_file, indices=None, render=True):
+    # indices of the thresholds to segment with, all thresholds if None
     ret = 0
     try:
         if io.is_non_zero_file(mesh_file):
             output_dir = os.path.join(os.path.dirname(mesh_file), cfg.process.segmentation.result_folder)
             io.ensure_dir_exists(output_dir)
-            basename = os.path.basename(mesh_file)
             log.info(f'Start mesh segmentation with segmentator')
             kthresh_list = OmegaConf.to_object(cfg.process.segmentation.kthesh)
-            for i, kthresh in enumerate(kthresh_list):
-                segs_file = os.path.join(output_dir, os.path.splitext(basename)[0] + (cfg.process.segmentation.segs_ext % kthresh))
-                face_based = '--face_based' if cfg.process.segmentation.face_based else ''
-                ret = io.call(['./segmentator', 
-                                '--input', mesh_file,
-                                face_based,
-                                '--kThresh', str(kthresh),
-                                '--segMinVerts', str(cfg.process.segmentation.seg_min_verts),
-                                '--colorWeight', str(cfg.process.segmentation.color_weight),
-                                '--colorKThresh', str(cfg.process.segmentation.color_kthesh[i]),
-                                '--colorSegMinVerts', str(cfg.process.segmentation.color_seg_min_verts),
-                                '--scanID', cfg.process.scan_name,
-                                '--output', segs_file,
-                                ], log, cfg.process.segmentation.bin_path)
-                # create visualize result of the segmentation
-                if io.is_non_zero_file(segs_file) and cfg.process.segmentation.render:
-                    log.info(f'Start creating visualization image of the segmentation')
-                    
-                    env = os.environ.copy()
-                    env['PYTHONPATH'] = ":".join(cfg.process.scripts_path)
-                    ret = io.call(['python', 'segm_viz.py', 
-                                '-i', mesh_file,
-                                '-segs', segs_file,
-                                '-o', os.path.dirname(segs_file),
-                                '--output_mesh',
-                                '--width', str(cfg.process.segmentation.render_res[0]),
-                                '--height', str(cfg.process.segmentation.render_res[1]),
-                                ], log, cfg.process.scripts_path, env=env)
+            color_kthresh_list = OmegaConf.to_object(cfg.process.segmentation.color_kthesh)
+            selected = [i for i in range(len(kthresh_list)) if indices is None or i in indices]
+            segs_files = segmentation_files(cfg, mesh_file, indices)
+
+            def segment_thresholds(positions):
+                kthreshs = [kthresh_list[selected[j]] for j in positions]
+                # metrics records are keyed by desc, one record per threshold
+                desc = 'segmentation ' + ','.join(str(kthresh) for kthresh in kthreshs)
+                return io.call(segmentator_command(cfg, mesh_file, kthreshs,
+                                                   [color_kthresh_list[selected[j]] for j in positions],
+                                                   [segs_files[j] for j in positions]),
+                               log, cfg.process.segmentation.bin_path, desc=desc,
+                               cpu_num=cfg.process.segmentation.cpus)
+
+            mode = cfg.process.segmentation.get('mode', 'serial')
+            if mode == 'batch' and selected:
+                ret = segment_thresholds(range(len(selected)))
+            elif mode == 'concurrent' and len(selected) > 1:
+                # io.call reserves the cores of each run, runs wait for free cores
+                workers = max(1, len(os.sched_getaffinity(0)) // max(1, cfg.process.segmentation.cpus))
+                with ThreadPoolExecutor(min(workers, len(selected))) as executor:
+                    for result in executor.map(lambda j: segment_thresholds([j]), range(len(selected))):
+                        ret |= result
+            else:
+                for j in range(len(selected)):
+                    ret = segment_thresholds([j])
+            if render:
+                ret |= render_segmentations(cfg, mesh_file, segs_files)
         log.info(f'Mesh segmentation is ended, return code {ret}')
         return ret
     except Exception as e:
@@ -208,7 +284,7 @@ def mvs_texturing(cfg):
                            f'--waste_ratio={cfg.process.texturing.waste_ratio}',
                            keep_unseen_faces, cfg.process.color_dir, decimated_mesh_path, 
                            output_mesh_basename],
-                           log, cfg.process.texturing.msv_bin_path, cpu_num=cfg.process.texturing.cpus)
+                           log, cfg.process.texturing.msv_bin_path, desc='texturing', cpu_num=cfg.process.texturing.cpus)
 
             TriMesh.transfer_color_texture_to_vertex(output_mesh_basename+'.obj', os.path.splitext(decimated_mesh_path)[0]+'_colored.ply')
         return ret
@@ -341,83 +417,181 @@ def process_scan_dir(path, name, config, proc=ProcessStage.PRELIMINARY):
     fh.setLevel(logging.INFO)
     fh.setFormatter(formatter)
     log.addHandler(fh)
+    # resource usage of every external command is appended to the per-scan metrics file
+    io.set_metrics_file(os.path.join(path, config.process.metrics_file))
     msg = ''
     try:
         msg = process_scan_dir_basic(path, name, config, proc)
         log.info(msg)
     finally:
+        io.set_metrics_file(None)
         log.removeHandler(fh)
         fh.close()
     return msg
 
 
+def make_thumbnails(config):
+    # create thumbnails from uploaded video
+    ret = io.call([config.process.thumbnail.mp42thumbnail_bin,
+                   config.process.output_dir, str(config.process.thumbnail.thumbnail_width)],
+                  log, desc='mp4-to-thumbnail')
+    ret |= io.call([config.process.thumbnail.mp42preview_bin,
+                    config.process.output_dir, str(config.process.thumbnail.preview_width)],
+                   log, desc='mp4-to-preview')
+    return ret
+
+
+def reconstruct(config):
+    # Open3D Reconstruction
+    log.info(f'Start processing using open3d integration')
+
+    env = os.environ.copy()
+    env['PYTHONPATH'] = ":".join(config.process.reconstruction_path)
+    return io.call(['python', 'main.py',
+                    '--config-path', os.path.join(config.dump_cfg_path, '.hydra'),
+                    f'reconstruction.input.color_stream={config.process.color_dir}',
+                    f'reconstruction.input.depth_stream={config.process.depth_dir}',
+                    f'reconstruction.input.metadata_file={config.process.meta_file}',
+                    f'reconstruction.input.trajectory_file={config.process.camera_file}',
+                    f'reconstruction.output.save_folder={config.process.output_dir}',
+                    f'reconstruction.output.mesh_filename={config.process.mesh_filename}',
+                    f'reconstruction.output.decimated_mesh_filename={config.process.decimated_mesh_filename}',
+                    f'reconstruction.output.mesh_alignment_filename={config.process.mesh_alignment_filename}',
+                    ], log, config.process.reconstruction_path, env=env, desc='recons',
+                   cpu_num=config.reconstruction.settings.cpu_num)
+
+
+def render_thumbnails(config, mesh_file, thumb_ext, thumb2_ext, paint_uniform_color=False):
+    ret = 0
+    thumb_path = os.path.join(config.process.output_dir, config.process.scan_name + thumb_ext)
+    # higher resolution
+    thumb2_path = os.path.join(config.process.output_dir, config.process.scan_name + thumb2_ext)
+    if io.is_non_zero_file(mesh_file):
+        log.info(f'Start creating rendered mesh thumbnail image')
+        env = os.environ.copy()
+        env['PYTHONPATH'] = ":".join(config.process.scripts_path)
+        uniform_color = ['--paint_uniform_color'] if paint_uniform_color else []
+        ret = io.call(['python', 'render.py',
+                       '-i', mesh_file,
+                       '-o', thumb_path,
+                       '--width', str(config.process.render.low_res[0]),
+                       '--height', str(config.process.render.low_res[1]),
+                       ] + uniform_color, log, config.process.scripts_path, env=env)
+
+        ret = io.call(['python', 'render.py',
+                       '-i', mesh_file,
+                       '-o', thumb2_path,
+                       '--width', str(config.process.render.high_res[0]),
+                       '--height', str(config.process.render.high_res[1]),
+                       ] + uniform_color, log, config.process.scripts_path, env=env)
+    return ret
+
+
+def render_ply(config):
+    # render decimated mesh
+    mesh_file = os.path.join(config.process.output_dir, config.process.decimated_mesh_filename)
+    return render_thumbnails(config, mesh_file, config.process.render.low_res_ply,
+                             config.process.render.high_res_ply, paint_uniform_color=True)
+
+
+def render_obj(config):
+    # render textured mesh
+    obj_mesh_filename = config.process.texturing.mesh_name % config.process.scan_name + '.obj'
+    mesh_file = os.path.join(config.process.textured_mesh_dir, obj_mesh_filename)
+    return render_thumbnails(config, mesh_file, config.process.render.low_res_obj,
+                             config.process.render.high_res_obj)
+
+
+def texture(config):
+    # Texturing reconstructed mesh
+    ret = mvs_texturing(config)
+    resize_atlas(config)
+    return ret
+
+
+def resize_atlas(config):
+    mesh_name = config.process.texturing.mesh_name % config.process.scan_name
+    atlas_downscale(config, mesh_name + '.obj', mesh_name + '_material*.png')
+    return 0
+
+
+def colored_mesh_file(config):
+    decimated_mesh_path = os.path.join(config.process.output_dir, config.process.decimated_mesh_filename)
+    return os.path.splitext(decimated_mesh_path)[0]+'_colored.ply'
+
+
+def segment(config, indices=None, render=True):
+    # textured mesh segmentation
+    return mesh_segmentation(config, colored_mesh_file(config), indices, render)
+
+
+def render_segments(config):
+    # visualize the segmentations of all thresholds
+    textured_mesh_file = colored_mesh_file(config)
+    return render_segmentations(config, textured_mesh_file, segmentation_files(config, textured_mesh_file))
+
+
+def clean(config):
+    # clean temporary files and dirs
+    if os.path.exists(config.process.color_dir):
+        shutil.rmtree(config.process.color_dir)
+    if os.path.exists(config.process.depth_dir):
+        shutil.rmtree(config.process.depth_dir)
+
+    # remove tmp uncompressed files
+    all_files = glob(config.process.output_dir + '/*')
+    file_pattern = re.compile(r'.*{}\.(depth|confidence)\.zlib.+'.format(config.process.scan_name))
+    matched_files = [fi for fi in all_files if file_pattern.match(fi)]
+    for tmp_file in matched_files:
+        # double check
+        if os.path.basename(tmp_file) != os.path.basename(config.process.confidence_stream) \
+                and os.path.basename(tmp_file) != os.path.basename(config.process.confidence_stream):
+            os.remove(tmp_file)
+    return 0
+
+
+# functions of the steps in process.steps, called with the config
+STEP_FUNCTIONS = {
+    'thumbnail': make_thumbnails,
+    'decode_color': decode_color,
+    'decode_depth': decode_depth,
+    'validate_decode': validate_decode,
+    'recons': reconstruct,
+    'render_ply': render_ply,
+    'texturing': texture,
+    'atlasresize': resize_atlas,
+    'segmentation': segment,
+    'render_segs': render_segments,
+    'render_obj': render_obj,
+    'alignpairs': pairwise_align,
+    'clean': clean,
+}
+
+
 def process_preliminary(config, validate):
     ret = 0
     try:
-        # create thumbnails from uploaded video
         if config.get('thumbnail') and (config.get('overwrite') or validate.get('thumbnail') != 'true'):
-            ret |= io.call([config.process.thumbnail.mp42thumbnail_bin,
-                        config.process.output_dir, str(config.process.thumbnail.thumbnail_width)],
-                        log, desc='mp4-to-thumbnail')
-            ret |= io.call([config.process.thumbnail.mp42preview_bin,
-                            config.process.output_dir, str(config.process.thumbnail.preview_width)],
-                            log, desc='mp4-to-preview')
+            ret |= make_thumbnails(config)
         else:
             log.info('skipping thumbnails')
 
         # Decode video to frames
         if config.get('convert') and (config.get('overwrite') or validate.get('convert') != 'true'):
-            ret |= decode(config)
+            decode_ret = decode(config)
+            if decode_ret != 0:
+                # later steps read the decoded frames
+                return ret | decode_ret
         else:
             log.info('skipping convert')
         
-        # Open3D Reconstruction
         if config.get('recons') and (config.get('overwrite') or validate.get('recons') != 'true'):
-            log.info(f'Start processing using open3d integration')
-
-            env = os.environ.copy()
-            env['PYTHONPATH'] = ":".join(config.process.reconstruction_path)
-            ret = io.call(['python', 'main.py',
-                        '--config-path', os.path.join(config.dump_cfg_path, '.hydra'),
-                        f'reconstruction.input.color_stream={config.process.color_dir}',
-                        f'reconstruction.input.depth_stream={config.process.depth_dir}',
-                        f'reconstruction.input.metadata_file={config.process.meta_file}',
-                        f'reconstruction.input.trajectory_file={config.process.camera_file}',
-                        f'reconstruction.output.save_folder={config.process.output_dir}',
-                        f'reconstruction.output.mesh_filename={config.process.mesh_filename}',
-                        f'reconstruction.output.decimated_mesh_filename={config.process.decimated_mesh_filename}',
-                        f'reconstruction.output.mesh_alignment_filename={config.process.mesh_alignment_filename}',
-                        ], log, config.process.reconstruction_path, env=env, cpu_num=config.reconstruction.settings.cpu_num)
+            ret = reconstruct(config)
         else:
             log.info('skipping reconstruction')
 
-        # render decimated mesh
         if config.get('render') and (config.get('overwrite') or validate.get('render') != 'true'):
-            thumb_ext = config.process.render.low_res_ply
-            thumb2_ext = config.process.render.high_res_ply
-            mesh_file = os.path.join(config.process.output_dir, config.process.decimated_mesh_filename)
-            thumb_path = os.path.join(config.process.output_dir, config.process.scan_name + thumb_ext)
-            # higher resolution
-            thumb2_path = os.path.join(config.process.output_dir, config.process.scan_name + thumb2_ext)
-            if io.is_non_zero_file(mesh_file):
-                log.info(f'Start creating rendered mesh thumbnail image')
-                env = os.environ.copy()
-                env['PYTHONPATH'] = ":".join(config.process.scripts_path)
-                ret = io.call(['python', 'render.py',
-                            '-i', mesh_file,
-                            '-o', thumb_path,
-                            '--width', str(config.process.render.low_res[0]),
-                            '--height', str(config.process.render.low_res[1]),
-                            '--paint_uniform_color',
-                            ], log, config.process.scripts_path, env=env)
-
-                ret = io.call(['python', 'render.py',
-                            '-i', mesh_file,
-                            '-o', thumb2_path,
-                            '--width', str(config.process.render.high_res[0]),
-                            '--height', str(config.process.render.high_res[1]),
-                            '--paint_uniform_color',
-                            ], log, config.process.scripts_path, env=env)
+            ret = render_ply(config)
         else:
             log.info('skipping render textured mesh')
 
@@ -431,54 +605,23 @@ def process_preliminary(config, validate):
 def process_extra(config, validate):
     ret = 0
     try:
-        # Texturing reconstructed mesh
         if config.get('texturing') and (config.get('overwrite') or validate.get('texturing') != 'true'):
-            ret |= mvs_texturing(config)
-            mesh_name = config.process.texturing.mesh_name % config.process.scan_name
-            atlas_downscale(config, mesh_name + '.obj', mesh_name + '_material*.png')
+            ret |= texture(config)
         else:
             log.info('skipping texturing')
 
         if config.get('atlasresize'):
-            mesh_name = config.process.texturing.mesh_name % config.process.scan_name
-            atlas_downscale(config, mesh_name + '.obj', mesh_name + '_material*.png')
+            resize_atlas(config)
         else:
             log.info('skipping texturing')
 
-        # textured mesh segmentation
         if config.get('segmentation') and (config.get('overwrite') or validate.get('segmentation') != 'true'):
-            decimated_mesh_path = os.path.join(config.process.output_dir, config.process.decimated_mesh_filename)
-            textured_mesh_file = os.path.splitext(decimated_mesh_path)[0]+'_colored.ply'
-            ret |= mesh_segmentation(config, textured_mesh_file)
+            ret |= segment(config)
         else:
             log.info('skipping textured mesh segmentation')
         
-        # render textured mesh
         if config.get('render') and (config.get('overwrite') or validate.get('render') != 'true'):
-            thumb_ext = config.process.render.low_res_obj
-            thumb2_ext = config.process.render.high_res_obj
-            obj_mesh_filename = config.process.texturing.mesh_name % config.process.scan_name + '.obj'
-            mesh_file = os.path.join(config.process.textured_mesh_dir, obj_mesh_filename)
-            thumb_path = os.path.join(config.process.output_dir, config.process.scan_name + thumb_ext)
-            # higher resolution
-            thumb2_path = os.path.join(config.process.output_dir, config.process.scan_name + thumb2_ext)
-            if io.is_non_zero_file(mesh_file):
-                log.info(f'Start creating rendered mesh thumbnail image')
-                env = os.environ.copy()
-                env['PYTHONPATH'] = ":".join(config.process.scripts_path)
-                ret = io.call(['python', 'render.py',
-                            '-i', mesh_file,
-                            '-o', thumb_path,
-                            '--width', str(config.process.render.low_res[0]),
-                            '--height', str(config.process.render.low_res[1]),
-                            ], log, config.process.scripts_path, env=env)
-
-                ret = io.call(['python', 'render.py',
-                            '-i', mesh_file,
-                            '-o', thumb2_path,
-                            '--width', str(config.process.render.high_res[0]),
-                            '--height', str(config.process.render.high_res[1]),
-                            ], log, config.process.scripts_path, env=env)
+            ret = render_obj(config)
         else:
             log.info('skipping render textured mesh')
 
@@ -488,22 +631,8 @@ def process_extra(config, validate):
         else:
             log.info('skipping align pairs')
 
-        # clean temporary files and dirs
         if config.get('clean'):
-            if os.path.exists(config.process.color_dir):
-                shutil.rmtree(config.process.color_dir)
-            if os.path.exists(config.process.depth_dir):
-                shutil.rmtree(config.process.depth_dir)
-
-            # remove tmp uncompressed files
-            all_files = glob(config.process.output_dir + '/*')
-            file_pattern = re.compile(r'.*{}\.(depth|confidence)\.zlib.+'.format(config.process.scan_name))
-            matched_files = [fi for fi in all_files if file_pattern.match(fi)]
-            for tmp_file in matched_files:
-                # double check
-                if os.path.basename(tmp_file) != os.path.basename(config.process.confidence_stream) \
-                        and os.path.basename(tmp_file) != os.path.basename(config.process.confidence_stream):
-                    os.remove(tmp_file)
+            clean(config)
         else:
             log.info('skipping clean')
     except Exception as e:
@@ -512,6 +641,48 @@ def process_extra(config, validate):
 
     return ret
 
+
+def process_steps(config, validate, proc_type):
+    # run the steps of a processing stage as a dependency graph, independent steps run concurrently
+    stage = 'preliminary' if proc_type == ProcessStage.PRELIMINARY else 'extra'
+    cfg_scheduler = config.process.scheduler
+    scheduler = StageScheduler(cpus=cfg_scheduler.get('cpus', 0), fraction=cfg_scheduler.get('memory_fraction', 0.8))
+    for step in config.process.steps:
+        if step.stage != stage:
+            continue
+        action = step.action
+        if not config.get(action) or (not config.get('overwrite') and validate.get(action) == 'true'):
+            log.info(f'skipping {step.name}')
+            continue
+        kwargs = {
+            'inputs': list(step.get('inputs', [])),
+            'outputs': list(step.get('outputs', [])),
+            'after': list(step.get('after', [])),
+            'cpus': step.get('cpus', 1),
+            'mem': estimate_memory(config, config.process.scan_dir, action),
+            'strict': step.get('strict', False),
+        }
+        if step.name == 'segmentation':
+            # the render_segs step renders the segmentations of all thresholds at once
+            if config.process.segmentation.get('mode', 'serial') == 'batch':
+                scheduler.add(step.name, segment, config, None, False, **kwargs)
+            else:
+                # the segmentation of each threshold is independent
+                kthresh_list = OmegaConf.to_object(config.process.segmentation.kthesh)
+                for i, kthresh in enumerate(kthresh_list):
+                    scheduler.add(f'segmentation {kthresh}', segment, config, [i], False, **kwargs)
+        else:
+            scheduler.add(step.name, STEP_FUNCTIONS[step.name], config, **kwargs)
+
+    ret = 0
+    for result in scheduler.run().values():
+        if isinstance(result, Exception):
+            ret = 1
+        elif result:
+            ret |= result
+    return ret
+
+
 def validate_process(cfg):
     validate = {}
     all_valid = True
@@ -618,7 +789,9 @@ def process_scan_dir_basic(path, name, cfg, proc_type):
     
     io.ensure_dir_exists(cfg.process.output_dir)
 
-    if proc_type == ProcessStage.PRELIMINARY:
+    if cfg.process.get('scheduler', {}).get('enabled', False):
+        ret = process_steps(cfg, validate, proc_type)
+    elif proc_type == ProcessStage.PRELIMINARY:
         ret = process_preliminary(cfg, validate)
     elif proc_type == ProcessStage.EXTRA:
         ret = process_extra(cfg, validate)
@@ -633,6 +806,79 @@ def process_scan_dir_basic(path, name, cfg, proc_type):
     return 'Scan at %s %s processed' % (path, tag)
 
 
+def estimate_memory(cfg, scan_dir, stage):
+    # rough peak memory estimate of a processing stage in bytes
+    name = os.path.basename(os.path.normpath(scan_dir))
+    metadata = io.read_json(os.path.join(scan_dir, name + '.json'))
+    if not metadata:
+        return 0
+    color_height, color_width = metadata['streams'][0]['resolution'][0:2]
+    depth_height, depth_width = metadata['streams'][1]['resolution'][0:2]
+    num_frames = min(metadata['streams'][0]['number_of_frames'], metadata['streams'][1]['number_of_frames'])
+    overhead = 2 * GB
+    if stage == 'recons':
+        # depth frames as float32 and the voxel block hash map
+        integration = cfg.reconstruction.alg_param.integration
+        voxel_bytes = 4 + 2 + (6 if integration.with_color else 0)
+        if integration.block_count == 'auto':
+            # auto sized volumes stay within the memory cap
+            volume = integration.get('block_memory_cap', 4096) * 1024 * 1024
+        else:
+            volume = integration.block_count * integration.block_resolution ** 3 * voxel_bytes
+        frames = num_frames / max(1, cfg.reconstruction.alg_param.frames.step) * depth_width * depth_height * 4
+        return int(overhead + volume + frames)
+    elif stage == 'texturing':
+        # texrecon keeps all views in memory and builds atlases of at most max_texture_size
+        downscale = cfg.process.decode.color_downscale
+        views = num_frames / max(1, cfg.process.texturing.step)
+        view_bytes = views * color_width * color_height * 3 / (downscale * downscale)
+        atlas_bytes = 4 * cfg.process.texturing.max_texture_size ** 2 * 4
+        return int(overhead + view_bytes + atlas_bytes)
+    elif stage == 'convert':
+        return int(overhead + num_frames * depth_width * depth_height * 3)
+    return overhead
+
+
+def estimate_scan_memory(cfg, scan_dir):
+    return max(estimate_memory(cfg, scan_dir, stage) for stage in ['convert', 'recons', 'texturing'])
+
+
+def process_scan_job(dir, name, config, mem_limit=None):
+    # process a scan in a pool worker, returns the log message and whether any step ran out of memory
+    if mem_limit:
+        io.set_call_memory_limit(mem_limit)
+    metrics_file = os.path.join(dir, config.process.metrics_file)
+    num_records = len(io.read_metrics(metrics_file))
+    msg = process_scan_dir(dir, name, config, ProcessStage.PRELIMINARY)
+    msg += '\n' + process_scan_dir(dir, name, config, ProcessStage.EXTRA)
+    records = io.read_metrics(metrics_file)[num_records:]
+    oom = any(is_oom_record(record) for record in records)
+    return msg, oom
+
+
+def process_scans(scans, config):
+    # scans is a list of (dir, name), processed concurrently when batch workers is above 1
+    workers = config.process.batch.workers
+    if workers <= 1:
+        for dir, name in scans:
+            log.info('Processing ' + dir + ' ' + name)
+            process_scan_dir(dir, name, config, ProcessStage.PRELIMINARY)
+            process_scan_dir(dir, name, config, ProcessStage.EXTRA)
+        return
+
+    with MemoryAwarePool(workers, fraction=config.process.batch.memory_fraction,
+                         max_retries=config.process.batch.max_retries,
+                         retry_factor=config.process.batch.retry_factor,
+                         is_oom=lambda result: result[1]) as pool:
+        for dir, name in scans:
+            pool.submit(process_scan_job, dir, name, config, mem=estimate_scan_memory(config, dir), name=name)
+        for (dir, name), result in zip(scans, pool.join()):
+            if isinstance(result, Exception):
+                log.error(f'Processing {name} failed: {result}')
+            else:
+                log.info(result[0])
+
+
 def get_good_candidates(cfg):
     scans_list = get_web_scans_list(cfg.process.align.scans_list_url)
     candidate_ids = []
@@ -649,27 +895,27 @@ def process_scan_dir_batch(dirname, config):
     entries = glob(dirname + '/*/')
     entries, _ = io.sorted_alphanum(entries)
     good_candidates = get_good_candidates(config)
+    scans = []
     for dir in entries:
         name = os.path.relpath(dir, dirname)
         if name in good_candidates:
-            log.info('Processing ' + dir + ' ' + name)
-            process_scan_dir(dir, name, config, ProcessStage.PRELIMINARY)
-            process_scan_dir(dir, name, config, ProcessStage.EXTRA)
+            scans.append((dir, name))
         else:
             log.info('Skip bad scan' + dir + ' ' + name)
+    process_scans(scans, config)
 
 
 def process_scan_dirs(dirs, config):
     # For now, assume one directory deep (can use os.walk() to recursively descend
     good_candidates = get_good_candidates(config)
+    scans = []
     for dir in dirs:
         name = os.path.relpath(dir, os.path.join(dir, '..'))
         if name in good_candidates:
-            log.info('Processing ' + dir + ' ' + name)
-            process_scan_dir(dir, name, config, ProcessStage.PRELIMINARY)
-            process_scan_dir(dir, name, config, ProcessStage.EXTRA)
+            scans.append((dir, name))
         else:
             log.info('Skip bad scan' + dir + ' ' + name)
+    process_scans(scans, config)
 
 
 @hydra.main(config_path="../config", config_name="config")
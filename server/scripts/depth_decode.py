@@ -1,15 +1,19 @@
 import argparse
+import mmap
+import multiprocessing
 import os
 import tempfile
 import zlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
 
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 
 from multiscan.utils import io
+from multiscan.utils import framestore
+from multiscan.utils import zran
 from multiprocessing import Pool
 
 class ExportType(Enum):
@@ -17,6 +21,52 @@ class ExportType(Enum):
     COLOR = 1
     GRAY = 2
 
+
+# color lookup tables, built once before the workers are forked
+_color_luts = {}
+
+
+def depth_color_lut(depth_unit, clamp=4.0):
+    """BGR jet colors of all 65536 depth values of 16 bits, zero depth is black
+
+    :param depth_unit: m for float16 depth, looked up by the bit pattern, mm for uint16 depth
+    :param clamp: depth in meters mapped to the end of the colormap
+    """
+    key = ('depth', depth_unit, clamp)
+    if key not in _color_luts:
+        import matplotlib.pyplot as plt
+        values = np.arange(65536, dtype='uint32').astype('uint16')
+        if depth_unit == 'mm':
+            depth = values.astype('float')
+            clamp *= 1000.0
+        else:
+            depth = values.view('float16').astype('float')
+        with np.errstate(invalid='ignore'):
+            color = plt.get_cmap('jet')(depth / clamp)
+        color *= 255
+        color = color.astype('uint8')[:, [2, 1, 0]]
+        color[depth == 0] = 0
+        _color_luts[key] = np.ascontiguousarray(color)
+    return _color_luts[key]
+
+
+def confidence_color_lut(levels):
+    """BGRA colors of all 256 confidence values"""
+    key = ('confidence', levels)
+    if key not in _color_luts:
+        import matplotlib.pyplot as plt
+        color = plt.get_cmap('Reds', levels)(np.arange(256, dtype='uint8') + np.uint8(1))
+        color *= 255
+        color = color.astype('uint8')[:, [2, 1, 0, 3]]
+        _color_luts[key] = np.ascontiguousarray(color)
+    return _color_luts[key]
+
+
+def build_color_luts(export_type, depth_unit, confidence_color_levels):
+    if export_type == ExportType.COLOR:
+        depth_color_lut(depth_unit)
+        confidence_color_lut(confidence_color_levels)
+
 class ParallelDepthDecode(object):
     def __init__(self, parameters):
         self.parameters = parameters
@@ -36,30 +86,48 @@ class ParallelDepthDecode(object):
         self.depth_format = self.parameters['depth_format']
         self.export_type = self.parameters['export_type']
         self.confidence_color_levels = self.parameters['confidence_color_levels']
+        self.step = self.parameters.get('step', 1)
+        self.frame_store = self.parameters.get('frame_store')
 
     def __call__(self, i):
         fp = np.memmap(self.tmp, dtype=self.depth_type, mode='r', shape=(self.height, self.width), 
                     offset=self.frame_size * i).copy()
-        # depth delta difference filtering
+        fp_last = None
         if self.depth_delta > 0 and i > 0:
             fp_last = np.memmap(self.tmp, dtype=self.depth_type, mode='r', shape=(self.height, self.width), 
                                 offset=self.frame_size * (i - 1)).copy()
-            delta = np.abs(fp_last - fp)
-            fp[delta > self.depth_delta] = 0
-        # filter with confidence levels
+        fp_confi = None
         if self.confidence_filter:
             fp_confi = np.memmap(self.tmp_confi, dtype='uint8', mode='r', shape=(self.height, self.width), 
                                 offset=int(self.frame_size / self.pixel_size * i)).copy()
+        self.export(i, fp, fp_last, fp_confi)
+
+    def export(self, i, fp, fp_last=None, fp_confi=None):
+        self.filter(fp, fp_last, fp_confi)
+        self.write(i, fp, fp_confi)
+
+    def filter(self, fp, fp_last=None, fp_confi=None):
+        """filter a frame, or a stack of frames in place"""
+        # depth delta difference filtering
+        if fp_last is not None:
+            delta = np.abs(fp_last - fp)
+            fp[delta > self.depth_delta] = 0
+        # filter with confidence levels
+        if fp_confi is not None:
             fp[fp_confi < self.level] = 0
 
+    def export_batch(self, indices, fps, fp_lasts=None, fp_confis=None):
+        """filter a stack of frames at once and export them one by one"""
+        self.filter(fps, fp_lasts, fp_confis)
+        for k, i in enumerate(indices):
+            self.write(i, fps[k], fp_confis[k] if fp_confis is not None else None)
+
+    def write(self, i, fp, fp_confi=None):
+        if fp_confi is not None:
             # output color mapped confidence images
             if self.output_confidence:
                 if self.export_type == ExportType.COLOR:
-                    cm = plt.get_cmap('Reds', self.confidence_color_levels)
-                    color = cm(fp_confi + 1)
-                    color *= 255
-                    color = color.astype('uint8')
-                    color = cv2.cvtColor(color, cv2.COLOR_RGBA2BGRA)
+                    color = confidence_color_lut(self.confidence_color_levels)[fp_confi]
                     cv2.imwrite(os.path.join(self.output_confidence, '{}.png'.format(i)), color)
                 elif self.export_type == ExportType.RAW:
                     cv2.imwrite(os.path.join(self.output_confidence, '{}.png'.format(i)), fp_confi)
@@ -76,17 +144,15 @@ class ParallelDepthDecode(object):
                     fp *= 1000
                 fp = fp.astype('uint16')
                 cv2.imwrite(os.path.join(self.output_depth, '{}.png'.format(i)), fp)
+            elif self.depth_format == framestore.EXT:
+                # same millimeter values as .png frames, in the slot of the frame
+                if self.depth_unit == 'm':
+                    fp *= 1000
+                self.frame_store.write(i // self.step, fp.astype('uint16'))
         
         elif self.export_type == ExportType.COLOR:
-            clamp = 4.0
-            if self.depth_unit == 'mm':
-                clamp *= 1000.0
-            cm = plt.get_cmap('jet')
-            color = cm(fp.astype('float') / clamp)
-            color *= 255
-            color = color.astype('uint8')
-            color = cv2.bitwise_and(color, color, mask=(fp!=0).astype('uint8'))
-            color = cv2.cvtColor(color, cv2.COLOR_RGBA2BGR)
+            # 16 bit depth values index the lookup table directly, float16 values by their bit pattern
+            color = depth_color_lut(self.depth_unit)[fp.view('uint16')]
             cv2.imwrite(os.path.join(self.output_depth, '{}.png'.format(i)), color)
         elif self.export_type == ExportType.GRAY:  # write gray frames
             if self.depth_unit == 'm':
@@ -97,6 +163,127 @@ class ParallelDepthDecode(object):
 
 
 
+# streams mapped once per worker of the batch decoder
+_depth_frames = None
+_confi_frames = None
+
+
+def init_batch_worker(tmp, tmp_confi, depth_type, height, width):
+    global _depth_frames, _confi_frames
+    _depth_frames = np.memmap(tmp, dtype=depth_type, mode='r')
+    _depth_frames = _depth_frames[:_depth_frames.size // (height * width) * height * width].reshape(-1, height, width)
+    _confi_frames = None
+    if tmp_confi:
+        _confi_frames = np.memmap(tmp_confi, dtype='uint8', mode='r')
+        _confi_frames = _confi_frames[:_confi_frames.size // (height * width) * height * width].reshape(-1, height, width)
+
+
+def init_random_access_worker(input, input_confi, depth_type, height, width, checkpoint_frames):
+    # frames are inflated on demand from the closest checkpoint of the stream index
+    global _depth_frames, _confi_frames
+    _depth_frames = zran.ZranFrames(input, (height, width), depth_type, checkpoint_frames)
+    _confi_frames = None
+    if input_confi:
+        _confi_frames = zran.ZranFrames(input_confi, (height, width), 'uint8', checkpoint_frames)
+
+
+class BatchDepthDecode(ParallelDepthDecode):
+    """filter and export a contiguous range of frames with array operations over the whole range"""
+    def __call__(self, frame_range):
+        start, stop = frame_range
+        indices = np.arange(start, stop, self.step)
+        # the range including the frame before it, for the delta filter
+        lo = max(start - 1, 0)
+        block = _depth_frames[lo:stop]
+        fps = block[indices - lo]
+        fp_lasts = None
+        if self.depth_delta > 0:
+            # the first frame has no previous frame, comparing it to itself keeps it unfiltered
+            fp_lasts = block[np.maximum(indices - 1, 0) - lo]
+        fp_confis = None
+        if self.confidence_filter:
+            fp_confis = np.array(_confi_frames[start:stop:self.step])
+        self.export_batch(indices, fps, fp_lasts, fp_confis)
+        return len(indices)
+
+
+# anonymous shared memory buffers of the streaming decoder, inherited by the forked workers
+_stream_slots = []
+
+
+class StreamDepthDecode(ParallelDepthDecode):
+    """filter and export a batch of frames inflated into a shared memory slot
+
+    A slot holds the last depth frame of the previous batch, followed by the depth frames
+    and the confidence frames of the batch.
+    """
+    def __init__(self, parameters):
+        super().__init__(parameters)
+        self.batch_size = self.parameters['batch_size']
+
+    def slot_views(self, slot):
+        buf = _stream_slots[slot]
+        shape = (self.height, self.width)
+        depth_bytes = self.frame_size * (self.batch_size + 1)
+        depth = np.frombuffer(buf, dtype=self.depth_type, count=(self.batch_size + 1) * self.height * self.width)
+        depth = depth.reshape((self.batch_size + 1,) + shape)
+        confi = np.frombuffer(buf, dtype='uint8', count=self.batch_size * self.height * self.width, offset=depth_bytes)
+        confi = confi.reshape((self.batch_size,) + shape)
+        return depth, confi
+
+    def __call__(self, task):
+        slot, start, count = task
+        depth, confi = self.slot_views(slot)
+        # offsets of the frames to export within the batch
+        offsets = np.arange(-start % self.step, count, self.step)
+        if not len(offsets):
+            return 0
+        fps = depth[offsets + 1]
+        fp_lasts = None
+        if self.depth_delta > 0:
+            # the previous frame of the first frame in a batch is carried in front of the batch
+            fp_lasts = depth[offsets]
+            if start == 0:
+                fp_lasts[0] = fps[0]
+        fp_confis = confi[offsets] if self.confidence_filter else None
+        self.export_batch(offsets + start, fps, fp_lasts, fp_confis)
+        return len(offsets)
+
+
+class StreamInflater:
+    """inflate a raw deflate stream incrementally and hand it out frame by frame"""
+    def __init__(self, input, frame_size, chunk_size=4096 * 16):
+        self.file = open(input, 'rb')
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.frame_size = frame_size
+        self.chunk_size = chunk_size
+        self.pending = bytearray()
+        self.eof = False
+
+    def read_frames(self, out, offset, num):
+        """inflate up to num frames into the writable buffer out, starting at byte offset
+
+        :return: number of complete frames written
+        """
+        need = num * self.frame_size
+        while len(self.pending) < need and not self.eof:
+            buffer = self.file.read(self.chunk_size)
+            if buffer:
+                self.pending += self.decompressor.decompress(buffer)
+            else:
+                self.pending += self.decompressor.flush()
+                self.eof = True
+        count = min(num, len(self.pending) // self.frame_size)
+        size = count * self.frame_size
+        with memoryview(out) as view:
+            view[offset:offset + size] = self.pending[:size]
+        del self.pending[:size]
+        return count
+
+    def close(self):
+        self.file.close()
+
+
 def configure(args):
     if not io.file_exist(args.input, '.zlib'):
         logging.error(f'Input file {args.input} not exists')
@@ -180,12 +367,177 @@ class DepthDecode:
         self.level = level
         self.depth_delta = depth_delta
 
-    def decode(self, output_depth, output_confidence, step, export_type=ExportType.RAW, num=0, confidence_color_levels=4):
+    def create_frame_store(self, output_depth):
+        if self.depth_format != framestore.EXT:
+            return None
+        return framestore.FrameStoreWriter(os.path.join(output_depth, framestore.DEFAULT_NAME),
+                                           self.height, self.width, dtype='uint16')
+
+    @staticmethod
+    def finalize_frame_store(frame_store, indices):
+        if frame_store is not None:
+            frame_store.finalize(indices, depth_unit='mm', depth_scale=1000.0)
+            frame_store.close()
+
+    def depth_type(self):
+        if self.depth_unit == 'm':
+            return 'float16'
+        elif self.depth_unit == 'mm':
+            return 'uint16'
+        logging.error(f"unsupported input depth unit {self.depth_unit}")
+        raise ValueError
+
+    def decode_stream(self, output_depth, output_confidence, step, export_type=ExportType.RAW, num=0,
+                      confidence_color_levels=4, processes=None, batch_size=64):
+        """decode without temporary files
+
+        Depth and confidence streams are inflated concurrently by two threads into shared memory
+        slots of batch_size frames, workers filter and export the frames of a slot while the
+        next slots are being inflated.
+
+        :return: True if all frames were decoded
+        """
+        confidence_filter = bool(self.input_confidence and io.file_exist(self.input_confidence))
+        depth_type = self.depth_type()
+        depth_delta = self.depth_delta * 1000 if self.depth_unit == 'mm' else self.depth_delta
+        processes = processes or os.cpu_count()
+        frame_size = self.width * self.height * self.pixel_size
+        confi_frame_size = self.width * self.height
+        depth_bytes = frame_size * (batch_size + 1)
+        num_slots = processes + 2
+
+        build_color_luts(export_type, self.depth_unit, confidence_color_levels)
+        global _stream_slots
+        _stream_slots = [mmap.mmap(-1, depth_bytes + confi_frame_size * batch_size) for _ in range(num_slots)]
+        params = {
+            'tmp': None, 'tmp_confi': None, 'depth_type': depth_type, 'height': self.height, 'width': self.width,
+            'frame_size': frame_size, 'confidence_filter': confidence_filter, 'output_confidence': output_confidence,
+            'output_depth': output_depth, 'depth_unit': self.depth_unit, 'level': self.level,
+            'depth_delta': depth_delta, 'pixel_size': self.pixel_size, 'depth_format': self.depth_format,
+            'export_type': export_type, 'confidence_color_levels': confidence_color_levels,
+            'step': step, 'batch_size': batch_size, 'frame_store': self.create_frame_store(output_depth),
+        }
+        p_decode = StreamDepthDecode(params)
+
+        depth_inflater = None
+        confi_inflater = None
+        pool = multiprocessing.get_context('fork').Pool(processes)
+        threads = ThreadPoolExecutor(2)
+        pending = [None] * num_slots
+        start = 0
+        batch = 0
+        prev_count = 0
+        success = False
+        try:
+            depth_inflater = StreamInflater(self.input_depth, frame_size)
+            if confidence_filter:
+                confi_inflater = StreamInflater(self.input_confidence, confi_frame_size)
+            while not num or start < num:
+                slot = batch % num_slots
+                if pending[slot] is not None:
+                    pending[slot].get()
+                buf = _stream_slots[slot]
+                count = batch_size if not num else min(batch_size, num - start)
+                depth_job = threads.submit(depth_inflater.read_frames, buf, frame_size, count)
+                if confi_inflater:
+                    confi_job = threads.submit(confi_inflater.read_frames, buf, depth_bytes, count)
+                    count = min(count, confi_job.result())
+                count = min(count, depth_job.result())
+                if count == 0:
+                    break
+                # carry the last depth frame of the previous batch for the delta filter
+                if batch > 0:
+                    prev_buf = _stream_slots[(batch - 1) % num_slots]
+                    buf[0:frame_size] = prev_buf[frame_size * prev_count:frame_size * (prev_count + 1)]
+                pending[slot] = pool.apply_async(p_decode, ((slot, start, count),))
+                start += count
+                prev_count = count
+                batch += 1
+            for job in pending:
+                if job is not None:
+                    job.get()
+            self.finalize_frame_store(params['frame_store'], range(0, start, step))
+            logging.info(f'{len(range(0, start, step))} frames are extracted')
+            success = True
+        except Exception as e:
+            logging.error(e)
+        finally:
+            pool.close()
+            pool.join()
+            threads.shutdown()
+            if depth_inflater:
+                depth_inflater.close()
+            if confi_inflater:
+                confi_inflater.close()
+            for buf in _stream_slots:
+                buf.close()
+            _stream_slots = []
+        return success
+
+    def decode_random_access(self, output_depth, output_confidence, step, export_type=ExportType.RAW, num=0,
+                             confidence_color_levels=4, processes=None, batch_size=64, checkpoint_frames=16):
+        """decode disjoint frame ranges in parallel, without temporary files
+
+        The streams are indexed once (the index is kept next to the streams), every worker then
+        inflates its ranges from the closest checkpoints.
+
+        :return: True if all frames were decoded
+        """
+        confidence_filter = bool(self.input_confidence and io.file_exist(self.input_confidence))
+        depth_type = self.depth_type()
+        depth_delta = self.depth_delta * 1000 if self.depth_unit == 'mm' else self.depth_delta
+        processes = processes or os.cpu_count()
+        frame_size = self.width * self.height * self.pixel_size
+        try:
+            depth_frames = zran.ZranFrames(self.input_depth, (self.height, self.width), depth_type, checkpoint_frames)
+            num_frames = len(depth_frames)
+            if confidence_filter:
+                confi_frames = zran.ZranFrames(self.input_confidence, (self.height, self.width), 'uint8',
+                                               checkpoint_frames)
+                num_frames = min(num_frames, len(confi_frames))
+            if num:
+                num_frames = min(num_frames, num)
+            logging.info(f'{len(range(0, num_frames, step))} frames are being extracted')
+
+            params = {
+                'tmp': None, 'tmp_confi': None, 'depth_type': depth_type, 'height': self.height, 'width': self.width,
+                'frame_size': frame_size, 'confidence_filter': confidence_filter,
+                'output_confidence': output_confidence, 'output_depth': output_depth,
+                'depth_unit': self.depth_unit, 'level': self.level, 'depth_delta': depth_delta,
+                'pixel_size': self.pixel_size, 'depth_format': self.depth_format, 'export_type': export_type,
+                'confidence_color_levels': confidence_color_levels, 'step': step,
+                'frame_store': self.create_frame_store(output_depth),
+            }
+            build_color_luts(export_type, self.depth_unit, confidence_color_levels)
+            pool = Pool(processes, initializer=init_random_access_worker,
+                        initargs=(self.input_depth, self.input_confidence if confidence_filter else None, depth_type,
+                                  self.height, self.width, checkpoint_frames))
+            p_decode = BatchDepthDecode(params)
+            chunk = step * batch_size
+            pool.map(p_decode, [(start, min(start + chunk, num_frames)) for start in range(0, num_frames, chunk)])
+            pool.close()
+            pool.join()
+            self.finalize_frame_store(params['frame_store'], range(0, num_frames, step))
+        except Exception as e:
+            logging.error(e)
+            return False
+        return True
+
+    def decode(self, output_depth, output_confidence, step, export_type=ExportType.RAW, num=0, confidence_color_levels=4,
+               processes=None, batch_size=0):
+        """decode through temporary files
+
+        With a positive batch_size, every worker maps the streams once and decodes ranges of
+        batch_size output frames, otherwise frames are decoded one per task.
+
+        :return: True if all frames were decoded
+        """
         tmp = self.decompress(self.input_depth, output_depth)
         confidence_filter = self.input_confidence and io.file_exist(self.input_confidence)
         if confidence_filter:
             tmp_confi = self.decompress(self.input_confidence, output_confidence)
         
+        success = False
         try:
             num_frames, frame_size = self.get_num_frames(num, self.width, self.height, tmp, self.pixel_size)
             out_num = int(num_frames / step)
@@ -199,7 +551,6 @@ class DepthDecode:
                 logging.error(f"unsupported input depth unit {self.depth_unit}")
                 raise ValueError
 
-            pool = Pool(os.cpu_count())
             params = {}
             params['tmp'] = tmp.name
             params['tmp_confi'] = tmp_confi.name if confidence_filter else None
@@ -217,8 +568,24 @@ class DepthDecode:
             params['depth_format'] = self.depth_format
             params['export_type'] = export_type
             params['confidence_color_levels'] = confidence_color_levels
-            p_decode = ParallelDepthDecode(params)
-            pool.map(p_decode, range(0, num_frames, step))
+            params['step'] = step
+            params['frame_store'] = self.create_frame_store(output_depth)
+            processes = processes or os.cpu_count()
+            build_color_luts(export_type, self.depth_unit, confidence_color_levels)
+            if batch_size > 0:
+                pool = Pool(processes, initializer=init_batch_worker,
+                            initargs=(params['tmp'], params['tmp_confi'], depth_type, self.height, self.width))
+                p_decode = BatchDepthDecode(params)
+                chunk = step * batch_size
+                pool.map(p_decode, [(start, min(start + chunk, num_frames)) for start in range(0, num_frames, chunk)])
+            else:
+                pool = Pool(processes)
+                p_decode = ParallelDepthDecode(params)
+                pool.map(p_decode, range(0, num_frames, step))
+            pool.close()
+            pool.join()
+            self.finalize_frame_store(params['frame_store'], range(0, num_frames, step))
+            success = True
 
         except Exception as e:
             logging.error(e)
@@ -226,6 +593,7 @@ class DepthDecode:
         os.unlink(tmp.name)
         if confidence_filter:
             os.unlink(tmp_confi.name)
+        return success
 
 
 if __name__ == "__main__":
@@ -263,7 +631,17 @@ if __name__ == "__main__":
                         help='input depth unit (mm or m)')
     parser.add_argument('--format', dest='format', type=str, action='store', required=False,
                         default='.exr',
-                        help='output depth format (.exr or .png)')
+                        help='output depth format (.exr, .png or .frames for a single frame store)')
+    parser.add_argument('--cpus', dest='cpus', type=int, default=0, action='store', required=False,
+                        help='Number of worker processes, all available cpus if not set')
+    parser.add_argument('--batch_size', dest='batch_size', type=int, default=0, action='store', required=False,
+                        help='Number of frames decoded per task, one frame per task if not set')
+    parser.add_argument('--random_access', dest='random_access', default=False, action='store_true', required=False,
+                        help='Index the streams and decode frame ranges from the closest checkpoints in parallel')
+    parser.add_argument('--checkpoint_frames', dest='checkpoint_frames', type=int, default=16, action='store',
+                        required=False, help='Number of frames between checkpoints of the stream index')
+    parser.add_argument('--stream', dest='stream', default=False, action='store_true', required=False,
+                        help='Decode streams on the fly without temporary files')
     parser.add_argument('-o_confi', '--output_confidence', dest='output_confidence', type=str, action='store',
                         required=False,
                         help='Output directory of confidence maps')
@@ -285,5 +663,18 @@ if __name__ == "__main__":
     elif args.mode == 2:
         export_type = ExportType.GRAY
     
-    decoder.decode(args.output, args.output_confidence, args.step, export_type=export_type, num=args.num,
-                   confidence_color_levels=args.confi_color_range)
+    processes = args.cpus or len(os.sched_getaffinity(0))
+    if args.random_access and zran.available():
+        success = decoder.decode_random_access(args.output, args.output_confidence, args.step, export_type=export_type,
+                                     num=args.num, confidence_color_levels=args.confi_color_range,
+                                     processes=processes, batch_size=args.batch_size or 64,
+                                     checkpoint_frames=args.checkpoint_frames)
+    elif args.stream:
+        success = decoder.decode_stream(args.output, args.output_confidence, args.step, export_type=export_type, num=args.num,
+                              confidence_color_levels=args.confi_color_range, processes=processes,
+                              batch_size=args.batch_size or 64)
+    else:
+        success = decoder.decode(args.output, args.output_confidence, args.step, export_type=export_type, num=args.num,
+                       confidence_color_levels=args.confi_color_range, processes=processes,
+                       batch_size=args.batch_size)
+    exit(0 if success else 1)
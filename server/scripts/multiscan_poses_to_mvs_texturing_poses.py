@@ -6,6 +6,8 @@ import json
 import numpy as np
 import os
 
+from multiscan.utils.trajectory import load_trajectory, arkit_to_open3d, fill_intrinsics
+
 
 """
 This script converts multiscan camera poses to the format expected by https://github.com/nmoehrle/mvs-texturing/ (see below)
@@ -24,45 +26,31 @@ The principal point has to be given in unit dimensions (e.g. 0.5 0.5).
 
 
 def parse_camera_poses_jsonl(filename, metadata):
-    pose_file = open(filename, 'r')
-
     color_width = metadata['color_width']
     color_height = metadata['color_height']
     max_img_dim = max(color_width, color_height)
 
-    poses = []
-    intrinsics = []
-
-    for pose_line in pose_file:
-        cam_info = json.loads(pose_line)
-        trans = cam_info.get('transform', None)
-        assert trans != None
-        # ARKit camera pose (+x along long axis of device toward home button, +y upwards, +z away from device on screen side)
-        trans = np.asarray(trans)
-        trans = trans.reshape(4, 4).transpose()
-
-        # open3d camera pose (flip y and z)
-        trans = np.matmul(trans, np.diag([1, -1, -1, 1]))
-        trans = trans / trans[3][3]
-        poses.append(trans)
-
-        K = cam_info.get('intrinsics', metadata['intrinsic_data'])
-        K = np.asarray(K).astype(np.float32)
-        K = K.reshape(3, 3).transpose()
-        K = K.flatten('F').tolist()
-        fx = K[0]
-        fy = K[4]
-        cx = K[6]
-        cy = K[7]
-
-        f = fx / max_img_dim  # assumes fx~=fy and uses just fx
-        ppx = cx / color_width
-        ppy = cy / color_height
-        paspect = fx / fy
-        d0 = 0  # assume no radial distortion
-        d1 = 0  # assume no distortion
-
-        intrinsics.append([f, d0, d1, paspect, ppx, ppy])
+    trajectory = load_trajectory(filename)
+    # open3d camera poses
+    poses = arkit_to_open3d(trajectory['transforms'])
+
+    K = fill_intrinsics(trajectory['intrinsics'], metadata['intrinsic_data'])
+    # intrinsics are single precision
+    K = K.astype(np.float32).astype(np.float64)
+    fx = K[:, 0, 0]
+    fy = K[:, 1, 1]
+    cx = K[:, 0, 2]
+    cy = K[:, 1, 2]
+
+    f = fx / max_img_dim  # assumes fx~=fy and uses just fx
+    ppx = cx / color_width
+    ppy = cy / color_height
+    paspect = fx / fy
+    d0 = 0  # assume no radial distortion
+    d1 = 0  # assume no distortion
+
+    intrinsics = [[f_i, d0, d1, paspect_i, ppx_i, ppy_i]
+                  for f_i, paspect_i, ppx_i, ppy_i in zip(f.tolist(), paspect.tolist(), ppx.tolist(), ppy.tolist())]
 
     return poses, intrinsics
 
@@ -83,7 +71,7 @@ def get_metadata(meta_file):
 
 
 def write_cam_file(P, intrinsics, filename):
-    P = np.linalg.inv(P)  # need world-to-camera transform matrix
+    # P is the world-to-camera transform matrix
     tx = P[0, 3]
     ty = P[1, 3]
     tz = P[2, 3]
@@ -122,17 +110,18 @@ def mts_poses_to_mvs_poses(indir, outdir, frame_skip, transform_poses):
     if os.path.isfile(transform_poses):
         transform = read_align_transform(transform_poses)
         print("Alignment transform:", transform)
-        poses = [np.matmul(transform, p) for p in poses]
+        poses = np.matmul(transform, poses)
 
+    if len(img_frame_ids):
+        print("First pose:", poses[img_frame_ids[0]])
+    # need world-to-camera transform matrices
+    extrinsics = np.linalg.inv(poses[img_frame_ids])
     for i in range(len(img_frame_ids)):
         frame_i = img_frame_ids[i]
-        pose_i = poses[frame_i]
-        if i == 0:
-            print("First pose:", pose_i)
         intrinsics_i = intrinsics[frame_i]
         # TODO: change frame id to the actual indices
         cam_filename = os.path.join(outdir, f'{i}.cam')
-        write_cam_file(pose_i, intrinsics_i, cam_filename)
+        write_cam_file(extrinsics[i], intrinsics_i, cam_filename)
 
 
 if __name__ == '__main__':
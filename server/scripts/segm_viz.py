@@ -13,6 +13,7 @@ from pyrender.constants import (DEFAULT_SCENE_SCALE,
                                 DEFAULT_Z_FAR, DEFAULT_Z_NEAR)
 
 from multiscan.utils import io
+from multiscan.meshproc import mesh_session
 
 os.environ['PYOPENGL_PLATFORM'] = 'egl'
 
@@ -31,12 +32,17 @@ def compute_initial_camera_pose(scene):
 
 
 def segm_render(input_mesh, input_segs, output_dir, output_mesh=True, width=640, height=480):
-    ms = pymeshlab.MeshSet()
-    ms.load_new_mesh(input_mesh)
-
-    mesh = ms.current_mesh()
-    np_vertices = mesh.vertex_matrix()
-    np_faces = mesh.face_matrix()
+    if io.file_extension(input_mesh).lower() == '.ply':
+        mesh = mesh_session().mesh(input_mesh)
+        np_vertices = mesh['vertices']
+        np_faces = mesh['faces']
+    else:
+        ms = pymeshlab.MeshSet()
+        ms.load_new_mesh(input_mesh)
+
+        mesh = ms.current_mesh()
+        np_vertices = mesh.vertex_matrix()
+        np_faces = mesh.face_matrix()
 
     num_vertices = np.shape(np_vertices)[0]
     num_faces = np.shape(np_faces)[0]
@@ -110,9 +116,10 @@ def configure(args):
         logging.error(f'Input file {args.input} not exists')
         return False
 
-    if not io.file_exist(args.segs, '.json'):
-        logging.error(f'Input segmentation file {args.input} not exists')
-        return False
+    for segs in args.segs:
+        if not io.file_exist(segs, '.json'):
+            logging.error(f'Input segmentation file {segs} not exists')
+            return False
 
     if args.output is None:
         args.output = os.path.dirname(args.input)
@@ -128,8 +135,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Decode depth stream!')
     parser.add_argument('-i', '--input', dest='input', type=str, action='store', required=True,
                         help='Input mesh ply file')
-    parser.add_argument('-segs', '--segs', dest='segs', type=str, action='store', required=True,
-                        help='Input mesh segmentation json file')
+    parser.add_argument('-segs', '--segs', dest='segs', type=str, nargs='+', required=True,
+                        help='Input mesh segmentation json files, the mesh is loaded once for all of them')
     parser.add_argument('--width', dest='width', type=int, action='store', required=False, default=640,
                         help='width of output visualization image')
     parser.add_argument('--height', dest='height', type=int, action='store', required=False, default=480,
@@ -144,4 +151,5 @@ if __name__ == "__main__":
     if not configure(args):
         exit(0)
 
-    segm_render(args.input, args.segs, args.output, args.output_mesh, args.width, args.height)
+    for segs in args.segs:
+        segm_render(args.input, segs, args.output, args.output_mesh, args.width, args.height)
@@ -0,0 +1,53 @@
+import json
+import zlib
+
+import numpy as np
+import pytest
+
+COLOR_SIZE = (96, 72)
+DEPTH_SIZE = (16, 12)
+VIDEO_FRAMES = 10
+META_FRAMES = 12
+# frames without valid depth, skipped by the min_portion filter
+EMPTY_FRAMES = (4, 8)
+
+
+def deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.fixture(scope='session')
+def stream_scan(tmp_path_factory):
+    """scan with an .mp4 color stream, .zlib depth and confidence streams and metadata
+
+    The video has VIDEO_FRAMES frames, fewer than the META_FRAMES depth frames of the metadata.
+    """
+    cv2 = pytest.importorskip('cv2')
+    folder = tmp_path_factory.mktemp('stream_scan')
+    rng = np.random.default_rng(0)
+    color_stream = str(folder / 'scan.mp4')
+    writer = cv2.VideoWriter(color_stream, cv2.VideoWriter_fourcc(*'mp4v'), 30, COLOR_SIZE)
+    for _ in range(VIDEO_FRAMES):
+        writer.write(rng.integers(0, 255, (COLOR_SIZE[1], COLOR_SIZE[0], 3), dtype=np.uint8))
+    writer.release()
+
+    shape = (META_FRAMES, DEPTH_SIZE[1], DEPTH_SIZE[0])
+    depth = rng.uniform(1.0, 2.0, (META_FRAMES, 1, 1)) + rng.uniform(0.0, 0.01, shape)
+    depth[list(EMPTY_FRAMES)] = 0
+    depth_stream = str(folder / 'scan.depth.zlib')
+    with open(depth_stream, 'wb') as f:
+        f.write(deflate(depth.astype('float16').tobytes()))
+    confidence_stream = str(folder / 'scan.confidence.zlib')
+    with open(confidence_stream, 'wb') as f:
+        f.write(deflate(rng.integers(1, 3, shape, dtype=np.uint8).tobytes()))
+
+    metadata_file = str(folder / 'scan.json')
+    with open(metadata_file, 'w') as f:
+        json.dump({'streams': [
+            {'resolution': [COLOR_SIZE[1], COLOR_SIZE[0]], 'number_of_frames': META_FRAMES,
+             'intrinsics': [60.0, 0, 0, 0, 60.0, 0, 48.0, 36.0, 1]},
+            {'resolution': [DEPTH_SIZE[1], DEPTH_SIZE[0]], 'number_of_frames': META_FRAMES},
+        ], 'depth_unit': 'm'}, f)
+    return {'color_stream': color_stream, 'depth_stream': depth_stream, 'confidence_stream': confidence_stream,
+            'metadata_file': metadata_file, 'trajectory_file': 'path'}
@@ -0,0 +1,169 @@
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+pytest.importorskip('decord')
+o3d = pytest.importorskip('open3d')
+from omegaconf import OmegaConf  # noqa: E402
+
+from reconstruction.scripts.bridge import Bridge, FrameCache  # noqa: E402
+from reconstruction.scripts.utils import align_color2depth, resize_nearest  # noqa: E402
+from conftest import DEPTH_SIZE, COLOR_SIZE, META_FRAMES, VIDEO_FRAMES, deflate  # noqa: E402
+
+
+def open_bridge(stream_scan, with_color=True, use_opencv=False, at_depth_resolution=True, random_access=False,
+                cache_size=4):
+    config = OmegaConf.create({
+        'input': stream_scan,
+        'alg_param': {
+            'frames': {'use_opencv': use_opencv, 'color_at_depth_resolution': at_depth_resolution,
+                       'color_batch_size': 4, 'random_access': random_access, 'cache_size': cache_size},
+            'integration': {'with_color': with_color},
+        },
+    })
+    bridge = Bridge(config)
+    bridge.open_all()
+    bridge.read_metadata()
+    return bridge
+
+
+def aligned(frame):
+    depth = o3d.geometry.Image(np.zeros((DEPTH_SIZE[1], DEPTH_SIZE[0]), dtype=np.float32))
+    return np.asarray(align_color2depth(o3d.geometry.Image(np.ascontiguousarray(frame)), depth))
+
+
+@pytest.mark.parametrize('size_in, size_out', [
+    ((1920, 1440), (256, 192)), ((1000, 1000), (333, 777)), ((7, 5), (13, 9)), ((96, 72), (16, 12)),
+])
+def test_resize_nearest_matches_align_color2depth(size_in, size_out):
+    rng = np.random.default_rng(0)
+    frames = rng.integers(0, 255, (2, size_in[1], size_in[0], 3), dtype=np.uint8)
+    resized = resize_nearest(frames, size_out)
+    assert resized.shape == (2, size_out[1], size_out[0], 3)
+    depth = o3d.geometry.Image(np.zeros((size_out[1], size_out[0]), dtype=np.float32))
+    for frame, expected in zip(frames, resized):
+        np.testing.assert_array_equal(np.asarray(align_color2depth(o3d.geometry.Image(frame), depth)), expected)
+        np.testing.assert_array_equal(resize_nearest(frame, size_out), expected)
+
+
+def test_depth_only_does_not_open_color(stream_scan):
+    bridge = open_bridge(stream_scan, with_color=False)
+    assert bridge.color_cap is None
+    assert bridge.meta['num_frames'] == META_FRAMES
+    bridge.close_all()
+
+
+def test_color_limits_the_number_of_frames(stream_scan):
+    bridge = open_bridge(stream_scan, with_color=True)
+    assert bridge.color_cap is not None
+    assert bridge.meta['num_frames'] == VIDEO_FRAMES
+    bridge.close_all()
+
+
+@pytest.mark.parametrize('use_opencv', [False, True])
+def test_color_at_depth_resolution_matches_resizing(stream_scan, use_opencv):
+    full = open_bridge(stream_scan, use_opencv=use_opencv, at_depth_resolution=False)
+    expected = [aligned(full.cap_colorframe(idx)) for idx in range(VIDEO_FRAMES)]
+    assert full.cap_colorframe(0).shape == (COLOR_SIZE[1], COLOR_SIZE[0], 3)
+    full.close_all()
+
+    bridge = open_bridge(stream_scan, use_opencv=use_opencv)
+    indices = [0, 2, 3, 7, 9, VIDEO_FRAMES, -1]
+    frames = list(bridge.iter_colorframes(indices))
+    for idx, frame in zip(indices, frames):
+        if 0 <= idx < VIDEO_FRAMES:
+            np.testing.assert_array_equal(frame, expected[idx])
+            np.testing.assert_array_equal(bridge.cap_colorframe(idx), expected[idx])
+        else:
+            assert frame is None
+    bridge.close_all()
+
+
+def test_frame_cache_hits_and_evictions():
+    frames = np.arange(10 * 2 * 3, dtype=np.float16).reshape(10, 2, 3)
+    cache = FrameCache(frames, size=3)
+    for idx in [0, 1, 0, 2]:
+        np.testing.assert_array_equal(cache.get(idx), frames[idx])
+    assert (cache.hits, cache.misses) == (1, 3)
+    # frame 3 evicts the oldest slot, which holds frame 0
+    np.testing.assert_array_equal(cache.get(3), frames[3])
+    assert 0 not in cache and all(idx in cache for idx in (1, 2, 3))
+    np.testing.assert_array_equal(cache.get(0), frames[0])
+    assert (cache.hits, cache.misses) == (1, 5)
+    assert 1 not in cache
+    # loads count the frames read, frame 4 evicts frame 2 in the slot after frame 0
+    cache.load(2, 3)
+    assert (cache.hits, cache.misses) == (1, 6)
+    assert 2 not in cache and all(idx in cache for idx in (0, 3, 4))
+    np.testing.assert_array_equal(cache.get(4), frames[4])
+    assert cache.hits == 2
+    # buffers hold copies of the frames
+    assert not np.shares_memory(cache.get(4), frames)
+
+
+@pytest.fixture(scope='module')
+def moving_depth_scan(stream_scan, tmp_path_factory):
+    """stream scan whose depth changes smoothly, so the delta filter removes only some pixels"""
+    rng = np.random.default_rng(1)
+    shape = (META_FRAMES, DEPTH_SIZE[1], DEPTH_SIZE[0])
+    depth = 1.5 + np.cumsum(rng.normal(0, 0.04, shape), axis=0)
+    depth[rng.random(shape) < 0.1] = 0
+    depth = depth.astype('float16')
+    scan = dict(stream_scan)
+    scan['depth_stream'] = str(tmp_path_factory.mktemp('moving_depth') / 'scan.depth.zlib')
+    with open(scan['depth_stream'], 'wb') as f:
+        f.write(deflate(depth.tobytes()))
+    return scan, depth
+
+
+def reference_filtered_depth(depth, confidence, idx, level, delta_thresh):
+    """depth filter of the bridge before the frame cache"""
+    num_frames = len(depth)
+    fp = depth[min(max(idx, 0), num_frames - 1)].copy()
+    if delta_thresh > 0:
+        fp_last = depth[min(max(idx - 1, 0), num_frames - 1)]
+        delta = np.abs(fp_last - fp)
+        fp[delta > delta_thresh] = 0
+    if level >= 0 and 0 <= idx < num_frames:
+        fp[confidence[idx] < level] = 0
+    return np.array(fp).astype(np.float32)
+
+
+@pytest.mark.parametrize('random_access', [False, True])
+@pytest.mark.parametrize('indices', [
+    list(range(META_FRAMES)),
+    list(range(0, META_FRAMES, 3)),
+    [5, 2, 9, 3, 3, 11, 0],
+])
+def test_filtered_depth_matches_reference(moving_depth_scan, random_access, indices):
+    scan, depth = moving_depth_scan
+    bridge = open_bridge(scan, with_color=False, random_access=random_access, cache_size=2)
+    confidence = np.array([bridge.raw_confidenceframe(i) for i in range(META_FRAMES)])
+    out = np.empty(depth.shape[1:], dtype=np.float32)
+    filtered = 0
+    for idx in indices:
+        expected = reference_filtered_depth(depth, confidence, idx, 2, 0.05)
+        np.testing.assert_array_equal(bridge.filtered_depthframe(idx, 2, 0.05), expected)
+        assert bridge.filtered_depthframe(idx, 2, 0.05, out=out) is out
+        np.testing.assert_array_equal(out, expected)
+        np.testing.assert_array_equal(bridge.filtered_depthframe(idx, -1, 0.0), depth[idx].astype(np.float32))
+        filtered += np.count_nonzero(depth[idx]) - np.count_nonzero(expected)
+    assert filtered > 0
+    bridge.close_all()
+
+
+def test_sequential_filtering_reads_each_frame_once(moving_depth_scan):
+    scan, _ = moving_depth_scan
+    bridge = open_bridge(scan, with_color=False, cache_size=2)
+    for idx in range(META_FRAMES):
+        bridge.filtered_depthframe(idx)
+    cache = bridge.depth_cache
+    assert cache.misses == META_FRAMES
+    # the first frame is its own predecessor
+    assert cache.hits == META_FRAMES + 1
+    # with a frame step each frame and its predecessor are read in one pass
+    bridge.depth_cache = FrameCache(bridge.depth_frames, 2)
+    for idx in range(0, META_FRAMES, 3):
+        bridge.filtered_depthframe(idx)
+    assert bridge.depth_cache.misses == 2 * len(range(3, META_FRAMES, 3)) + 1
+    bridge.close_all()
@@ -0,0 +1,63 @@
+import os
+import subprocess
+
+import pytest
+
+from multiscan.utils import cores
+
+
+@pytest.fixture
+def allocator(tmp_path):
+    return cores.CoreAllocator(state_file=str(tmp_path / 'cores.json'), cpus=range(8), poll_interval=0.01)
+
+
+def test_parse_cpu_list():
+    assert cores.parse_cpu_list('0-3,8,10-11') == [0, 1, 2, 3, 8, 10, 11]
+    assert cores.parse_cpu_list(' 2, 1 ,\n') == [1, 2]
+    assert cores.parse_cpu_list(cores.format_cpu_list([5, 3, 4])) == [3, 4, 5]
+
+
+def test_allocations_are_disjoint(allocator):
+    first = allocator.allocate(3, tag='a')
+    second = allocator.allocate(3, tag='b')
+    assert len(first) == 3 and len(second) == 3
+    assert not set(first) & set(second)
+    assert set(allocator.allocations()) == {str(c) for c in first + second}
+
+
+def test_release_frees_cores(allocator):
+    cpus = allocator.allocate(8)
+    assert allocator.allocate(1, wait=False) == []
+    allocator.release(cpus[:2])
+    assert sorted(allocator.allocate(2, wait=False)) == sorted(cpus[:2])
+
+
+def test_partial_allocation_after_timeout(allocator):
+    allocator.allocate(6)
+    assert len(allocator.allocate(4, timeout=0.05)) == 2
+
+
+def test_request_is_clamped_to_available_cores(allocator):
+    assert len(allocator.allocate(100)) == 8
+
+
+def test_dead_owner_is_reclaimed(allocator):
+    child = subprocess.Popen(['true'])
+    child.wait()
+    allocator.allocate(8, owner=child.pid)
+    assert len(allocator.allocate(8, wait=False)) == 8
+
+
+def test_reserve_reuses_inherited_cores(allocator, monkeypatch):
+    monkeypatch.setenv(cores.ALLOCATED_CPUS_ENV, '4-7')
+    with cores.reserve(2, allocator=allocator) as cpus:
+        assert cpus == [4, 5]
+    assert allocator.allocations() == {}
+
+
+def test_reserve_releases_on_exit(allocator, monkeypatch):
+    monkeypatch.delenv(cores.ALLOCATED_CPUS_ENV, raising=False)
+    with cores.reserve(3, allocator=allocator) as cpus:
+        assert len(cpus) == 3
+        assert set(allocator.allocations()) == {str(c) for c in cpus}
+    assert allocator.allocations() == {}
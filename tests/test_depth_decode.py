@@ -0,0 +1,180 @@
+import filecmp
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+cv2 = pytest.importorskip('cv2')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server', 'scripts'))
+import depth_decode  # noqa: E402
+from multiscan.utils import framestore, zran  # noqa: E402
+
+WIDTH, HEIGHT = 16, 12
+NUM_FRAMES = 23
+
+
+def deflate(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.fixture(scope='module')
+def streams(tmp_path_factory):
+    folder = tmp_path_factory.mktemp('streams')
+    rng = np.random.default_rng(0)
+    depth = rng.uniform(0.2, 4.0, (NUM_FRAMES, HEIGHT, WIDTH))
+    # jumps between consecutive frames trip the delta filter
+    depth[rng.random(depth.shape) < 0.2] += 0.5
+    depth[rng.random(depth.shape) < 0.05] = 0
+    confidence = rng.integers(0, 3, (NUM_FRAMES, HEIGHT, WIDTH), dtype=np.uint8)
+    depth_stream = str(folder / 'scan.depth.zlib')
+    confidence_stream = str(folder / 'scan.confidence.zlib')
+    with open(depth_stream, 'wb') as f:
+        f.write(deflate(depth.astype('float16').tobytes()))
+    with open(confidence_stream, 'wb') as f:
+        f.write(deflate(confidence.tobytes()))
+    return depth_stream, confidence_stream
+
+
+def run_decode(streams, folder, method, step, depth_format='.png', **kwargs):
+    output_depth = os.path.join(folder, 'depth')
+    output_confidence = os.path.join(folder, 'confidence')
+    os.makedirs(output_depth)
+    os.makedirs(output_confidence)
+    decoder = depth_decode.DepthDecode(*streams)
+    decoder.set_filter_params(2, 0.05)
+    decoder.set_frame_params(WIDTH, HEIGHT, depth_unit='m', pixel_size=2, depth_format=depth_format)
+    assert getattr(decoder, method)(output_depth, output_confidence, step, processes=2, **kwargs)
+    return output_depth, output_confidence
+
+
+def assert_same_folders(expected, actual):
+    names = sorted(os.listdir(expected))
+    assert names and names == sorted(os.listdir(actual))
+    _, mismatch, errors = filecmp.cmpfiles(expected, actual, names, shallow=False)
+    assert not mismatch and not errors
+
+
+@pytest.fixture(scope='module', params=[1, 2])
+def reference(request, streams, tmp_path_factory):
+    # one frame per task through temporary files
+    step = request.param
+    folder = str(tmp_path_factory.mktemp('reference'))
+    return step, run_decode(streams, folder, 'decode', step, batch_size=0)
+
+
+def test_reference_exports_all_frames(reference):
+    step, (output_depth, output_confidence) = reference
+    expected = {f'{i}.png' for i in range(0, NUM_FRAMES, step)}
+    assert set(os.listdir(output_depth)) == expected
+    assert set(os.listdir(output_confidence)) == expected
+
+
+@pytest.mark.parametrize('batch_size', [1, 5, NUM_FRAMES, 64])
+def test_batches_match_per_frame_decode(streams, reference, tmp_path, batch_size):
+    # batch sizes not dividing the frame count leave a partial last batch
+    step, expected = reference
+    actual = run_decode(streams, str(tmp_path), 'decode', step, batch_size=batch_size)
+    for expected_folder, actual_folder in zip(expected, actual):
+        assert_same_folders(expected_folder, actual_folder)
+
+
+@pytest.mark.parametrize('batch_size', [1, 5, NUM_FRAMES, 64])
+def test_stream_matches_temp_file_decode(streams, reference, tmp_path, batch_size):
+    step, expected = reference
+    actual = run_decode(streams, str(tmp_path), 'decode_stream', step, batch_size=batch_size)
+    for expected_folder, actual_folder in zip(expected, actual):
+        assert_same_folders(expected_folder, actual_folder)
+
+
+@pytest.mark.skipif(not zran.available(), reason='zlib library not found')
+@pytest.mark.parametrize('batch_size', [1, 5])
+def test_random_access_matches_temp_file_decode(streams, reference, tmp_path, batch_size):
+    step, expected = reference
+    actual = run_decode(streams, str(tmp_path), 'decode_random_access', step, batch_size=batch_size,
+                        checkpoint_frames=4)
+    for expected_folder, actual_folder in zip(expected, actual):
+        assert_same_folders(expected_folder, actual_folder)
+
+
+@pytest.mark.parametrize('method, kwargs', [
+    ('decode', {'batch_size': 5}),
+    ('decode_stream', {'batch_size': 5}),
+])
+def test_frame_store_matches_png_frames(streams, reference, tmp_path, method, kwargs):
+    step, (expected_depth, _) = reference
+    output_depth, _ = run_decode(streams, str(tmp_path), method, step, depth_format=framestore.EXT, **kwargs)
+    store = framestore.FrameStore(framestore.find_store(output_depth))
+    indices = list(range(0, NUM_FRAMES, step))
+    assert len(store) == len(indices)
+    for index in indices:
+        png = depth_decode.cv2.imread(os.path.join(expected_depth, f'{index}.png'), -1)
+        np.testing.assert_array_equal(store.frame(index), png)
+
+
+def test_stream_decode_reports_failure(streams, tmp_path):
+    decoder = depth_decode.DepthDecode(str(tmp_path / 'missing.depth.zlib'), streams[1])
+    decoder.set_frame_params(WIDTH, HEIGHT, depth_unit='m', pixel_size=2, depth_format='.png')
+    os.makedirs(tmp_path / 'depth')
+    assert not decoder.decode_stream(str(tmp_path / 'depth'), None, 1, processes=1, batch_size=5)
+
+
+def reference_depth_colors(fp, depth_unit):
+    """per frame jet colors of the colormap export before the lookup tables"""
+    plt = pytest.importorskip('matplotlib.pyplot')
+    clamp = 4.0
+    if depth_unit == 'mm':
+        clamp *= 1000.0
+    with np.errstate(invalid='ignore'):
+        color = plt.get_cmap('jet')(fp.astype('float') / clamp)
+    color *= 255
+    color = color.astype('uint8')
+    color = cv2.bitwise_and(color, color, mask=(fp != 0).astype('uint8'))
+    return cv2.cvtColor(color, cv2.COLOR_RGBA2BGR)
+
+
+def reference_confidence_colors(fp_confi, levels):
+    plt = pytest.importorskip('matplotlib.pyplot')
+    color = plt.get_cmap('Reds', levels)(fp_confi + 1)
+    color *= 255
+    color = color.astype('uint8')
+    return cv2.cvtColor(color, cv2.COLOR_RGBA2BGRA)
+
+
+@pytest.mark.parametrize('depth_unit, depth_type', [('m', 'float16'), ('mm', 'uint16')])
+def test_depth_color_lut_matches_colormap(depth_unit, depth_type):
+    # every 16 bit value, including negative, infinite and nan float16 values
+    fp = np.arange(65536, dtype='uint32').astype('uint16').view(depth_type).reshape(256, 256)
+    expected = reference_depth_colors(fp, depth_unit)
+    actual = depth_decode.depth_color_lut(depth_unit)[fp.view('uint16')]
+    np.testing.assert_array_equal(actual, expected)
+
+
+@pytest.mark.parametrize('levels', [2, 4, 8])
+def test_confidence_color_lut_matches_colormap(levels):
+    fp_confi = np.arange(256, dtype='uint8').reshape(16, 16)
+    np.testing.assert_array_equal(depth_decode.confidence_color_lut(levels)[fp_confi],
+                                  reference_confidence_colors(fp_confi, levels))
+
+
+def test_color_export_writes_identical_images(tmp_path):
+    rng = np.random.default_rng(0)
+    fp = rng.uniform(0.0, 5.0, (HEIGHT, WIDTH)).astype('float16')
+    fp[rng.random(fp.shape) < 0.2] = 0
+    fp_confi = rng.integers(0, 3, (HEIGHT, WIDTH), dtype=np.uint8)
+    (tmp_path / 'depth').mkdir()
+    (tmp_path / 'confidence').mkdir()
+    writer = depth_decode.ParallelDepthDecode({
+        'tmp': None, 'tmp_confi': None, 'depth_type': 'float16', 'height': HEIGHT, 'width': WIDTH,
+        'frame_size': HEIGHT * WIDTH * 2, 'confidence_filter': True,
+        'output_confidence': str(tmp_path / 'confidence'), 'output_depth': str(tmp_path / 'depth'),
+        'depth_unit': 'm', 'level': 2, 'depth_delta': 0.05, 'pixel_size': 2, 'depth_format': '.png',
+        'export_type': depth_decode.ExportType.COLOR, 'confidence_color_levels': 4,
+    })
+    writer.write(0, fp.copy(), fp_confi)
+    cv2.imwrite(str(tmp_path / 'depth.png'), reference_depth_colors(fp, 'm'))
+    cv2.imwrite(str(tmp_path / 'confidence.png'), reference_confidence_colors(fp_confi, 4))
+    assert (tmp_path / 'depth' / '0.png').read_bytes() == (tmp_path / 'depth.png').read_bytes()
+    assert (tmp_path / 'confidence' / '0.png').read_bytes() == (tmp_path / 'confidence.png').read_bytes()
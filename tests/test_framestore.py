@@ -0,0 +1,92 @@
+import multiprocessing
+import pickle
+
+import numpy as np
+import pytest
+
+from multiscan.utils import framestore
+
+
+def frames(count, height=4, width=6, dtype='uint16'):
+    return np.arange(count * height * width, dtype=dtype).reshape(count, height, width)
+
+
+def write_slot(writer, slot, data):
+    writer.write(slot, data)
+    writer.close()
+
+
+def test_round_trip_in_any_slot_order(tmp_path):
+    path = str(tmp_path / framestore.DEFAULT_NAME)
+    data = frames(5)
+    writer = framestore.FrameStoreWriter(path, 4, 6)
+    for slot in [3, 0, 4]:
+        writer.write(slot, data[slot])
+    # a stack of frames fills consecutive slots
+    writer.write(1, data[1:3])
+    writer.finalize([0, 2, 4, 6, 8], depth_unit='mm', depth_scale=1000.0)
+    writer.close()
+
+    store = framestore.FrameStore(path)
+    assert len(store) == 5
+    np.testing.assert_array_equal(np.stack(list(store)), data)
+    np.testing.assert_array_equal(store[2], data[2])
+    np.testing.assert_array_equal(store.frame(6), data[3])
+    assert store.header['depth_unit'] == 'mm' and store.header['depth_scale'] == 1000.0
+    assert store.frames.dtype == np.uint16
+    with pytest.raises(KeyError):
+        store.frame(1)
+
+
+def test_frames_start_page_aligned(tmp_path):
+    path = str(tmp_path / 'a.frames')
+    writer = framestore.FrameStoreWriter(path, 4, 6, dtype='float32')
+    writer.write(0, frames(2, dtype='float32'))
+    writer.finalize([0, 1])
+    writer.close()
+    store = framestore.FrameStore(path)
+    assert store.header['data_offset'] % 4096 == 0
+    assert store.frames.dtype == np.float32
+
+
+def test_concurrent_writers(tmp_path):
+    path = str(tmp_path / framestore.DEFAULT_NAME)
+    data = frames(8)
+    writer = framestore.FrameStoreWriter(path, 4, 6)
+    with multiprocessing.get_context('fork').Pool(4) as pool:
+        pool.starmap(write_slot, [(writer, slot, data[slot]) for slot in range(8)])
+    writer.finalize(range(8))
+    writer.close()
+    np.testing.assert_array_equal(framestore.FrameStore(path).frames, data)
+
+
+def test_store_is_picklable(tmp_path):
+    path = str(tmp_path / framestore.DEFAULT_NAME)
+    writer = framestore.FrameStoreWriter(path, 4, 6)
+    writer.write(0, frames(3))
+    writer.finalize([0, 1, 2])
+    writer.close()
+    store = pickle.loads(pickle.dumps(framestore.FrameStore(path)))
+    np.testing.assert_array_equal(store.frame(2), frames(3)[2])
+
+
+def test_find_store(tmp_path):
+    assert framestore.find_store(str(tmp_path)) is None
+    path = tmp_path / framestore.DEFAULT_NAME
+    path.write_bytes(b'')
+    assert framestore.find_store(str(tmp_path)) == str(path)
+
+
+def test_invalid_store(tmp_path):
+    path = tmp_path / '0.png'
+    path.write_bytes(b'\x89PNG' + b'\0' * 100)
+    with pytest.raises(IOError):
+        framestore.FrameStore(str(path))
+
+
+def test_oversized_header_attributes(tmp_path):
+    writer = framestore.FrameStoreWriter(str(tmp_path / 'a.frames'), 4, 6)
+    writer.write(0, frames(1))
+    with pytest.raises(ValueError):
+        writer.finalize([0], comment='x' * framestore.HEADER_SIZE)
+    writer.close()
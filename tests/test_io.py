@@ -0,0 +1,143 @@
+import logging
+import os
+import sys
+import time
+
+import pytest
+
+from multiscan.utils import io
+
+
+def touch(path, age=0.0):
+    with open(path, 'w'):
+        pass
+    if age:
+        stamp = time.time() - age
+        os.utime(path, (stamp, stamp))
+
+
+def settle(path, age=10.0):
+    # listings are only cached once the directory mtime is older than its resolution
+    stamp = time.time() - age
+    os.utime(path, (stamp, stamp))
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    io.clear_listing_cache()
+    yield
+    io.clear_listing_cache()
+
+
+@pytest.fixture
+def frames(tmp_path):
+    for name in ['10.png', '2.png', '1.png', '3.exr', 'a10b.txt', 'a9b.txt']:
+        touch(tmp_path / name)
+    (tmp_path / 'sub2').mkdir()
+    (tmp_path / 'sub10').mkdir()
+    settle(tmp_path)
+    return tmp_path
+
+
+def test_alphanum_key_fast_path_matches_general_split():
+    for name in ['0.png', '12.depth.png', '007', '12']:
+        general = tuple(int(c) if c.isdigit() else c for c in io._alphanum_split.split(name))
+        assert io.alphanum_key(name) == general
+
+
+def test_scan_dir_natural_order(frames):
+    assert io.scan_dir(str(frames), join_path=False) == ['1.png', '2.png', '3.exr', '10.png', 'a9b.txt', 'a10b.txt']
+    assert io.scan_dir(str(frames), ext='.png') == [os.path.join(str(frames), n) for n in ['1.png', '2.png', '10.png']]
+    assert io.get_folder_list(str(frames), join_path=False) == ['sub2', 'sub10']
+
+
+def test_scan_dir_matches_uncached_listing(frames):
+    for query in [dict(ext='.png'), dict(files=False, folders=True), dict(folders=True, join_path=False)]:
+        assert io.scan_dir(str(frames), **query) == io.scan_dir(str(frames), cache=False, **query)
+        # second call served from the cache
+        assert io.scan_dir(str(frames), **query) == io.scan_dir(str(frames), cache=False, **query)
+
+
+def test_scan_dir_results_are_copies(frames):
+    listing = io.scan_dir(str(frames), ext='.png')
+    listing.append('junk')
+    assert 'junk' not in io.scan_dir(str(frames), ext='.png')
+
+
+def test_cached_listing_is_reused_while_unchanged(frames, monkeypatch):
+    io.scan_dir(str(frames))
+    calls = []
+    scandir = os.scandir
+    monkeypatch.setattr(io.os, 'scandir', lambda path: calls.append(path) or scandir(path))
+    io.scan_dir(str(frames))
+    io.scan_dir(str(frames), ext='.exr')
+    assert calls == []
+
+
+def test_cache_invalidated_by_directory_change(frames):
+    assert len(io.scan_dir(str(frames), ext='.png')) == 3
+    touch(frames / '4.png')
+    settle(frames, age=5.0)
+    assert io.scan_dir(str(frames), ext='.png', join_path=False) == ['1.png', '2.png', '4.png', '10.png']
+
+
+def test_recently_changed_directory_is_not_cached(tmp_path):
+    touch(tmp_path / '1.png')
+    assert io.scan_dir(str(tmp_path), join_path=False) == ['1.png']
+    assert str(tmp_path) not in io._listing_cache
+
+
+def test_get_file_list_of_missing_directory(tmp_path):
+    assert io.get_file_list(str(tmp_path / 'missing')) == []
+
+
+@pytest.mark.parametrize('script, out_of_memory', [
+    ('raise MemoryError()', True),
+    ('import sys; sys.exit(1)', False),
+])
+def test_call_records_out_of_memory_output(tmp_path, script, out_of_memory):
+    metrics_file = str(tmp_path / 'metrics.jsonl')
+    log = logging.getLogger('test_io')
+    for print_at_run in [True, False]:
+        assert io.call([sys.executable, '-c', script], log, desc='oom', print_at_run=print_at_run,
+                       metrics_file=metrics_file) == 1
+    records = io.read_metrics(metrics_file)
+    assert [record['out_of_memory'] for record in records] == [out_of_memory, out_of_memory]
+    assert records[0]['desc'] == 'oom'
+
+
+def test_call_records_child_resource_usage(tmp_path):
+    metrics_file = str(tmp_path / 'metrics.jsonl')
+    log = logging.getLogger('test_io')
+    # burn cpu for a while and touch 200 MB
+    script = ('import time\n'
+              'data = bytearray(200 * 1000 * 1000)\n'
+              'start = time.process_time()\n'
+              'while time.process_time() - start < 0.3:\n'
+              '    pass\n')
+    assert io.call([sys.executable, '-c', script], log, desc='busy', print_at_run=False,
+                   metrics_file=metrics_file) == 0
+    records = io.read_metrics(metrics_file)
+    assert len(records) == 1
+    record = records[0]
+    assert record['desc'] == 'busy' and record['returncode'] == 0
+    assert record['cpu_time'] >= 0.25 and record['user_time'] > 0 and record['sys_time'] >= 0
+    assert record['cpu_time'] == pytest.approx(record['user_time'] + record['sys_time'])
+    assert record['wall_time'] >= record['cpu_time'] * 0.9
+    assert 200 * 1000 * 1000 <= record['max_rss'] < 2000 * 1000 * 1000
+    assert not record['out_of_memory']
+
+
+def test_timings_read_the_configured_metrics_file(tmp_path, monkeypatch):
+    pytest.importorskip('pytimeparse')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+    try:
+        import compute_timings
+    finally:
+        sys.path.pop(0)
+    assert compute_timings.getMetricsFilename() == 'process_metrics.jsonl'
+    io.write_metrics({'desc': 'recons', 'wall_time': 2.0, 'user_time': 1.5, 'max_rss': 1024}, str(tmp_path / 'm.jsonl'))
+    output = tmp_path / 'timings.csv'
+    monkeypatch.setattr(sys, 'argv', ['compute_timings.py', str(tmp_path), str(output), '--metrics_file', 'm.jsonl'])
+    compute_timings.main()
+    assert output.read_text().splitlines()[1].startswith('recons,0:00:02,2.0,1.5,')
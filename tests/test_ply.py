@@ -0,0 +1,143 @@
+import io
+
+import numpy as np
+import pytest
+
+from multiscan.utils import ply
+
+
+def random_mesh(num_vertices=50, num_faces=80, seed=0):
+    rng = np.random.default_rng(seed)
+    return {
+        'vertices': rng.normal(size=(num_vertices, 3)).astype(np.float32),
+        'faces': rng.integers(0, num_vertices, (num_faces, 3)).astype(np.int32),
+        'normals': rng.normal(size=(num_vertices, 3)).astype(np.float32),
+        'colors': rng.integers(0, 256, (num_vertices, 3)).astype(np.uint8),
+        'objectId': rng.integers(0, 10, num_faces).astype(np.uint16),
+        'partId': rng.integers(0, 100, num_faces).astype(np.uint16),
+    }
+
+
+def write_random_mesh(path, mesh):
+    ply.write_mesh(str(path), mesh['vertices'], mesh['faces'], normals=mesh['normals'], colors=mesh['colors'],
+                   face_properties={'objectId': mesh['objectId'], 'partId': mesh['partId']}, comments=['test'])
+    return str(path)
+
+
+def assert_mesh_equal(data, mesh):
+    np.testing.assert_array_equal(data['vertices'], mesh['vertices'])
+    np.testing.assert_array_equal(data['normals'], mesh['normals'])
+    np.testing.assert_array_equal(data['colors'], mesh['colors'])
+    np.testing.assert_array_equal(data['faces'], mesh['faces'])
+    assert data['faces'].dtype == np.int32 and data['faces'].shape == (len(mesh['faces']), 3)
+    np.testing.assert_array_equal(data['face']['objectId'], mesh['objectId'])
+    np.testing.assert_array_equal(data['face']['partId'], mesh['partId'])
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_mesh_round_trip(tmp_path, mmap):
+    mesh = random_mesh()
+    path = write_random_mesh(tmp_path / 'mesh.ply', mesh)
+    data = ply.read_mesh(path, mmap=mmap)
+    assert_mesh_equal(data, mesh)
+    # the faces are a view of the face element, changes are not written back to the file
+    assert np.shares_memory(data['faces'], data['face'])
+    data['faces'][0] = 0
+    assert_mesh_equal(ply.read_mesh(path), mesh)
+
+
+def test_read_from_bytes_and_file_objects(tmp_path):
+    mesh = random_mesh()
+    path = write_random_mesh(tmp_path / 'mesh.ply', mesh)
+    with open(path, 'rb') as f:
+        content = f.read()
+    assert_mesh_equal(ply.read_mesh(content), mesh)
+    assert_mesh_equal(ply.read_mesh(io.BytesIO(content)), mesh)
+
+
+def test_rewrite_read_elements(tmp_path):
+    mesh = random_mesh()
+    path = write_random_mesh(tmp_path / 'mesh.ply', mesh)
+    data = ply.read_ply(path)
+    copy = str(tmp_path / 'copy.ply')
+    ply.write_ply(copy, data)
+    with open(path, 'rb') as f, open(copy, 'rb') as g:
+        # identical up to the comment
+        assert f.read().replace(b'comment test\n', b'') == g.read()
+
+
+def test_variable_length_lists_are_read_by_rows(tmp_path):
+    # a triangle and a quad with a per face label after the list
+    vertex = np.zeros(4, dtype=[('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    vertex['x'] = [0, 1, 1, 0]
+    vertex['y'] = [0, 0, 1, 1]
+    header = b'ply\nformat binary_little_endian 1.0\nelement vertex 4\n' \
+             b'property float x\nproperty float y\nproperty float z\n' \
+             b'element face 2\nproperty list uchar int vertex_indices\nproperty ushort label\nend_header\n'
+    body = vertex.tobytes() + np.array([3], 'u1').tobytes() + np.array([0, 1, 2], '<i4').tobytes() + \
+        np.array([7], '<u2').tobytes() + np.array([4], 'u1').tobytes() + \
+        np.array([0, 1, 2, 3], '<i4').tobytes() + np.array([9], '<u2').tobytes()
+    path = tmp_path / 'polygons.ply'
+    path.write_bytes(header + body)
+    data = ply.read_ply(str(path))
+    assert data['face']['vertex_indices_count'].tolist() == [3, 4]
+    assert data['face']['vertex_indices'].tolist() == [[0, 1, 2, 0], [0, 1, 2, 3]]
+    assert data['face']['label'].tolist() == [7, 9]
+    np.testing.assert_array_equal(data['vertex']['x'], vertex['x'])
+    with pytest.raises(ValueError):
+        ply.faces(data['face'])
+
+
+def test_ascii_and_big_endian_files(tmp_path):
+    mesh = random_mesh(num_vertices=6, num_faces=4)
+    lines = [b'ply', b'format ascii 1.0', b'element vertex 6', b'property float x', b'property float y',
+             b'property float z', b'element face 4', b'property list uchar int vertex_index', b'end_header']
+    lines += [b'%r %r %r' % tuple(float(value) for value in vertex) for vertex in mesh['vertices']]
+    lines += [b'3 %d %d %d' % tuple(face) for face in mesh['faces']]
+    path = tmp_path / 'ascii.ply'
+    path.write_bytes(b'\n'.join(lines) + b'\n')
+    data = ply.read_mesh(str(path))
+    np.testing.assert_array_equal(data['vertices'], mesh['vertices'])
+    np.testing.assert_array_equal(data['faces'], mesh['faces'])
+
+    header = b'ply\nformat binary_big_endian 1.0\nelement vertex 6\n' \
+             b'property float x\nproperty float y\nproperty float z\n' \
+             b'element face 4\nproperty list uchar int vertex_indices\nend_header\n'
+    face = np.empty(4, dtype=[('count', 'u1'), ('indices', '>i4', (3,))])
+    face['count'] = 3
+    face['indices'] = mesh['faces']
+    path = tmp_path / 'big_endian.ply'
+    path.write_bytes(header + mesh['vertices'].astype('>f4').tobytes() + face.tobytes())
+    data = ply.read_mesh(str(path))
+    np.testing.assert_array_equal(data['vertices'], mesh['vertices'])
+    np.testing.assert_array_equal(data['faces'], mesh['faces'])
+    assert data['faces'].dtype == np.int32
+
+
+def test_empty_and_invalid_files(tmp_path):
+    path = str(tmp_path / 'empty.ply')
+    ply.write_mesh(path, np.empty((0, 3)), np.empty((0, 3), dtype=np.int32))
+    data = ply.read_mesh(path)
+    assert data['vertices'].shape == (0, 3) and data['faces'].shape == (0, 3)
+    with pytest.raises(IOError):
+        ply.read_ply(b'obj\n')
+    with pytest.raises(IOError):
+        ply.read_ply(b'ply\nformat binary_little_endian 1.0\nelement vertex 1\n')
+
+
+def test_open3d_reads_written_meshes(tmp_path):
+    o3d = pytest.importorskip('open3d')
+    mesh = random_mesh()
+    path = write_random_mesh(tmp_path / 'mesh.ply', mesh)
+    o3d_mesh = o3d.io.read_triangle_mesh(path)
+    np.testing.assert_allclose(np.asarray(o3d_mesh.vertices), mesh['vertices'])
+    np.testing.assert_array_equal(np.asarray(o3d_mesh.triangles), mesh['faces'])
+    np.testing.assert_allclose(np.asarray(o3d_mesh.vertex_colors), mesh['colors'] / 255.0)
+
+    # and meshes written by open3d are read the same
+    o3d_path = str(tmp_path / 'open3d.ply')
+    o3d.io.write_triangle_mesh(o3d_path, o3d_mesh)
+    data = ply.read_mesh(o3d_path)
+    np.testing.assert_allclose(data['vertices'], mesh['vertices'])
+    np.testing.assert_array_equal(data['faces'], mesh['faces'])
+    np.testing.assert_array_equal(data['colors'], mesh['colors'])
@@ -0,0 +1,161 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+o3d = pytest.importorskip('open3d')
+pymeshlab = pytest.importorskip('pymeshlab')
+from scipy.spatial import ConvexHull  # noqa: E402
+
+from multiscan.meshproc import TriMesh, gravity_aligned_obbs, min_area_rectangles  # noqa: E402
+from multiscan.utils import ply  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from bench_obb import legacy_min_area_direction  # noqa: E402
+
+# the cleanup runs the filters of pymeshlab 0.2, renamed in later releases
+HAS_MESHLAB_FILTERS = hasattr(pymeshlab.MeshSet(), 'remove_isolated_pieces_wrt_face_num')
+
+
+def grid_mesh(size=20, seed=0):
+    """a bumpy grid with a duplicated vertex and a two triangle component far from it"""
+    rng = np.random.default_rng(seed)
+    x, y = np.meshgrid(np.arange(size, dtype=np.float32), np.arange(size, dtype=np.float32))
+    vertices = np.stack([x.ravel(), y.ravel(), rng.uniform(0, 0.3, x.size).astype(np.float32)], axis=1) * 0.1
+    quads = (np.arange(size - 1)[None, :] + size * np.arange(size - 1)[:, None]).ravel()
+    faces = np.concatenate([np.stack([quads, quads + 1, quads + size + 1], axis=1),
+                            np.stack([quads, quads + size + 1, quads + size], axis=1)])
+    # a copy of the first vertex referenced by the first face
+    vertices = np.vstack([vertices, vertices[:1]])
+    faces[0, 0] = len(vertices) - 1
+    # tiny isolated component
+    island = np.array([[5, 5, 5], [5.1, 5, 5], [5, 5.1, 5], [5.1, 5.1, 5]], dtype=np.float32)
+    faces = np.vstack([faces, np.array([[0, 1, 3], [0, 3, 2]]) + len(vertices)]).astype(np.int32)
+    vertices = np.vstack([vertices, island]).astype(np.float32)
+    colors = rng.integers(0, 256, (len(vertices), 3)).astype(np.uint8)
+    return vertices, faces, colors
+
+
+@pytest.mark.skipif(not HAS_MESHLAB_FILTERS, reason='pymeshlab 0.2 filter names')
+def test_in_memory_cleanup_matches_the_file_cleanup(tmp_path):
+    vertices, faces, colors = grid_mesh()
+    input_file = str(tmp_path / 'mesh.ply')
+    ply.write_mesh(input_file, vertices, faces, colors=colors)
+    output_file = str(tmp_path / 'cleaned.ply')
+    TriMesh.cleanup_mesh(input_file, output_file=output_file)
+    expected = ply.read_mesh(output_file)
+
+    cleaned = TriMesh.cleanup_o3d_mesh(o3d.io.read_triangle_mesh(input_file))
+    # the duplicated vertex is merged and the island removed
+    assert len(expected['vertices']) == len(vertices) - 5
+    assert len(expected['faces']) == len(faces) - 2
+    np.testing.assert_array_equal(np.asarray(cleaned.vertices, dtype=np.float32), expected['vertices'])
+    np.testing.assert_array_equal(np.asarray(cleaned.triangles), expected['faces'])
+    np.testing.assert_array_equal(np.round(np.asarray(cleaned.vertex_colors) * 255).astype(np.uint8),
+                                  expected['colors'][:, :3])
+    np.testing.assert_allclose(np.asarray(cleaned.vertex_normals), expected['normals'], atol=1e-6)
+
+
+def random_hulls(count, seed=0):
+    """convex hulls in counterclockwise order of random point clouds of different sizes"""
+    rng = np.random.default_rng(seed)
+    hulls = []
+    for _ in range(count):
+        points = rng.normal(size=(rng.integers(5, 60), 2)) * rng.uniform(0.5, 3.0, 2) + rng.uniform(-5, 5, 2)
+        hulls.append(points[ConvexHull(points).vertices])
+    return hulls
+
+
+def pad(hulls):
+    """hulls padded by repeating their last vertex, as in gravity_aligned_obbs"""
+    num = max(len(hull) for hull in hulls)
+    return np.stack([np.concatenate([hull, np.repeat(hull[-1:], num - len(hull), axis=0)]) for hull in hulls])
+
+
+def extents(hull, direction):
+    """extents of a hull along a direction and its orthogonal direction"""
+    along = hull @ direction
+    across = hull @ np.array([direction[1], -direction[0]])
+    return np.array([np.ptp(along), np.ptp(across)])
+
+
+def brute_force_rectangle(hull):
+    """minimum area rectangle over all edge orientations, ties go to the smallest angle in [0, 90)"""
+    best = None
+    for start, end in zip(hull, np.roll(hull, -1, axis=0)):
+        if np.all(start == end):
+            continue
+        angle = np.arctan2(end[1] - start[1], end[0] - start[0]) % (np.pi / 2)
+        direction = np.array([np.cos(angle), np.sin(angle)])
+        area = np.prod(extents(hull, direction))
+        if best is None or area < best[0] * (1 - 1e-12) or (area <= best[0] * (1 + 1e-12) and angle < best[1]):
+            best = (area, angle, direction)
+    return best
+
+
+def test_rectangles_match_the_calipers_loop():
+    hulls = random_hulls(300)
+    bottom_dirs, left_dirs, sizes = min_area_rectangles(pad(hulls))
+    for hull, bottom_dir, left_dir, size in zip(hulls, bottom_dirs, left_dirs, sizes):
+        direction = legacy_min_area_direction(hull)
+        expected = extents(hull, direction)
+        np.testing.assert_allclose(np.prod(size), np.prod(expected), rtol=1e-9)
+        np.testing.assert_allclose(extents(hull, bottom_dir), size, rtol=1e-9)
+        # the legacy loop returns the direction of the shorter side
+        shorter = bottom_dir if size[0] < size[1] else left_dir
+        assert abs(np.cross(shorter, direction)) < 1e-9
+
+
+def test_padded_hulls_match_unpadded_hulls():
+    hulls = random_hulls(50, seed=1)
+    batched = min_area_rectangles(pad(hulls))
+    for i, hull in enumerate(hulls):
+        for expected, actual in zip(min_area_rectangles(hull[None]), batched):
+            np.testing.assert_allclose(actual[i], expected[0], rtol=1e-12, atol=1e-12)
+
+
+def test_rectangles_match_brute_force_with_ties():
+    rng = np.random.default_rng(2)
+    hulls = random_hulls(100, seed=3)
+    # regular polygons have several orientations of the same minimum area
+    for sides in (3, 4, 5, 6, 8, 12):
+        for offset in rng.uniform(0, 2 * np.pi, 5):
+            angles = offset + 2 * np.pi * np.arange(sides) / sides
+            hulls.append(rng.uniform(0.5, 2.0) * np.stack([np.cos(angles), np.sin(angles)], axis=1))
+    bottom_dirs, left_dirs, sizes = min_area_rectangles(pad(hulls))
+    for hull, bottom_dir, left_dir, size in zip(hulls, bottom_dirs, left_dirs, sizes):
+        area, angle, direction = brute_force_rectangle(hull)
+        np.testing.assert_allclose(np.prod(size), area, rtol=1e-9)
+        np.testing.assert_allclose(bottom_dir, direction, atol=1e-9)
+        np.testing.assert_allclose(left_dir, [bottom_dir[1], -bottom_dir[0]])
+        assert bottom_dir[0] > 0 and bottom_dir[1] >= 0
+
+
+def box_surface_points(size, yaw, center, seed=0):
+    """points on the faces of a box rotated by yaw around the y axis"""
+    rng = np.random.default_rng(seed)
+    points = rng.uniform(-0.5, 0.5, (6000, 3))
+    face = rng.integers(0, 3, len(points))
+    points[np.arange(len(points)), face] = rng.choice([-0.5, 0.5], len(points))
+    rotation = np.array([[np.cos(yaw), 0, np.sin(yaw)], [0, 1, 0], [-np.sin(yaw), 0, np.cos(yaw)]])
+    return (points * size) @ rotation.T + center
+
+
+def test_gravity_aligned_boxes_of_rotated_boxes():
+    boxes = [((4.0, 2.5, 3.0), 0.3, (1.0, 1.2, -2.0)), ((1.0, 0.8, 0.5), 1.2, (0.0, 0.4, 0.0)),
+             ((2.0, 3.0, 6.0), -0.7, (-3.0, 1.5, 4.0))]
+    point_sets = [box_surface_points(np.array(size), yaw, center, seed)
+                  for seed, (size, yaw, center) in enumerate(boxes)]
+    obbs = gravity_aligned_obbs(point_sets, max_points=0)
+    for (size, _, center), (obb_center, obb_size, rotation), points in zip(boxes, obbs, point_sets):
+        np.testing.assert_allclose(obb_center, center, atol=0.05)
+        # the up axis keeps the height, the horizontal sides are found up to their order
+        np.testing.assert_allclose(obb_size[2], size[1], rtol=0.02)
+        np.testing.assert_allclose(sorted(obb_size[:2]), sorted([size[0], size[2]]), rtol=0.02)
+        np.testing.assert_allclose(rotation @ rotation.T, np.eye(3), atol=1e-9)
+        # the boxes of a batch are the boxes of the point sets alone
+        (alone_center, alone_size, alone_rotation), = gravity_aligned_obbs([points], max_points=0)
+        np.testing.assert_allclose(obb_center, alone_center, atol=1e-9)
+        np.testing.assert_allclose(obb_size, alone_size, atol=1e-9)
+        np.testing.assert_allclose(rotation, alone_rotation, atol=1e-9)
@@ -0,0 +1,143 @@
+import os
+import signal
+import time
+
+import pytest
+
+from multiscan.utils import pool
+from multiscan.utils.pool import GB, MemoryAwarePool
+
+
+def sleep_job(duration, mem_limit=None):
+    start = time.time()
+    time.sleep(duration)
+    return start, time.time(), mem_limit
+
+
+def flaky_job(marker, failure, delay=0.0, mem_limit=None):
+    # fails on the first attempt, the marker file records the attempt across processes
+    if not os.path.exists(marker):
+        time.sleep(delay)
+        with open(marker, 'w'):
+            pass
+        if failure == 'memory_error':
+            raise MemoryError('simulated')
+        elif failure == 'value_error':
+            raise ValueError('simulated')
+        return failure
+    return sleep_job(0.0, mem_limit)
+
+
+@pytest.fixture(autouse=True)
+def memory(monkeypatch):
+    # 10 GB available to the jobs
+    monkeypatch.setattr(pool, 'available_memory', lambda: 10 * GB)
+
+
+def overlap(a, b):
+    return a[0] < b[1] and b[0] < a[1]
+
+
+def test_jobs_fitting_the_budget_run_concurrently():
+    with MemoryAwarePool(2, fraction=1.0) as p:
+        p.submit(sleep_job, 0.5, mem=4 * GB)
+        p.submit(sleep_job, 0.5, mem=4 * GB)
+        first, second = p.join()
+    assert overlap(first, second)
+
+
+def test_jobs_exceeding_the_budget_are_queued():
+    with MemoryAwarePool(2, fraction=1.0) as p:
+        p.submit(sleep_job, 0.3, mem=6 * GB)
+        p.submit(sleep_job, 0.3, mem=6 * GB)
+        first, second = p.join()
+    assert second[0] >= first[1]
+
+
+def test_fraction_reduces_the_budget():
+    with MemoryAwarePool(2, fraction=0.5) as p:
+        p.submit(sleep_job, 0.3, mem=3 * GB)
+        p.submit(sleep_job, 0.3, mem=3 * GB)
+        first, second = p.join()
+    assert second[0] >= first[1]
+
+
+def test_queue_starts_jobs_in_submission_order():
+    with MemoryAwarePool(3, fraction=1.0) as p:
+        p.submit(sleep_job, 0.3, mem=8 * GB)
+        p.submit(sleep_job, 0.1, mem=6 * GB)
+        # fits next to the first job but waits behind the second
+        p.submit(sleep_job, 0.1, mem=1 * GB)
+        first, second, third = p.join()
+    assert second[0] >= first[1]
+    assert third[0] >= second[0]
+
+
+def test_oversized_job_runs_alone():
+    with MemoryAwarePool(2, fraction=1.0) as p:
+        p.submit(sleep_job, 0.2, mem=20 * GB)
+        p.submit(sleep_job, 0.2, mem=1 * GB)
+        first, second = p.join()
+    assert second[0] >= first[1]
+
+
+def test_memory_limit_is_independent_of_the_budget():
+    with MemoryAwarePool(2, fraction=0.1, min_limit=48) as p:
+        p.submit(sleep_job, 0.0, mem=1 * GB)
+        p.submit(sleep_job, 0.0, mem=60 * GB)
+        small, large = p.join()
+    assert small[2] == 48
+    assert large[2] == 60
+
+
+@pytest.mark.parametrize('failure', [-signal.SIGKILL, -signal.SIGABRT, 'memory_error'])
+def test_out_of_memory_job_is_retried_with_a_larger_limit(tmp_path, failure):
+    with MemoryAwarePool(2, fraction=1.0, retry_factor=1.5, min_limit=48) as p:
+        job = p.submit(flaky_job, str(tmp_path / 'marker'), failure, mem=1 * GB)
+        result, = p.join()
+    assert job.attempt == 1
+    assert result[2] == 72
+
+
+@pytest.mark.parametrize('failure', [1, 'value_error'])
+def test_other_failures_are_not_retried(tmp_path, failure):
+    with MemoryAwarePool(2, fraction=1.0) as p:
+        job = p.submit(flaky_job, str(tmp_path / 'marker'), failure, mem=1 * GB)
+        result, = p.join()
+    assert job.attempt == 0
+    if failure == 1:
+        assert result == 1
+    else:
+        assert isinstance(result, ValueError)
+
+
+def test_retry_runs_alone(tmp_path):
+    marker = tmp_path / 'marker'
+    with MemoryAwarePool(3, fraction=1.0) as p:
+        retried = p.submit(flaky_job, str(marker), -signal.SIGKILL, 0.2, mem=1 * GB)
+        p.submit(sleep_job, 0.6, mem=1 * GB)
+        while retried.attempt == 0:
+            time.sleep(0.01)
+        # queued behind the retry
+        p.submit(sleep_job, 0.0, mem=1 * GB)
+        first, other, queued = p.join()
+    assert retried.attempt == 1
+    assert first[0] >= other[1]
+    assert queued[0] >= first[1]
+
+
+def test_retries_are_limited(tmp_path):
+    with MemoryAwarePool(1, fraction=1.0, max_retries=0) as p:
+        job = p.submit(flaky_job, str(tmp_path / 'marker'), -signal.SIGKILL, mem=1 * GB)
+        result, = p.join()
+    assert job.attempt == 0
+    assert result == -signal.SIGKILL
+
+
+def test_is_oom_record():
+    assert pool.is_oom_record({'returncode': -signal.SIGKILL})
+    assert pool.is_oom_record({'returncode': -signal.SIGABRT})
+    assert pool.is_oom_record({'returncode': 1, 'out_of_memory': True})
+    assert not pool.is_oom_record({'returncode': 1, 'out_of_memory': False})
+    assert not pool.is_oom_record({'returncode': 0, 'out_of_memory': True})
+    assert not pool.is_oom_record({'returncode': -signal.SIGTERM})
@@ -0,0 +1,273 @@
+import json
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('decord')
+o3d = pytest.importorskip('open3d')
+pymeshlab = pytest.importorskip('pymeshlab')
+from omegaconf import OmegaConf  # noqa: E402
+
+from reconstruction.scripts.bridge import Bridge  # noqa: E402
+from multiscan.utils import trajectory  # noqa: E402
+from reconstruction.scripts import checkpoint  # noqa: E402
+from reconstruction.scripts.reconstruct import Reconstruct  # noqa: E402
+from conftest import DEPTH_SIZE, EMPTY_FRAMES, META_FRAMES, VIDEO_FRAMES  # noqa: E402
+
+
+# TSDFVoxelGrid frames are converted with the tensor image API of open3d before 0.14
+HAS_TENSOR_IMAGE = hasattr(o3d.t.geometry.Image, 'from_legacy_image')
+# integration checkpoints use the voxel block hash map of open3d 0.13
+HAS_BLOCK_HASHMAP = HAS_TENSOR_IMAGE and hasattr(getattr(o3d.t.geometry, 'TSDFVoxelGrid', None), 'get_block_hashmap')
+
+VOLUME_SETUPS = [
+    pytest.param('TSDFVoxelGrid', False, marks=pytest.mark.skipif(not HAS_TENSOR_IMAGE, reason='open3d >= 0.14')),
+    pytest.param('TSDFVoxelGrid', True, marks=pytest.mark.skipif(not HAS_TENSOR_IMAGE, reason='open3d >= 0.14')),
+    # ScalableTSDFVolume integrates color frames only
+    ('ScalableTSDFVolume', True),
+]
+
+
+def make_reconstruct(stream_scan, with_color, prefetch, volume_type='ScalableTSDFVolume'):
+    config = OmegaConf.create({
+        'settings': {'debug': False, 'device_type': 'cpu', 'device_id': 0, 'resume': False},
+        'input': stream_scan,
+        'alg_param': {
+            'volume_type': volume_type,
+            'frames': {'step': 1, 'use_opencv': False, 'color_at_depth_resolution': True, 'color_batch_size': 4,
+                       'random_access': False, 'cache_size': 4},
+            'integration': {'with_color': with_color, 'prefetch': prefetch, 'block_resolution': 24,
+                            'block_count': 30000, 'default_block_count': 30000, 'block_margin': 1.2,
+                            'min_block_count': 1000, 'block_memory_cap': 4096, 'voxel_len_fine': 0.01,
+                            'sdf_trunc': 0.04, 'checkpoint': {'every': 0, 'folder': 'integration_checkpoint'},
+                            'voxel_type': {'tsdf': 'Float32', 'weight': 'UInt16', 'color': 'UInt16'}},
+            'depth_filter': {'level': 2, 'delta_thresh': 0.05, 'min_portion': 0.1},
+            'depth_thresh': {'min': 0.2, 'max': 3.0, 'scale': 1000.0},
+        },
+    })
+    bridge = Bridge(config)
+    bridge.open_all()
+    bridge.read_metadata()
+    recons = Reconstruct(config, bridge)
+    num_frames = bridge.meta['num_frames']
+    recons._extrinsics = np.tile(np.eye(4), (num_frames, 1, 1))
+    recons._intrinsics = np.tile(np.array([[10.0, 0, 8], [0, 10.0, 6], [0, 0, 1]]), (num_frames, 1, 1))
+    return recons
+
+
+def prepared_frames(recons, indices):
+    color_frames = None
+    if recons.config.alg_param.integration.with_color:
+        color_frames = recons.bridge.iter_colorframes([recons._frame_i_abs[i] for i in indices])
+    frames = []
+    for frame in recons._iter_prepared_frames(indices, color_frames):
+        if frame is None:
+            frames.append(None)
+            continue
+        frames.append(tuple(frame_arrays(item) for item in frame))
+    recons.bridge.close_all()
+    return frames
+
+
+def frame_arrays(item):
+    if item is None:
+        return None
+    if isinstance(item, o3d.camera.PinholeCameraIntrinsic):
+        return item.intrinsic_matrix
+    if hasattr(item, 'as_tensor'):
+        item = item.as_tensor()
+    if hasattr(item, 'numpy'):
+        return item.numpy().copy()
+    return np.array(item)
+
+
+def producers():
+    return [thread for thread in threading.enumerate() if thread.name == 'frame-producer']
+
+
+@pytest.mark.parametrize('volume_type, with_color', VOLUME_SETUPS)
+@pytest.mark.parametrize('prefetch', [1, 4, 64])
+def test_prefetch_matches_sequential_preparation(stream_scan, volume_type, with_color, prefetch):
+    # color frames are decoded from the video, which may hold fewer frames than the depth stream
+    num_frames = VIDEO_FRAMES if with_color else META_FRAMES
+    indices = list(range(num_frames))
+    expected = prepared_frames(make_reconstruct(stream_scan, with_color, 0, volume_type), indices)
+    actual = prepared_frames(make_reconstruct(stream_scan, with_color, prefetch, volume_type), indices)
+    assert [frame is None for frame in actual] == [frame is None for frame in expected]
+    # frames without enough valid depth are skipped in both modes
+    assert {i for i, frame in enumerate(expected) if frame is None} >= set(EMPTY_FRAMES)
+    assert any(frame is not None for frame in expected)
+    for expected_frame, actual_frame in zip(expected, actual):
+        if expected_frame is None:
+            continue
+        for expected_array, actual_array in zip(expected_frame, actual_frame):
+            if expected_array is None:
+                assert actual_array is None
+            else:
+                np.testing.assert_array_equal(actual_array, expected_array)
+    assert not producers()
+
+
+def test_early_exit_stops_the_producer(stream_scan):
+    recons = make_reconstruct(stream_scan, True, 2)
+    indices = list(range(VIDEO_FRAMES))
+    frames = recons._iter_prepared_frames(indices, recons.bridge.iter_colorframes(indices))
+    next(frames)
+    frames.close()
+    assert not producers()
+    recons.bridge.close_all()
+
+
+def test_producer_errors_are_raised(stream_scan):
+    recons = make_reconstruct(stream_scan, True, 2)
+    # no camera pose for the last frames
+    recons._extrinsics = recons._extrinsics[:3]
+    indices = list(range(VIDEO_FRAMES))
+    with pytest.raises(IndexError):
+        list(recons._iter_prepared_frames(indices, recons.bridge.iter_colorframes(indices)))
+    assert not producers()
+    recons.bridge.close_all()
+
+
+def test_motion_selection_of_step_frames(stream_scan):
+    recons = make_reconstruct(stream_scan, False, 0)
+    recons.bridge.close_all()
+    frames = recons.config.alg_param.frames
+    frames.step = 2
+    recons._skip_step = 2
+    assert recons._select_frames() == list(range(0, META_FRAMES, 2))
+
+    # the camera moves 2 cm per frame, 4 cm per step-th frame
+    for i in range(META_FRAMES):
+        recons._extrinsics[i][0, 3] = -0.02 * i
+    frames.selection = 'motion'
+    frames.min_translation = 0.05
+    frames.min_rotation = 5.0
+    frames.max_gap = 0
+    assert recons._select_frames() == [0, 4, 8]
+    # max_gap counts frames and is rounded down to step-th frames
+    frames.min_translation = 1.0
+    frames.max_gap = 5
+    assert recons._select_frames() == [0, 6]
+    frames.selection = 'keyframes'
+    with pytest.raises(ValueError):
+        recons._select_frames()
+
+
+def test_block_count_from_camera_frustums(stream_scan):
+    recons = make_reconstruct(stream_scan, False, 0)
+    recons.bridge.close_all()
+    integration = recons.config.alg_param.integration
+    frame_indices = list(range(META_FRAMES))
+    # a fixed block count unless auto sizing is enabled
+    assert recons._estimate_block_count(frame_indices) == (30000, None)
+
+    # the camera turns by 20 degrees per frame
+    for i in range(META_FRAMES):
+        angle = np.deg2rad(20 * i)
+        recons._extrinsics[i][:3, :3] = [[np.cos(angle), 0, -np.sin(angle)], [0, 1, 0],
+                                         [np.sin(angle), 0, np.cos(angle)]]
+    num_blocks = len(trajectory.frustum_blocks(recons._extrinsics, recons._intrinsics, *DEPTH_SIZE, 0.2, 3.0, 0.24))
+    integration.block_count = 'auto'
+    # small volumes get the estimate with its margin, not the fixed default
+    estimate = int(np.ceil(num_blocks * 1.2))
+    assert 1000 < estimate < 30000
+    assert recons._estimate_block_count(frame_indices) == (estimate, num_blocks)
+    # at least the safety minimum
+    integration.min_block_count = 20000
+    assert recons._estimate_block_count(frame_indices) == (20000, num_blocks)
+    # the memory cap applies last, 4096 MB hold 25890 blocks of 24^3 voxels with 12 bytes
+    integration.min_block_count = 30000
+    assert recons._estimate_block_count(frame_indices) == (25890, num_blocks)
+    integration.min_block_count = 1
+    integration.block_memory_cap = 100 * 12 * 24 ** 3 / 1024 / 1024
+    assert recons._estimate_block_count(frame_indices) == (100, num_blocks)
+    # without intrinsics of all frames
+    recons._intrinsics = recons._intrinsics[:1]
+    assert recons._estimate_block_count(frame_indices) == (30000, None)
+
+
+def saved_blocks(volume, path):
+    """voxel blocks of a volume ordered by their coordinates"""
+    checkpoint.save_volume(volume, path)
+    with np.load(path) as data:
+        keys, values = data['keys'], data['values']
+    order = np.lexsort(keys.reshape(len(keys), -1).T)
+    return keys[order], values[order]
+
+
+@pytest.mark.skipif(not HAS_BLOCK_HASHMAP, reason='open3d 0.13 TSDFVoxelGrid')
+def test_resumed_integration_matches_an_uninterrupted_one(stream_scan, tmp_path):
+    frame_indices = list(range(META_FRAMES))
+    # checkpoint after 7 frames only
+    recons = make_reconstruct(stream_scan, False, 0, 'TSDFVoxelGrid')
+    recons.config.output = {'save_folder': str(tmp_path)}
+    recons.config.alg_param.integration.checkpoint.every = 7
+    volume = recons._integrate_with_traj(recons.create_volume(1000), frame_indices)
+    recons.bridge.close_all()
+    expected = saved_blocks(volume, str(tmp_path / 'expected.npz'))
+    assert len(expected[0]) > 0
+    with open(tmp_path / 'integration_checkpoint' / checkpoint.CURSOR_FILE) as f:
+        assert json.load(f)['position'] == 7
+
+    recons = make_reconstruct(stream_scan, False, 0, 'TSDFVoxelGrid')
+    recons.config.output = {'save_folder': str(tmp_path)}
+    recons.config.alg_param.integration.checkpoint.every = 7
+    recons.config.settings.resume = True
+    integrated = []
+    integrate_frame = recons._integrate_frame
+    recons._integrate_frame = lambda volume, frame: integrated.append(frame) or integrate_frame(volume, frame)
+    volume = recons._integrate_with_traj(recons.create_volume(1000), frame_indices)
+    recons.bridge.close_all()
+    # only the frames after the checkpoint are integrated again
+    assert len(integrated) == len([i for i in range(7, META_FRAMES) if i not in EMPTY_FRAMES])
+    actual = saved_blocks(volume, str(tmp_path / 'actual.npz'))
+    np.testing.assert_array_equal(actual[0], expected[0])
+    np.testing.assert_array_equal(actual[1], expected[1])
+
+
+def test_checkpoints_of_unsupported_volumes_are_errors(stream_scan, tmp_path):
+    recons = make_reconstruct(stream_scan, True, 0)
+    recons.config.output = {'save_folder': str(tmp_path)}
+    recons.config.alg_param.integration.checkpoint.every = 5
+    with pytest.raises(ValueError):
+        recons._integrate_with_traj(recons.create_volume(), list(range(VIDEO_FRAMES)))
+    recons.bridge.close_all()
+
+    volume = o3d.pipelines.integration.ScalableTSDFVolume(
+        voxel_length=0.01, sdf_trunc=0.04, color_type=o3d.pipelines.integration.TSDFVolumeColorType.RGB8)
+    with pytest.raises(RuntimeError, match='get_block_hashmap'):
+        checkpoint.check_volume(volume)
+
+
+@pytest.mark.skipif(not hasattr(pymeshlab.MeshSet(), 'remove_isolated_pieces_wrt_face_num'),
+                    reason='pymeshlab 0.2 filter names')
+def test_quadric_decimation_writes_decimated_and_aligned_meshes(stream_scan, tmp_path):
+    recons = make_reconstruct(stream_scan, False, 0)
+    recons.bridge.close_all()
+    recons.config.settings.extract_mesh = True
+    recons.config.settings.extract_pcd = False
+    recons.config.output = {'save_folder': str(tmp_path), 'mesh_filename': 'scan.ply',
+                            'decimated_mesh_filename': 'scan_decimated.ply',
+                            'mesh_alignment_filename': 'scan-align-transform.json'}
+    recons.config.alg_param.decimation = {'backend': 'quadric', 'degree': 4}
+    mesh = o3d.geometry.TriangleMesh.create_sphere(radius=1.0, resolution=40)
+    mesh.translate((3.0, 2.0, 1.0))
+    target_vertices = len(mesh.vertices) // 4
+    recons.export_geometry(mesh)
+
+    unaligned = o3d.io.read_triangle_mesh(str(tmp_path / 'scan_unaligned.ply'))
+    decimated = o3d.io.read_triangle_mesh(str(tmp_path / 'scan_decimated.ply'))
+    aligned = o3d.io.read_triangle_mesh(str(tmp_path / 'scan.ply'))
+    assert abs(len(decimated.vertices) - target_vertices) <= 0.1 * target_vertices
+    assert decimated.has_vertex_normals()
+    # the undecimated mesh is moved by the alignment of the decimated mesh
+    assert len(aligned.vertices) == len(unaligned.vertices) == len(mesh.vertices)
+    with open(tmp_path / 'scan-align-transform.json') as f:
+        transform = np.asarray(json.load(f)['transform']).reshape((4, 4), order='F')
+    np.testing.assert_allclose(transform[:3, 3], (3.0, 2.0, 1.0), atol=0.05)
+    np.testing.assert_allclose(np.asarray(aligned.transform(transform).vertices), np.asarray(unaligned.vertices),
+                               atol=1e-5)
+    np.testing.assert_allclose(np.asarray(decimated.vertices).mean(axis=0), 0.0, atol=0.05)
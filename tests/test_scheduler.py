@@ -0,0 +1,218 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+from omegaconf import OmegaConf
+
+from multiscan.utils.scheduler import StageScheduler
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class Recorder:
+    """step functions recording the order and the overlap of the steps"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = []
+        self.finished = []
+        self.running = 0
+        self.max_running = 0
+
+    def step(self, name, result=0, duration=0.05, error=None):
+        def fn(*args, **kwargs):
+            with self.lock:
+                self.started.append(name)
+                self.running += 1
+                self.max_running = max(self.max_running, self.running)
+            time.sleep(duration)
+            with self.lock:
+                self.running -= 1
+                self.finished.append(name)
+            if error is not None:
+                raise error
+            return result
+        return fn
+
+
+def test_steps_run_after_their_dependencies():
+    recorder = Recorder()
+    scheduler = StageScheduler(cpus=8)
+    scheduler.add('thumbnail', recorder.step('thumbnail', duration=0.2), inputs=['video'], outputs=['thumb'])
+    scheduler.add('color', recorder.step('color'), inputs=['video'], outputs=['colors'])
+    scheduler.add('depth', recorder.step('depth'), inputs=['depth_stream'], outputs=['depths'])
+    scheduler.add('recons', recorder.step('recons', result=3), inputs=['colors', 'depths'], outputs=['mesh'])
+    scheduler.add('clean', recorder.step('clean'), after=['recons'])
+    results = scheduler.run()
+    assert results == {'thumbnail': 0, 'color': 0, 'depth': 0, 'recons': 3, 'clean': 0}
+    assert recorder.max_running == 3
+    assert recorder.finished.index('recons') > max(recorder.finished.index('color'), recorder.finished.index('depth'))
+    assert recorder.started.index('clean') > recorder.finished.index('recons')
+    # recons does not wait for the thumbnails
+    assert recorder.started.index('recons') < recorder.finished.index('thumbnail')
+
+
+def test_sequential_order_with_a_single_core():
+    recorder = Recorder()
+    scheduler = StageScheduler(cpus=1)
+    names = ['a', 'b', 'c', 'd']
+    for name in names:
+        scheduler.add(name, recorder.step(name, duration=0.01))
+    scheduler.run()
+    assert recorder.started == names and recorder.max_running == 1
+
+
+def test_core_budget():
+    recorder = Recorder()
+    scheduler = StageScheduler(cpus=4)
+    for name in 'abcd':
+        scheduler.add(name, recorder.step(name), cpus=2)
+    # a step needing more cores than the budget runs alone
+    scheduler.add('big', recorder.step('big'), cpus=16)
+    scheduler.run()
+    assert recorder.max_running == 2
+    assert sorted(recorder.finished) == ['a', 'b', 'big', 'c', 'd']
+
+
+def test_memory_budget():
+    recorder = Recorder()
+    scheduler = StageScheduler(cpus=8)
+    scheduler.capacity = 10
+    for name in 'abcd':
+        scheduler.add(name, recorder.step(name), mem=4)
+    scheduler.run()
+    assert recorder.max_running == 2
+
+
+def test_failed_steps_skip_their_dependents():
+    recorder = Recorder()
+    scheduler = StageScheduler(cpus=8)
+    scheduler.add('decode', recorder.step('decode', error=ValueError('broken')), outputs=['frames'])
+    scheduler.add('recons', recorder.step('recons'), inputs=['frames'], outputs=['mesh'])
+    scheduler.add('render', recorder.step('render'), inputs=['mesh'])
+    scheduler.add('thumbnail', recorder.step('thumbnail'))
+    results = scheduler.run()
+    assert isinstance(results['decode'], ValueError)
+    assert isinstance(results['recons'], RuntimeError) and isinstance(results['render'], RuntimeError)
+    assert results['thumbnail'] == 0
+    assert sorted(recorder.started) == ['decode', 'thumbnail']
+
+
+def test_strict_steps_require_zero_return_codes():
+    recorder = Recorder()
+    scheduler = StageScheduler(cpus=8)
+    scheduler.add('color', recorder.step('color', result=1), outputs=['colors'])
+    scheduler.add('depth', recorder.step('depth'), outputs=['depths'])
+    scheduler.add('lenient', recorder.step('lenient'), inputs=['colors'])
+    scheduler.add('validate', recorder.step('validate'), inputs=['colors', 'depths'], outputs=['frames'], strict=True)
+    scheduler.add('recons', recorder.step('recons'), inputs=['frames'])
+    results = scheduler.run()
+    assert results['lenient'] == 0
+    assert 'color failed' in str(results['validate'])
+    assert isinstance(results['recons'], RuntimeError)
+    assert sorted(recorder.started) == ['color', 'depth', 'lenient']
+
+
+@pytest.fixture
+def scan_processor():
+    pytest.importorskip('hydra')
+    pytest.importorskip('requests')
+    sys.path.insert(0, os.path.join(ROOT, 'server'))
+    try:
+        import scan_processor
+        yield scan_processor
+    finally:
+        sys.path.remove(os.path.join(ROOT, 'server'))
+
+
+def make_config(tmp_path, **actions):
+    config = OmegaConf.load(os.path.join(ROOT, 'config', 'config.yaml'))
+    config.reconstruction = OmegaConf.merge(OmegaConf.load(os.path.join(ROOT, 'config', 'reconstruction',
+                                                                        'reconstruction.yaml')),
+                                            config.reconstruction)
+    config.process.scan_dir = str(tmp_path)
+    config.process.scan_name = 'scan'
+    config.process.color_dir = str(tmp_path / 'color')
+    config.process.depth_dir = str(tmp_path / 'depth')
+    config.process.scheduler.cpus = 16
+    for action, enabled in actions.items():
+        config[action] = enabled
+    return config
+
+
+def fake_steps(scan_processor, monkeypatch, recorder, results):
+    for name in scan_processor.STEP_FUNCTIONS:
+        if name != 'validate_decode':
+            monkeypatch.setitem(scan_processor.STEP_FUNCTIONS, name, recorder.step(name, results.get(name, 0)))
+    calls = []
+
+    def segment(config, indices=None, render=True):
+        calls.append((indices, render))
+        return recorder.step('segmentation')()
+    monkeypatch.setattr(scan_processor, 'segment', segment)
+    return calls
+
+
+def decoded_frames(config, color=True, depth=True):
+    os.makedirs(config.process.color_dir)
+    os.makedirs(config.process.depth_dir)
+    if color:
+        open(os.path.join(config.process.color_dir, '0.png'), 'w').close()
+    if depth:
+        open(os.path.join(config.process.depth_dir, '0' + config.process.decode.depth_format), 'w').close()
+
+
+@pytest.mark.parametrize('color_result, frames, ran_recons', [
+    (0, (True, True), True),
+    (1, (True, True), False),
+    (0, (True, False), False),
+])
+def test_decode_validation_gates_reconstruction(scan_processor, monkeypatch, tmp_path,
+                                                color_result, frames, ran_recons):
+    config = make_config(tmp_path, thumbnail=True, convert=True, recons=True, render=True)
+    recorder = Recorder()
+    fake_steps(scan_processor, monkeypatch, recorder, {'decode_color': color_result})
+    decoded_frames(config, *frames)
+    ret = scan_processor.process_steps(config, {}, scan_processor.ProcessStage.PRELIMINARY)
+    assert ('recons' in recorder.started) == ran_recons
+    assert ('render_ply' in recorder.started) == ran_recons
+    assert {'thumbnail', 'decode_color', 'decode_depth'} <= set(recorder.started)
+    assert ret == (0 if ran_recons else 1)
+
+
+
+@pytest.mark.parametrize('color_result, frames, ran_recons', [
+    (0, (True, True), True),
+    (1, (True, True), False),
+    (0, (True, False), False),
+])
+def test_sequential_decode_failures_stop_reconstruction(scan_processor, monkeypatch, tmp_path,
+                                                        color_result, frames, ran_recons):
+    config = make_config(tmp_path, thumbnail=True, convert=True, recons=True, render=True)
+    recorder = Recorder()
+    results = {'decode_color': color_result}
+    for name in ('make_thumbnails', 'decode_color', 'decode_depth', 'reconstruct', 'render_ply'):
+        monkeypatch.setattr(scan_processor, name, recorder.step(name, results.get(name, 0)))
+    decoded_frames(config, *frames)
+    ret = scan_processor.process_preliminary(config, {})
+    assert ('reconstruct' in recorder.started) == ran_recons
+    assert ('render_ply' in recorder.started) == ran_recons
+    assert ret == (0 if ran_recons else 1)
+
+@pytest.mark.parametrize('mode', ['serial', 'batch'])
+def test_segmentations_are_rendered_once(scan_processor, monkeypatch, tmp_path, mode):
+    config = make_config(tmp_path, segmentation=True)
+    config.process.segmentation.mode = mode
+    recorder = Recorder()
+    calls = fake_steps(scan_processor, monkeypatch, recorder, {})
+    assert scan_processor.process_steps(config, {}, scan_processor.ProcessStage.EXTRA) == 0
+    num_thresholds = len(config.process.segmentation.kthesh)
+    if mode == 'batch':
+        assert calls == [(None, False)]
+    else:
+        assert sorted(calls) == [([i], False) for i in range(num_thresholds)]
+    assert recorder.started.count('render_segs') == 1
+    assert recorder.started[-1] == 'render_segs'
+    assert recorder.started.count('segmentation') == len(calls)
@@ -0,0 +1,89 @@
+import json
+import os
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from multiscan.utils import ply
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+KTHRESHS = [0.005, 0.01, 0.05, 0.1, 0.5]
+COLOR_KTHRESHS = [0.5, 2, 4, 4, 8]
+
+
+@pytest.fixture(scope='module')
+def segmentator(tmp_path_factory):
+    """segmentator built from the sources, needs cmake, boost program_options and rapidjson"""
+    if shutil.which('cmake') is None:
+        pytest.skip('cmake is not available')
+    build = tmp_path_factory.mktemp('segmentator_build')
+    try:
+        subprocess.run(['cmake', '-S', os.path.join(ROOT, 'segmentator'), '-B', str(build)],
+                       check=True, capture_output=True)
+        subprocess.run(['cmake', '--build', str(build), '--', f'-j{len(os.sched_getaffinity(0))}'],
+                       check=True, capture_output=True)
+    except subprocess.CalledProcessError as e:
+        pytest.skip(f'segmentator does not build: {e.stderr.decode(errors="replace")[-500:]}')
+    binary = build / 'segmentator'
+    if not binary.exists():
+        pytest.skip('segmentator does not build without boost program_options')
+    return str(binary)
+
+
+@pytest.fixture(scope='module')
+def mesh_file(tmp_path_factory):
+    """wavy grid mesh with patches of vertex colors"""
+    rng = np.random.default_rng(0)
+    size = 40
+    x, y = np.meshgrid(np.linspace(0, 2, size), np.linspace(0, 2, size))
+    z = 0.2 * np.sin(3 * x) * np.cos(2 * y) + rng.normal(0, 0.005, x.shape)
+    vertices = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1)
+    palette = rng.integers(0, 256, (9, 3))
+    colors = palette[(np.minimum(x * 1.5, 2).astype(int) * 3 + np.minimum(y * 1.5, 2).astype(int)).ravel()]
+    colors = np.clip(colors + rng.integers(-10, 10, colors.shape), 0, 255).astype(np.uint8)
+    index = np.arange(size * size).reshape(size, size)
+    corners = index[:-1, :-1].ravel(), index[:-1, 1:].ravel(), index[1:, :-1].ravel(), index[1:, 1:].ravel()
+    faces = np.concatenate([np.stack([corners[0], corners[1], corners[3]], axis=1),
+                            np.stack([corners[0], corners[3], corners[2]], axis=1)])
+    path = str(tmp_path_factory.mktemp('segmentator_mesh') / 'mesh.ply')
+    ply.write_mesh(path, vertices, faces, colors=colors)
+    return path
+
+
+def run(segmentator, args):
+    subprocess.run([segmentator] + args, check=True, capture_output=True)
+
+
+@pytest.mark.parametrize('face_based', [False, True])
+def test_threshold_list_matches_separate_runs(segmentator, mesh_file, tmp_path, face_based):
+    common = ['--input', mesh_file, '--segMinVerts', '10', '--colorSegMinVerts', '10', '--scanID', 'mesh']
+    if face_based:
+        common.append('--face_based')
+    separate = []
+    for kthresh, color_kthresh in zip(KTHRESHS, COLOR_KTHRESHS):
+        output = str(tmp_path / f'separate.{kthresh}.segs.json')
+        run(segmentator, common + ['--kThresh', str(kthresh), '--colorKThresh', str(color_kthresh),
+                                   '--output', output])
+        separate.append(output)
+    listed = [str(tmp_path / f'listed.{kthresh}.segs.json') for kthresh in KTHRESHS]
+    run(segmentator, common + ['--kThreshList'] + [str(kthresh) for kthresh in KTHRESHS] +
+        ['--colorKThreshList'] + [str(kthresh) for kthresh in COLOR_KTHRESHS] + ['--outputList'] + listed)
+
+    num_segments = []
+    for separate_file, listed_file in zip(separate, listed):
+        with open(separate_file) as f, open(listed_file) as g:
+            expected, actual = json.load(f), json.load(g)
+        assert actual == expected
+        num_segments.append(len(set(expected['segmentation'][1]['index'])))
+    # the thresholds give different segmentations
+    assert len(set(num_segments)) > 1
+
+
+def test_threshold_list_lengths_must_match(segmentator, mesh_file, tmp_path):
+    with pytest.raises(subprocess.CalledProcessError):
+        run(segmentator, ['--input', mesh_file, '--kThreshList', '0.01', '0.05', '--colorKThreshList', '0.5'])
+    with pytest.raises(subprocess.CalledProcessError):
+        run(segmentator, ['--input', mesh_file, '--kThreshList', '0.01', '0.05', '--colorKThreshList', '0.5', '2',
+                          '--outputList', str(tmp_path / 'a.segs.json')])
@@ -0,0 +1,116 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+o3d = pytest.importorskip('open3d')
+pytest.importorskip('pymeshlab')
+
+from multiscan.meshproc import MeshSession, TriMesh  # noqa: E402
+from multiscan.meshproc import session  # noqa: E402
+from multiscan.utils import ply  # noqa: E402
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def write_mesh(path, seed=0, num_vertices=200, num_faces=300):
+    rng = np.random.default_rng(seed)
+    ply.write_mesh(str(path), rng.normal(size=(num_vertices, 3)).astype(np.float32),
+                   rng.integers(0, num_vertices, (num_faces, 3)).astype(np.int32),
+                   normals=rng.normal(size=(num_vertices, 3)).astype(np.float32),
+                   colors=rng.integers(0, 256, (num_vertices, 3)).astype(np.uint8))
+    return str(path)
+
+
+def parse_in_process(path, folder):
+    """number of ply files a new process parsed to read path, and the vertices it read"""
+    script = ('import sys, numpy as np\n'
+              'from multiscan.meshproc import MeshSession\n'
+              'mesh_session = MeshSession(folder=sys.argv[2])\n'
+              'vertices = mesh_session.mesh(sys.argv[1])["vertices"]\n'
+              'print(mesh_session.parsed, float(np.sum(vertices)))\n')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, os.environ.get('PYTHONPATH', '')]))
+    output = subprocess.run([sys.executable, '-c', script, path, folder], env=env, check=True,
+                            capture_output=True, text=True).stdout.split()
+    return int(output[0]), float(output[1])
+
+
+def test_meshes_are_parsed_once_across_processes(tmp_path):
+    path = write_mesh(tmp_path / 'mesh.ply')
+    folder = str(tmp_path / 'cache')
+    expected = float(np.sum(ply.read_mesh(path)['vertices']))
+    assert parse_in_process(path, folder) == (1, pytest.approx(expected))
+    # later stages attach to the cached arrays
+    assert parse_in_process(path, folder) == (0, pytest.approx(expected))
+
+    # a rewritten mesh is parsed again
+    write_mesh(path, seed=1)
+    os.utime(path, ns=(os.stat(path).st_atime_ns, os.stat(path).st_mtime_ns + 10 ** 9))
+    expected = float(np.sum(ply.read_mesh(path)['vertices']))
+    assert parse_in_process(path, folder) == (1, pytest.approx(expected))
+
+
+def test_cached_arrays_match_the_ply_file(tmp_path):
+    path = write_mesh(tmp_path / 'mesh.ply')
+    folder = str(tmp_path / 'cache')
+    parsed = MeshSession(folder=folder).mesh(path)
+    attached = MeshSession(folder=folder)
+    mesh = attached.mesh(path)
+    assert attached.parsed == 0
+    data = ply.read_mesh(path)
+    for name in ('vertices', 'faces', 'normals', 'colors'):
+        for arrays in (parsed, mesh):
+            assert arrays[name].dtype == data[name].dtype
+            np.testing.assert_array_equal(arrays[name], data[name])
+            assert not arrays[name].flags.writeable
+
+
+def test_least_recently_used_meshes_are_evicted(tmp_path):
+    paths = [write_mesh(tmp_path / f'mesh{i}.ply', seed=i) for i in range(4)]
+    folder = str(tmp_path / 'cache')
+    mesh_session = MeshSession(folder=folder, max_meshes=2)
+    mesh_session.mesh(paths[0])
+    entry_bytes = sum(os.path.getsize(os.path.join(folder, entry, name))
+                      for entry in os.listdir(folder) for name in os.listdir(os.path.join(folder, entry)))
+    # room for two meshes
+    mesh_session.max_bytes = int(2.5 * entry_bytes)
+    for path in paths[1:3]:
+        mesh_session.mesh(path)
+    assert len(os.listdir(folder)) == 2
+    assert len(mesh_session._meshes) == 2
+    # the oldest mesh was evicted from the process and the folder, the others are attached
+    mesh_session = MeshSession(folder=folder, max_bytes=mesh_session.max_bytes)
+    for path in paths[1:3]:
+        mesh_session.mesh(path)
+    assert mesh_session.parsed == 0
+    mesh_session.mesh(paths[0])
+    assert mesh_session.parsed == 1
+    assert len(os.listdir(folder)) == 2
+
+    mesh_session.invalidate()
+    assert not os.path.exists(folder)
+    mesh_session.mesh(paths[3])
+    assert mesh_session.parsed == 2
+
+
+def test_double_meshes_are_read_like_open3d(tmp_path, monkeypatch):
+    monkeypatch.setattr(session, '_session', MeshSession(folder=str(tmp_path / 'cache')))
+    rng = np.random.default_rng(0)
+    mesh = o3d.geometry.TriangleMesh.create_sphere(radius=1.0, resolution=20)
+    mesh.translate((1000.0, -1000.0, 1000.0))
+    mesh.vertices = o3d.utility.Vector3dVector(np.asarray(mesh.vertices) + rng.uniform(-1e-3, 1e-3, (len(mesh.vertices), 3)))
+    mesh.compute_vertex_normals()
+    mesh.vertex_colors = o3d.utility.Vector3dVector(rng.integers(0, 256, (len(mesh.vertices), 3)) / 255.0)
+    path = str(tmp_path / 'open3d.ply')
+    # open3d writes vertices and normals as double
+    o3d.io.write_triangle_mesh(path, mesh, write_vertex_normals=True)
+
+    expected = o3d.io.read_triangle_mesh(path)
+    for _ in range(2):
+        actual = TriMesh(path).o3d_mesh
+        for name in ('vertices', 'triangles', 'vertex_normals', 'vertex_colors'):
+            np.testing.assert_array_equal(np.asarray(getattr(actual, name)), np.asarray(getattr(expected, name)))
+    assert session.mesh_session().parsed == 1
+    assert ply.read_mesh(path)['vertices'].dtype == np.float64
@@ -0,0 +1,307 @@
+import itertools
+
+import numpy as np
+import pytest
+
+pytest.importorskip('cv2')
+pytest.importorskip('decord')
+o3d = pytest.importorskip('open3d')
+from omegaconf import OmegaConf  # noqa: E402
+
+from reconstruction.scripts import tiled  # noqa: E402
+from reconstruction.scripts.bridge import Bridge  # noqa: E402
+from reconstruction.scripts.reconstruct import Reconstruct  # noqa: E402
+from conftest import META_FRAMES  # noqa: E402
+
+
+WIDTH, HEIGHT = 64, 48
+INTRINSIC = np.array([[50.0, 0, 32], [0, 50.0, 24], [0, 0, 1]])
+DEPTH_SCALE = 1000.0
+DEPTH_MAX = 3.0
+SDF_TRUNC = 0.06
+
+# tiled integration runs TSDFVoxelGrid volumes, whose frames need the tensor image API of open3d before 0.14
+HAS_TSDF_VOXEL_GRID = hasattr(o3d.t.geometry, 'TSDFVoxelGrid') and hasattr(o3d.t.geometry.Image, 'from_legacy_image')
+
+
+def look_at(eye, target, up=(0, 0, 1)):
+    """world to camera transform of a camera at eye looking at target"""
+    eye = np.asarray(eye, dtype=np.float64)
+    forward = np.asarray(target, dtype=np.float64) - eye
+    forward /= np.linalg.norm(forward)
+    right = np.cross(forward, up)
+    right /= np.linalg.norm(right)
+    rotation = np.stack([right, np.cross(forward, right), forward])
+    extrinsic = np.eye(4)
+    extrinsic[:3, :3] = rotation
+    extrinsic[:3, 3] = -rotation @ eye
+    return extrinsic
+
+
+def render_depth(extrinsic, center=(1.0, 1.0, 0.4), radius=0.4):
+    """depth image of a sphere on the floor plane z = 0"""
+    u, v = np.meshgrid(np.arange(WIDTH), np.arange(HEIGHT))
+    rays = np.stack([(u - INTRINSIC[0, 2]) / INTRINSIC[0, 0], (v - INTRINSIC[1, 2]) / INTRINSIC[1, 1],
+                     np.ones(u.shape)], axis=-1)
+    rotation = extrinsic[:3, :3]
+    origin = -rotation.T @ extrinsic[:3, 3]
+    # world directions of rays at unit depth, the ray parameter is the depth
+    directions = rays @ rotation
+    with np.errstate(divide='ignore'):
+        t_floor = np.where(directions[..., 2] < 0, -origin[2] / directions[..., 2], np.inf)
+    offset = origin - np.asarray(center)
+    a = np.sum(directions ** 2, axis=-1)
+    b = 2 * directions @ offset
+    discriminant = b ** 2 - 4 * a * (offset @ offset - radius ** 2)
+    t_sphere = np.where(discriminant >= 0, (-b - np.sqrt(np.maximum(discriminant, 0))) / (2 * a), np.inf)
+    depth = np.minimum(t_floor, t_sphere)
+    depth = np.where(np.isfinite(depth), depth, 0)
+    return np.round(depth * DEPTH_SCALE).astype(np.uint16)
+
+
+@pytest.fixture(scope='module')
+def synthetic_scene():
+    """cameras circling a sphere on the floor and their depth images"""
+    angles = np.linspace(0, 2 * np.pi, 6, endpoint=False)
+    extrinsics = np.array([look_at((1 + 1.5 * np.cos(a), 1 + 1.5 * np.sin(a), 1.2), (1, 1, 0.3)) for a in angles])
+    depths = [render_depth(extrinsic) for extrinsic in extrinsics]
+    return extrinsics, depths
+
+
+def integrate_tsdf(centers, frames):
+    """projective TSDF of voxel centers, integrated like a TSDFVoxelGrid
+
+    :param centers: (N, 3) voxel centers
+    :param frames: (depth, extrinsic) pairs
+    :return: (tsdf, weight) of the voxels
+    """
+    tsdf = np.zeros(len(centers))
+    weight = np.zeros(len(centers))
+    for depth, extrinsic in frames:
+        points = centers @ extrinsic[:3, :3].T + extrinsic[:3, 3]
+        z = points[:, 2]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            u = np.round(points[:, 0] / z * INTRINSIC[0, 0] + INTRINSIC[0, 2])
+            v = np.round(points[:, 1] / z * INTRINSIC[1, 1] + INTRINSIC[1, 2])
+        inside = (z > 0) & (u >= 0) & (u < WIDTH) & (v >= 0) & (v < HEIGHT)
+        d = np.zeros(len(centers))
+        d[inside] = depth[v[inside].astype(int), u[inside].astype(int)] / DEPTH_SCALE
+        sdf = d - z
+        update = inside & (d > 0) & (d <= DEPTH_MAX) & (sdf >= -SDF_TRUNC)
+        value = np.minimum(sdf[update] / SDF_TRUNC, 1.0)
+        tsdf[update] = (tsdf[update] * weight[update] + value) / (weight[update] + 1)
+        weight[update] += 1
+    return tsdf, weight
+
+
+def test_tiles_cover_the_view_frustums(synthetic_scene):
+    extrinsics, _ = synthetic_scene
+    intrinsics = np.tile(INTRINSIC, (len(extrinsics), 1, 1))
+    # grown blocks span more than a tile
+    tile_size, overlap, block_size = 0.5, 0.1, 0.16
+    tiles = tiled.plan_tiles(extrinsics, intrinsics, WIDTH, HEIGHT, 0.2, DEPTH_MAX, tile_size, overlap, block_size)
+
+    # frustums sampled much finer than the blocks
+    u, v = np.meshgrid(np.linspace(0, WIDTH, 33), np.linspace(0, HEIGHT, 25))
+    rays = np.linalg.inv(INTRINSIC) @ np.stack([u.ravel(), v.ravel(), np.ones(u.size)])
+    depths = np.arange(0.2, DEPTH_MAX + 0.01, 0.04)
+
+    def tiles_within(points, margin):
+        """tiles whose box grown by margin contains a point"""
+        lo = np.floor((points - margin) / tile_size).astype(np.int64)
+        hi = np.floor((points + margin) / tile_size).astype(np.int64)
+        lo, hi = np.split(np.unique(np.hstack([lo, hi]), axis=0), 2, axis=1)
+        keys = set()
+        for offset in itertools.product(range(int(np.max(hi - lo)) + 1), repeat=3):
+            key = np.minimum(lo + offset, hi)
+            keys.update(map(tuple, np.unique(key, axis=0).tolist()))
+        return keys
+
+    for i, extrinsic in enumerate(extrinsics):
+        pose = np.linalg.inv(extrinsic)
+        points = (pose[:3, :3] @ (rays[..., None] * depths).reshape(3, -1)).T + pose[:3, 3]
+        planned = {key for key, frames in tiles.items() if i in frames}
+        assert tiles_within(points, overlap) <= planned
+        # planned tiles are at most two blocks beyond the frustum
+        assert planned <= tiles_within(points, overlap + 2 * block_size)
+    for frames in tiles.values():
+        assert frames == sorted(set(frames))
+
+
+def test_clipped_depth_keeps_the_rays_through_the_box(synthetic_scene):
+    extrinsics, depths = synthetic_scene
+    rng = np.random.default_rng(0)
+    for extrinsic, depth in zip(extrinsics, depths):
+        box_min = rng.uniform(0.0, 1.5, 3) - [0, 0, 0.5]
+        box_max = box_min + rng.uniform(0.2, 0.8, 3)
+        clipped = depth.copy()
+        kept = tiled.clip_depth_to_box(clipped, INTRINSIC, extrinsic, DEPTH_SCALE, DEPTH_MAX, box_min, box_max,
+                                       SDF_TRUNC)
+        assert kept == np.count_nonzero(clipped)
+        # dropped pixels are zeroed, kept pixels unchanged
+        assert np.all((clipped == 0) | (clipped == depth))
+
+        # segments sampled from the camera to sdf_trunc behind the surface
+        v, u = np.nonzero((depth > 0) & (depth <= DEPTH_MAX * DEPTH_SCALE))
+        z = depth[v, u] / DEPTH_SCALE
+        rays = np.stack([(u - INTRINSIC[0, 2]) / INTRINSIC[0, 0], (v - INTRINSIC[1, 2]) / INTRINSIC[1, 1],
+                         np.ones(len(u))])
+        ends = rays * (z + SDF_TRUNC / np.linalg.norm(rays, axis=0))
+        samples = ends[..., None] * np.linspace(0, 1, 2000)
+        pose = np.linalg.inv(extrinsic)
+        samples = np.einsum('ij,jnk->nki', pose[:3, :3], samples) + pose[:3, 3]
+        hit = np.any(np.all((samples >= box_min) & (samples <= box_max), axis=2), axis=1)
+        # the sampling may only miss segments grazing the box
+        slab = clipped[v, u] > 0
+        assert np.all(slab[hit])
+        assert np.count_nonzero(slab & ~hit) <= max(1, 0.01 * len(hit))
+
+
+def test_tiles_integrate_like_a_single_volume(synthetic_scene):
+    extrinsics, depths = synthetic_scene
+    tile_size, overlap, voxel = 0.5, 0.1, 0.04
+    tiles = tiled.plan_tiles(extrinsics, np.tile(INTRINSIC, (len(extrinsics), 1, 1)), WIDTH, HEIGHT, 0.2,
+                             DEPTH_MAX, tile_size, overlap, 8 * voxel)
+    # voxels around the sphere and the floor
+    axes = [np.arange(0.0, 2.0, voxel), np.arange(0.0, 2.0, voxel), np.arange(-0.2, 0.9, voxel)]
+    centers = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3) + voxel / 2
+    tsdf, weight = integrate_tsdf(centers, zip(depths, extrinsics))
+    assert np.count_nonzero(weight) > 0.5 * len(centers)
+
+    covered = np.zeros(len(centers), dtype=bool)
+    for key, frames in tiles.items():
+        box_min = np.asarray(key) * tile_size
+        box_max = box_min + tile_size
+        core = np.all((centers >= box_min) & (centers < box_max), axis=1)
+        if not np.any(core):
+            continue
+        clipped = []
+        for i in frames:
+            depth = depths[i].copy()
+            if tiled.clip_depth_to_box(depth, INTRINSIC, extrinsics[i], DEPTH_SCALE, DEPTH_MAX,
+                                       box_min - overlap, box_max + overlap, SDF_TRUNC):
+                clipped.append((depth, extrinsics[i]))
+        tile_tsdf, tile_weight = integrate_tsdf(centers[core], clipped)
+        np.testing.assert_array_equal(tile_weight, weight[core])
+        np.testing.assert_allclose(tile_tsdf, tsdf[core], rtol=0, atol=1e-12)
+        covered |= core
+    # tiles cover every updated voxel
+    assert np.all(covered[weight > 0])
+
+
+def triangle_set(vertices, triangles):
+    """triangles as sorted tuples of vertex coordinates"""
+    return [tuple(sorted(map(tuple, vertices[triangle].tolist()))) for triangle in triangles]
+
+
+def tile_keys(points, tile_size):
+    lo = np.floor(points.min(axis=0) / tile_size).astype(int)
+    hi = np.floor(points.max(axis=0) / tile_size).astype(int)
+    return itertools.product(*(range(a, b + 1) for a, b in zip(lo, hi)))
+
+
+def test_stitched_tiles_keep_every_triangle_once():
+    mesh = o3d.geometry.TriangleMesh.create_sphere(radius=0.7, resolution=30)
+    mesh.translate((0.3, 0.2, 0.1))
+    mesh.compute_vertex_normals()
+    vertices = np.asarray(mesh.vertices)
+    mesh.vertex_colors = o3d.utility.Vector3dVector((vertices - vertices.min(axis=0)) / np.ptp(vertices, axis=0))
+    tile_size = 0.5
+
+    parts = [tiled.crop_mesh(mesh, np.asarray(key) * tile_size, (np.asarray(key) + 1) * tile_size)
+             for key in tile_keys(vertices, tile_size)]
+    assert sum(len(part['triangles']) for part in parts) == len(mesh.triangles)
+    assert sum(len(part['triangles']) > 0 for part in parts) > 8
+    stitched = tiled.stitch_meshes(parts)
+
+    expected = triangle_set(vertices, np.asarray(mesh.triangles))
+    result = triangle_set(np.asarray(stitched.vertices), np.asarray(stitched.triangles))
+    assert len(set(result)) == len(result)
+    assert sorted(result) == sorted(expected)
+    # border vertices are merged with their normals and colors
+    assert len(stitched.vertices) == len(mesh.vertices)
+    order = np.lexsort(vertices.T)
+    stitched_order = np.lexsort(np.asarray(stitched.vertices).T)
+    for name in ('vertices', 'vertex_normals', 'vertex_colors'):
+        np.testing.assert_array_equal(np.asarray(getattr(stitched, name))[stitched_order],
+                                      np.asarray(getattr(mesh, name))[order])
+
+
+def test_triangles_on_tile_borders_go_to_the_upper_tile():
+    mesh = o3d.geometry.TriangleMesh()
+    # centroid at x = 0.5, on the border of the tiles 0 and 1
+    mesh.vertices = o3d.utility.Vector3dVector([[0.0, 0.1, 0.1], [1.5, 0.1, 0.1], [0.0, 0.4, 0.1]])
+    mesh.triangles = o3d.utility.Vector3iVector([[0, 1, 2]])
+    lower = tiled.crop_mesh(mesh, np.zeros(3), np.full(3, 0.5))
+    upper = tiled.crop_mesh(mesh, np.array([0.5, 0.0, 0.0]), np.array([1.0, 0.5, 0.5]))
+    assert len(lower['triangles']) == 0 and len(lower['vertices']) == 0
+    np.testing.assert_array_equal(upper['triangles'], [[0, 1, 2]])
+    assert len(tiled.stitch_meshes([lower]).triangles) == 0
+
+
+def test_cropped_points_partition_the_cloud():
+    rng = np.random.default_rng(0)
+    pcd = o3d.geometry.PointCloud()
+    points = rng.uniform(-1.0, 1.0, (2000, 3))
+    # points on the tile borders
+    points[:100] = np.round(points[:100] * 2) / 2
+    pcd.points = o3d.utility.Vector3dVector(points)
+    pcd.normals = o3d.utility.Vector3dVector(rng.normal(size=(2000, 3)))
+    pcd.colors = o3d.utility.Vector3dVector(rng.uniform(size=(2000, 3)))
+    tile_size = 0.5
+
+    parts = [tiled.crop_points(pcd, np.asarray(key) * tile_size, (np.asarray(key) + 1) * tile_size)
+             for key in tile_keys(points, tile_size)]
+    stitched = tiled.stitch_points(parts)
+    assert len(stitched.points) == len(points)
+    order = np.lexsort(points.T)
+    stitched_order = np.lexsort(np.asarray(stitched.points).T)
+    for name in ('points', 'normals', 'colors'):
+        np.testing.assert_array_equal(np.asarray(getattr(stitched, name))[stitched_order],
+                                      np.asarray(getattr(pcd, name))[order])
+
+
+@pytest.mark.skipif(not HAS_TSDF_VOXEL_GRID, reason='open3d with TSDFVoxelGrid')
+def test_tiled_integration_matches_a_single_volume(stream_scan):
+    config = OmegaConf.create({
+        'settings': {'debug': False, 'device_type': 'cpu', 'device_id': 0, 'extract_mesh': True,
+                     'extract_pcd': False},
+        'input': stream_scan,
+        'alg_param': {
+            'volume_type': 'TSDFVoxelGrid',
+            'frames': {'step': 1, 'use_opencv': False, 'color_at_depth_resolution': True, 'color_batch_size': 4,
+                       'random_access': False, 'cache_size': 4},
+            'integration': {'with_color': False, 'prefetch': 0, 'block_resolution': 8, 'voxel_len_fine': 0.02,
+                            'sdf_trunc': 0.06, 'voxel_type': {'tsdf': 'Float32', 'weight': 'UInt16', 'color': 'UInt16'},
+                            'tiled': {'enabled': True, 'tile_size': 0.5, 'overlap': 0.2, 'processes': 2}},
+            'depth_filter': {'level': 2, 'delta_thresh': 0.05, 'min_portion': 0.1},
+            'depth_thresh': {'min': 0.2, 'max': 3.0, 'scale': 1000.0},
+            'extract': {'weight_threshold': 0.0},
+        },
+    })
+    bridge = Bridge(config)
+    bridge.open_inputs()
+    recons = Reconstruct(config, bridge)
+    # the camera turns by 20 degrees per frame
+    recons._extrinsics = np.tile(np.eye(4), (META_FRAMES, 1, 1))
+    for i in range(META_FRAMES):
+        angle = np.deg2rad(20 * i)
+        recons._extrinsics[i][:3, :3] = [[np.cos(angle), 0, -np.sin(angle)], [0, 1, 0],
+                                         [np.sin(angle), 0, np.cos(angle)]]
+    recons._intrinsics = np.tile(np.array([[10.0, 0, 8], [0, 10.0, 6], [0, 0, 1]]), (META_FRAMES, 1, 1))
+    frame_indices = list(range(META_FRAMES))
+    assert recons._use_tiled_integration()
+
+    mesh, pcd = tiled.integrate_tiled(recons, frame_indices)
+    assert pcd is None
+    volume = recons._integrate_with_traj(recons.create_volume(10000), frame_indices)
+    single = volume.cpu().extract_surface_mesh(weight_threshold=0.0).to_legacy_triangle_mesh()
+    bridge.close_all()
+
+    assert len(single.triangles) > 0
+    assert abs(len(mesh.triangles) - len(single.triangles)) <= 0.01 * len(single.triangles)
+    # the stitched surface lies on the single volume surface
+    distances = np.asarray(o3d.geometry.PointCloud(mesh.vertices).compute_point_cloud_distance(
+        o3d.geometry.PointCloud(single.vertices)))
+    assert np.max(distances) < 0.02
+    assert np.unique(np.asarray(mesh.vertices), axis=0).shape[0] == len(mesh.vertices)
@@ -0,0 +1,238 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from multiscan.utils import trajectory
+
+DEFAULT_INTRINSICS = [500.0, 0, 0, 0, 500.0, 0, 320.0, 240.0, 1]
+
+
+def random_pose(rng):
+    q, _ = np.linalg.qr(rng.normal(size=(3, 3)))
+    if np.linalg.det(q) < 0:
+        q[:, 0] = -q[:, 0]
+    pose = np.eye(4)
+    pose[:3, :3] = q
+    pose[:3, 3] = rng.uniform(-2.0, 2.0, 3)
+    return pose
+
+
+def write_trajectory(path, num=20, seed=0):
+    """trajectory .jsonl with ARKit poses stored column major, every third camera without intrinsics"""
+    rng = np.random.default_rng(seed)
+    with open(path, 'w') as f:
+        for i in range(num):
+            cam_info = {'timestamp': i, 'transform': random_pose(rng).transpose().ravel().tolist()}
+            if i % 3:
+                K = np.array([[rng.uniform(400, 600), 0, 320], [0, rng.uniform(400, 600), 240], [0, 0, 1]])
+                cam_info['intrinsics'] = K.transpose().ravel().tolist()
+            f.write(json.dumps(cam_info) + '\n')
+    return str(path)
+
+
+def reference_cameras(path):
+    """camera extrinsics and intrinsics read one json document per line"""
+    extrinsics, intrinsics = [], []
+    with open(path, 'r') as f:
+        for line in f:
+            cam_info = json.loads(line)
+            C = np.asarray(cam_info['transform']).reshape(4, 4).transpose()
+            C = np.matmul(C, np.diag([1, -1, -1, 1]))
+            C = C / C[3][3]
+            extrinsics.append(np.linalg.inv(C))
+            K = np.asarray(cam_info.get('intrinsics', DEFAULT_INTRINSICS))
+            intrinsics.append(K.reshape(3, 3).transpose())
+    return np.array(extrinsics), np.array(intrinsics)
+
+
+def test_parse_matches_per_line_reading(tmp_path):
+    path = write_trajectory(tmp_path / 'trajectory.jsonl')
+    extrinsics, intrinsics = reference_cameras(path)
+    data = trajectory.parse_trajectory(path)
+    assert data['transforms'].shape == (20, 4, 4)
+    np.testing.assert_allclose(np.linalg.inv(trajectory.arkit_to_open3d(data['transforms'])), extrinsics,
+                               atol=1e-12)
+    np.testing.assert_allclose(trajectory.camera_extrinsics(path, cache=False), extrinsics, atol=1e-12)
+    missing = np.isnan(data['intrinsics']).any(axis=(1, 2))
+    assert missing.tolist() == [i % 3 == 0 for i in range(20)]
+    np.testing.assert_array_equal(trajectory.fill_intrinsics(data['intrinsics'], DEFAULT_INTRINSICS), intrinsics)
+    # the parsed intrinsics are left untouched
+    assert np.isnan(data['intrinsics']).any()
+
+
+def test_parse_skips_blank_lines_and_requires_transforms(tmp_path):
+    path = tmp_path / 'trajectory.jsonl'
+    path.write_text('{"transform": %s}\n\n' % json.dumps(np.eye(4).ravel().tolist()))
+    np.testing.assert_array_equal(trajectory.parse_trajectory(str(path))['transforms'], np.eye(4)[None])
+    path.write_text('{"transform": %s}\n{"timestamp": 1}\n' % json.dumps(np.eye(4).ravel().tolist()))
+    with pytest.raises(AssertionError):
+        trajectory.parse_trajectory(str(path))
+
+
+def test_cache_is_reused_until_the_trajectory_changes(tmp_path, monkeypatch):
+    path = write_trajectory(tmp_path / 'trajectory.jsonl')
+    expected = trajectory.load_trajectory(path)
+    assert os.path.isfile(trajectory.cache_path(path))
+
+    parses = []
+    parse = trajectory.parse_trajectory
+    monkeypatch.setattr(trajectory, 'parse_trajectory', lambda filename: parses.append(filename) or parse(filename))
+    cached = trajectory.load_trajectory(path)
+    assert not parses
+    for key in ('transforms', 'intrinsics'):
+        np.testing.assert_array_equal(cached[key], expected[key])
+
+    write_trajectory(path, num=5, seed=1)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert len(trajectory.load_trajectory(path)['transforms']) == 5
+    assert parses == [path]
+    assert len(trajectory.load_trajectory(path)['transforms']) == 5
+    assert parses == [path]
+
+
+def test_invalid_cache_is_replaced(tmp_path):
+    path = write_trajectory(tmp_path / 'trajectory.jsonl')
+    with open(trajectory.cache_path(path), 'wb') as f:
+        f.write(b'not a npz file')
+    assert len(trajectory.load_trajectory(path)['transforms']) == 20
+    with np.load(trajectory.cache_path(path)) as data:
+        assert len(data['transforms']) == 20
+    assert sorted(os.listdir(tmp_path)) == ['trajectory.jsonl', 'trajectory.jsonl.npz']
+
+
+def test_no_cache(tmp_path):
+    path = write_trajectory(tmp_path / 'trajectory.jsonl')
+    trajectory.load_trajectory(path, cache=False)
+    assert not os.path.exists(trajectory.cache_path(path))
+
+
+def camera_path(centers, angles):
+    """world to camera extrinsics of cameras at centers rotated by angles (degree) about the z axis"""
+    extrinsics = []
+    for center, angle in zip(centers, np.deg2rad(angles)):
+        pose = np.eye(4)
+        pose[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+        pose[:3, 3] = center
+        extrinsics.append(np.linalg.inv(pose))
+    return np.array(extrinsics)
+
+
+def reference_keyframes(extrinsics, min_translation, min_rotation, max_gap):
+    poses = np.linalg.inv(extrinsics)
+    selected = [0]
+    for i in range(1, len(extrinsics)):
+        last = selected[-1]
+        translation = np.linalg.norm(poses[i, :3, 3] - poses[last, :3, 3])
+        relative = np.matmul(poses[i, :3, :3], poses[last, :3, :3].transpose())
+        rotation = np.rad2deg(np.arccos(np.clip((np.trace(relative) - 1) / 2, -1, 1)))
+        if translation > min_translation or rotation > min_rotation or (max_gap > 0 and i - last > max_gap):
+            selected.append(i)
+    return selected
+
+
+def test_keyframes_follow_translation_and_rotation():
+    # moves 4 cm per frame, then stands still and turns 3 degrees per frame
+    centers = [[0.04 * min(i, 10), 0, 0] for i in range(20)]
+    angles = [3.0 * max(i - 10, 0) for i in range(20)]
+    extrinsics = camera_path(centers, angles)
+    assert trajectory.select_keyframes(extrinsics).tolist() == list(range(20))
+    assert trajectory.select_keyframes(extrinsics, 0.1, 180).tolist() == [0, 3, 6, 9]
+    assert trajectory.select_keyframes(extrinsics, 1.0, 10).tolist() == [0, 14, 18]
+    assert trajectory.select_keyframes(extrinsics, 0.1, 10).tolist() == [0, 3, 6, 9, 14, 18]
+    assert trajectory.select_keyframes(extrinsics, 1.0, 180, max_gap=5).tolist() == [0, 6, 12, 18]
+    assert trajectory.select_keyframes(extrinsics[:0], 0.1, 10).tolist() == []
+
+
+def test_keyframes_match_reference_on_random_trajectories():
+    rng = np.random.default_rng(0)
+    for _ in range(20):
+        num = int(rng.integers(1, 60))
+        centers = np.cumsum(rng.normal(0, 0.03, (num, 3)), axis=0)
+        angles = np.cumsum(rng.normal(0, 4, num))
+        extrinsics = camera_path(centers, angles)
+        # rotate the whole path to exercise rotations about all axes
+        world = random_pose(rng)
+        extrinsics = np.matmul(extrinsics, np.linalg.inv(world))
+        min_translation = rng.uniform(0, 0.2)
+        min_rotation = rng.uniform(0, 20)
+        max_gap = int(rng.integers(0, 8))
+        assert trajectory.select_keyframes(extrinsics, min_translation, min_rotation, max_gap).tolist() == \
+            reference_keyframes(extrinsics, min_translation, min_rotation, max_gap)
+
+
+FRUSTUM_SIZE = (48, 36)
+FRUSTUM_INTRINSICS = np.array([[40.0, 0, 24], [0, 40.0, 18], [0, 0, 1]])
+
+
+def turning_path(num=8):
+    """cameras moving sideways while turning about the vertical axis"""
+    centers = [[0.1 * i, 0, 0] for i in range(num)]
+    extrinsics = camera_path(centers, np.zeros(num))
+    for i, extrinsic in enumerate(extrinsics):
+        angle = np.deg2rad(10 * i)
+        rotation = np.eye(4)
+        rotation[:3, :3] = [[np.cos(angle), 0, np.sin(angle)], [0, 1, 0], [-np.sin(angle), 0, np.cos(angle)]]
+        extrinsics[i] = np.matmul(rotation.transpose(), extrinsic)
+    return extrinsics
+
+
+def dense_frustum_blocks(extrinsics, intrinsics, width, height, depth_min, depth_max, block_size):
+    """blocks hit by rays through every pixel corner sampled at every 8th of a block"""
+    u, v = np.meshgrid(np.linspace(0, width, width + 1), np.linspace(0, height, height + 1))
+    pixels = np.stack([u.ravel(), v.ravel(), np.ones(u.size)])
+    depths = np.arange(depth_min, depth_max + 1e-9, block_size / 8)
+    blocks = set()
+    for extrinsic, intrinsic in zip(extrinsics, intrinsics):
+        pose = np.linalg.inv(extrinsic)
+        points = (np.matmul(np.linalg.inv(intrinsic), pixels)[..., None] * depths).reshape(3, -1)
+        points = np.matmul(pose[:3, :3], points) + pose[:3, 3:]
+        blocks.update(map(tuple, np.unique(np.floor(points.T / block_size).astype(np.int64), axis=0).tolist()))
+    return blocks
+
+
+def test_frustum_blocks_match_dense_sampling():
+    extrinsics = turning_path()
+    intrinsics = np.tile(FRUSTUM_INTRINSICS, (len(extrinsics), 1, 1))
+    block_size = 0.24
+    blocks = trajectory.frustum_blocks(extrinsics, intrinsics, *FRUSTUM_SIZE, 0.2, 3.0, block_size, chunk_size=3)
+    assert blocks.shape[1] == 3 and len(np.unique(blocks, axis=0)) == len(blocks)
+    estimated = set(map(tuple, blocks.tolist()))
+    expected = dense_frustum_blocks(extrinsics, intrinsics, *FRUSTUM_SIZE, 0.2, 3.0, block_size)
+    # only blocks clipped at a frustum edge are missed
+    assert len(expected - estimated) <= 0.05 * len(expected)
+    assert len(estimated) <= 1.2 * len(expected)
+    no_blocks = trajectory.frustum_blocks(extrinsics[:0], intrinsics[:0], *FRUSTUM_SIZE, 0.2, 3.0, block_size)
+    assert no_blocks.shape == (0, 3)
+
+
+@pytest.mark.parametrize('scene', ['random', 'wall'])
+def test_frustum_blocks_bound_integrated_blocks(scene):
+    o3d = pytest.importorskip('open3d')
+    if not hasattr(o3d.t.geometry, 'VoxelBlockGrid'):
+        pytest.skip('open3d without VoxelBlockGrid')
+    voxel_size, block_resolution, depth_max = 0.01, 24, 3.0
+    extrinsics = turning_path()
+    intrinsics = np.tile(FRUSTUM_INTRINSICS, (len(extrinsics), 1, 1))
+    grid = o3d.t.geometry.VoxelBlockGrid(('tsdf', 'weight'), (o3d.core.float32, o3d.core.float32), (1, 1),
+                                         voxel_size, block_resolution, 1000)
+    rng = np.random.default_rng(0)
+    width, height = FRUSTUM_SIZE
+    used = set()
+    for extrinsic in extrinsics:
+        if scene == 'random':
+            depth = rng.uniform(0.2, depth_max, (height, width))
+        else:
+            depth = np.full((height, width), depth_max - 0.1)
+        image = o3d.t.geometry.Image(o3d.core.Tensor((depth * 1000).astype(np.uint16)))
+        # blocks allocated by the integration of the frame with an 8 cm truncation
+        coordinates = grid.compute_unique_block_coordinates(image, o3d.core.Tensor(FRUSTUM_INTRINSICS),
+                                                            o3d.core.Tensor(extrinsic), 1000.0, depth_max, 8.0)
+        used.update(map(tuple, coordinates.numpy().reshape(-1, 3).tolist()))
+    estimated = set(map(tuple, trajectory.frustum_blocks(extrinsics, intrinsics, width, height, 0.2, depth_max,
+                                                         voxel_size * block_resolution).tolist()))
+    assert len(used) > 100
+    assert len(used - estimated) <= 0.01 * len(used)
+    assert len(estimated) >= len(used)
@@ -0,0 +1,111 @@
+import os
+import pickle
+import zlib
+
+import numpy as np
+import pytest
+
+from multiscan.utils import zran
+
+pytestmark = pytest.mark.skipif(not zran.available(), reason='zlib library not found')
+
+HEIGHT, WIDTH = 32, 48
+NUM_FRAMES = 300
+
+
+def deflate(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+@pytest.fixture(scope='module')
+def frames():
+    rng = np.random.default_rng(0)
+    # smooth depth like frames compress into many deflate blocks
+    base = rng.integers(500, 4000, (NUM_FRAMES, 1, 1), dtype=np.uint16)
+    noise = rng.integers(0, 64, (NUM_FRAMES, HEIGHT, WIDTH), dtype=np.uint16)
+    return base + noise
+
+
+@pytest.fixture
+def stream(tmp_path, frames):
+    path = str(tmp_path / 'scan.depth.zlib')
+    with open(path, 'wb') as f:
+        f.write(deflate(frames.tobytes()))
+    return path
+
+
+def test_index_has_checkpoints(stream, frames):
+    index = zran.build_index(stream, span=1 << 16)
+    assert int(index['total_out']) == frames.nbytes
+    assert len(index['out']) > 4
+    assert np.all(np.diff(index['out']) > 1 << 16)
+    assert index['windows'].shape == (len(index['out']), zran.WINSIZE)
+
+
+def test_random_reads_match_stream(stream, frames):
+    raw = frames.tobytes()
+    reader = zran.ZranStream(stream, span=1 << 16)
+    rng = np.random.default_rng(1)
+    offsets = list(rng.integers(0, len(raw), 50)) + [0, len(raw) - 1, len(raw) - 10]
+    for offset in offsets:
+        size = int(rng.integers(1, 20000))
+        assert reader.read(int(offset), size).tobytes() == raw[offset:offset + size]
+    # sequential reads continue from the previous read
+    assert reader.read(1000, 100).tobytes() + reader.read(1100, 100).tobytes() == raw[1000:1200]
+    assert reader.read(len(raw), 10).size == 0
+    reader.close()
+
+
+def test_frames_indexing(stream, frames):
+    depth = zran.ZranFrames(stream, (HEIGHT, WIDTH), 'uint16', checkpoint_frames=8)
+    assert len(depth) == NUM_FRAMES and depth.shape == frames.shape
+    np.testing.assert_array_equal(depth[0], frames[0])
+    np.testing.assert_array_equal(depth[-1], frames[-1])
+    np.testing.assert_array_equal(depth[123], frames[123])
+    np.testing.assert_array_equal(depth[10:50:3], frames[10:50:3])
+    np.testing.assert_array_equal(depth[50:10:-4], frames[50:10:-4])
+    np.testing.assert_array_equal(depth[[250, 3, -1, 3]], frames[[250, 3, -1, 3]])
+    np.testing.assert_array_equal(depth.read(290, 20), frames[290:])
+    assert depth[5:5].shape == (0, HEIGHT, WIDTH)
+    with pytest.raises(IndexError):
+        depth[NUM_FRAMES]
+    with pytest.raises(IndexError):
+        depth[[0, NUM_FRAMES]]
+    depth.close()
+
+
+def test_frames_are_picklable(stream, frames):
+    depth = pickle.loads(pickle.dumps(zran.ZranFrames(stream, (HEIGHT, WIDTH), 'uint16')))
+    np.testing.assert_array_equal(depth[77], frames[77])
+
+
+def test_index_sidecar_is_reused(stream, monkeypatch):
+    index = zran.load_index(stream, 1 << 16)
+    assert os.path.isfile(zran.index_path(stream))
+
+    def fail(*args):
+        raise AssertionError('index rebuilt')
+    monkeypatch.setattr(zran, 'build_index', fail)
+    cached = zran.load_index(stream, 1 << 17)
+    np.testing.assert_array_equal(cached['out'], index['out'])
+    np.testing.assert_array_equal(cached['windows'], index['windows'])
+
+
+def test_index_sidecar_is_rebuilt(stream, frames):
+    zran.load_index(stream, 1 << 16)
+    # a smaller span needs more checkpoints
+    assert int(zran.load_index(stream, 1 << 15)['span']) == 1 << 15
+    with open(stream, 'wb') as f:
+        f.write(deflate(frames[:10].tobytes()))
+    assert int(zran.load_index(stream, 1 << 15)['total_out']) == frames[:10].nbytes
+
+
+def test_truncated_stream(tmp_path, frames):
+    path = str(tmp_path / 'truncated.zlib')
+    data = deflate(frames.tobytes())
+    with open(path, 'wb') as f:
+        f.write(data[:len(data) // 2])
+    depth = zran.ZranFrames(path, (HEIGHT, WIDTH), 'uint16')
+    assert 0 < len(depth) < NUM_FRAMES
+    np.testing.assert_array_equal(depth[len(depth) - 1], frames[len(depth) - 1])
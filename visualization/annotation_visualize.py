@@ -12,19 +12,18 @@ import matplotlib
 from PIL import Image
 from matplotlib import cm
 import pandas as pd
-from plyfile import PlyData
 from tqdm import tqdm
 from multiprocessing import Pool, cpu_count
 from scipy.spatial.transform import Rotation as R
 
 import matplotlib.colors as mc
 import colorsys
-from io import BytesIO
 
 import hydra
 from omegaconf import DictConfig
 
 from multiscan.utils import io
+from multiscan.utils import ply
 from visualization import Visualizer
 
 log = logging.getLogger(__name__)
@@ -56,8 +55,8 @@ def lighten_color(color, amount=0.8, alpha=0.7):
 class AnnotationVisualize:
     def __init__(self, cfg, input_dir):
         self.cfg = cfg
-        self._arrow_ply = PlyData.read(BytesIO(requests.get(urljoin(cfg.arrow_ply_gist_url, 'arrow.ply')).content))
-        self._arrow_head_ply = PlyData.read(BytesIO(requests.get(urljoin(cfg.arrow_ply_gist_url, 'arrow_head.ply')).content))
+        self._arrow_ply = ply.read_ply(requests.get(urljoin(cfg.arrow_ply_gist_url, 'arrow.ply')).content)
+        self._arrow_head_ply = ply.read_ply(requests.get(urljoin(cfg.arrow_ply_gist_url, 'arrow_head.ply')).content)
         self._head_body_ratio = 0.25
 
         self.input_dir = input_dir
@@ -113,28 +112,19 @@ class AnnotationVisualize:
         return alignment
 
     def _get_plydata(self):
-        return PlyData.read(os.path.join(self.input_dir, f'{self.scan_id}.ply'))
+        return ply.read_ply(os.path.join(self.input_dir, f'{self.scan_id}.ply'))
 
     def _construct_ply_mesh(self):
-        x = np.asarray(self.plydata['vertex']['x'])
-        y = np.asarray(self.plydata['vertex']['y'])
-        z = np.asarray(self.plydata['vertex']['z'])
-        nx = np.asarray(self.plydata['vertex']['nx'])
-        ny = np.asarray(self.plydata['vertex']['ny'])
-        nz = np.asarray(self.plydata['vertex']['nz'])
-        red = self.plydata['vertex']['red'].astype('float64') / 255.
-        green = self.plydata['vertex']['green'].astype('float64') / 255.
-        blue = self.plydata['vertex']['blue'].astype('float64') / 255.
-        
-        vertices = np.column_stack((x, y, z))
-        vertex_normals = np.column_stack((nx, ny, nz))
-        vertex_colors = np.column_stack((red, green, blue))
-        triangles = np.vstack(self.plydata['face'].data['vertex_indices'])
+        vertex = self.plydata['vertex']
+        vertices = ply.columns(vertex, ('x', 'y', 'z'))
+        vertex_normals = ply.columns(vertex, ('nx', 'ny', 'nz'))
+        vertex_colors = ply.columns(vertex, ('red', 'green', 'blue')) / 255.
+        triangles = ply.faces(self.plydata['face'])
         return vertices, vertex_colors, vertex_normals, triangles
 
     def semseg_triangles(self):
-        object_ids = self.plydata['face'].data['objectId']
-        part_ids = self.plydata['face'].data['partId']
+        object_ids = self.plydata['face']['objectId']
+        part_ids = self.plydata['face']['partId']
         return pd.DataFrame({'objectId': object_ids, 'partId': part_ids})
 
     def object_triangles(self, object_id):
@@ -164,18 +154,9 @@ class AnnotationVisualize:
 
     @staticmethod
     def plydata_to_trimesh(plydata, color):
-        x = plydata['vertex']['x']
-        y = plydata['vertex']['y']
-        z = plydata['vertex']['z']
-        vertices = np.column_stack((x, y, z))
-
-        nx = plydata['vertex']['nx']
-        ny = plydata['vertex']['ny']
-        nz = plydata['vertex']['nz']
-        vertex_normals = np.column_stack((nx, ny, nz))
-        
-        tri_data = plydata['face'].data['vertex_indices']
-        triangles = np.vstack(tri_data)
+        vertices = ply.columns(plydata['vertex'], ('x', 'y', 'z'))
+        vertex_normals = ply.columns(plydata['vertex'], ('nx', 'ny', 'nz'))
+        triangles = ply.faces(plydata['face'])
 
         return trimesh.Trimesh(vertices, faces=triangles, vertex_normals=vertex_normals, vertex_colors=color)
 